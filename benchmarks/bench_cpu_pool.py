@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""Measure CPU heavy work on the event loop against running it in CpuPool
+
+Every scenario submits its tasks in concurrent batches, first with the work
+done on the event loop and then offloaded to worker processes, and reports
+the task throughput, the p50/p99 latency of a task and how late a 1ms timer
+on the same loop fired (p99 loop lag), i.e. how long other rooms would have
+waited. Offloading is forced for every input here, the bot only does it for
+inputs of at least cpu_offload_min_size.
+
+    python benchmarks/bench_cpu_pool.py --output bench-cpu-pool.json
+    python benchmarks/bench_cpu_pool.py --compare bench-cpu-pool.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from matrix_bot.cpupool import CpuPool  # noqa: E402
+from matrix_bot.modules.base import render_help  # noqa: E402
+from matrix_bot.modules.zgame_render import render_output_detached  # noqa: E402
+
+CORPUS_FILE = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "../test-data/zgame-transcripts.json")
+)
+
+
+def make_gif_response(results):
+    # about the size of a GIF search response with `results` results
+    rendition = {
+        "url": "https://media.example.com/media/abcdef/giphy.gif",
+        "width": "480",
+        "height": "270",
+        "size": "1234567",
+        "mp4": "https://media.example.com/media/abcdef/giphy.mp4",
+        "mp4_size": "123456",
+        "webp": "https://media.example.com/media/abcdef/giphy.webp",
+        "webp_size": "234567",
+    }
+    data = [
+        {
+            "id": "abcdef{}".format(i),
+            "title": "cat typing on a keyboard GIF {}".format(i),
+            "url": "https://example.com/gifs/cat-{}".format(i),
+            "images": {
+                "{}_{}".format(name, j): dict(rendition)
+                for name in ("original", "fixed_height", "fixed_width", "downsized")
+                for j in range(4)
+            },
+        }
+        for i in range(results)
+    ]
+    return json.dumps({"data": data, "pagination": {"count": results}}).encode()
+
+
+def make_scenarios():
+    with open(CORPUS_FILE) as f:
+        corpus = json.load(f)
+
+    outputs = [
+        turn["output"]
+        for transcript in corpus
+        for turn in transcript["turns"]
+        if "error" not in turn
+    ]
+    long_output = "\n".join(outputs[:40])
+    rows = [
+        ("!command{}, !c{}".format(i, i), "<name>\xa0[optional]", "does thing " * 8)
+        for i in range(100)
+    ]
+    return {
+        "gif_json_500k": (json.loads, (make_gif_response(100),)),
+        "zgame_turn": (render_output_detached, (outputs[10], {})),
+        "zgame_long_output": (render_output_detached, (long_output, {})),
+        "help_100_commands": (render_help, (rows,)),
+    }
+
+
+def percentile(sorted_values, p):
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def measure_lag(lags, stop):
+    while not stop.is_set():
+        t = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - t - 0.001)
+
+
+async def bench(pool, func, args, tasks, concurrency):
+    latencies = []
+
+    async def task():
+        t = time.perf_counter()
+        await pool.run(func, *args)
+        latencies.append(time.perf_counter() - t)
+
+    # start the workers and import the task function in them
+    await asyncio.gather(*(pool.run(func, *args) for unused in range(concurrency)))
+
+    lags = []
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_lag(lags, stop))
+    await asyncio.sleep(0.01)
+    start = time.perf_counter()
+    for unused in range(tasks // concurrency):
+        await asyncio.gather(*(task() for unused in range(concurrency)))
+
+    total_time = time.perf_counter() - start
+    stop.set()
+    await lag_task
+    latencies.sort()
+    lags.sort()
+    return dict(
+        tasks=len(latencies),
+        tasks_per_second=len(latencies) / total_time,
+        p50_us=percentile(latencies, 50) * 1e6,
+        p99_us=percentile(latencies, 99) * 1e6,
+        lag_p99_us=percentile(lags, 99) * 1e6,
+    )
+
+
+async def run(args):
+    results = {}
+    for name, (func, func_args) in make_scenarios().items():
+        results[name] = {}
+        for mode, workers in (("inline", 0), ("offloaded", args.workers)):
+            pool = CpuPool(workers=workers, min_size=0)
+            try:
+                results[name][mode] = await bench(
+                    pool, func, func_args, args.tasks, args.concurrency
+                )
+            finally:
+                pool.close()
+
+    return dict(
+        meta=dict(
+            python=platform.python_version(),
+            machine=platform.machine(),
+            cpus=os.cpu_count(),
+            workers=args.workers,
+            tasks=args.tasks,
+            concurrency=args.concurrency,
+            timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        ),
+        results=results,
+    )
+
+
+def print_report(report, baseline=None):
+    print(
+        "{:<18} {:<10} {:>10} {:>10} {:>10} {:>12}".format(
+            "scenario", "mode", "tasks/s", "p50 us", "p99 us", "lag p99 us"
+        )
+    )
+    for name, modes in report["results"].items():
+        for mode, result in modes.items():
+            line = "{:<18} {:<10} {:>10.0f} {:>10.1f} {:>10.1f} {:>12.1f}".format(
+                name,
+                mode,
+                result["tasks_per_second"],
+                result["p50_us"],
+                result["p99_us"],
+                result["lag_p99_us"],
+            )
+            if baseline is not None and name in baseline["results"]:
+                old = baseline["results"][name][mode]["tasks_per_second"]
+                line += "  {:+.1f}%".format(
+                    (result["tasks_per_second"] / old - 1) * 100
+                )
+
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--tasks", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""Measure how fast MatrixBot dispatches room messages to module commands
+
+Builds a MatrixBot with a stub client and stub modules and feeds it synthetic
+RoomMessageText events. For every scenario (command hits, misses, prefix
+commands and validation errors) it reports the throughput and the p50/p99
+latency of dispatching a single event, both through the command router and
+through the per-module scan of MatrixBotModule.handle_room_message. The
+throughput of the whole path through on_room_message and the worker queue is
+measured as well.
+
+    python benchmarks/bench_dispatch.py --output bench-dispatch.json
+    python benchmarks/bench_dispatch.py --compare bench-dispatch.json
+"""
+
+import argparse
+import asyncio
+import configparser
+import json
+import os
+import platform
+import sys
+import time
+
+from nio import RoomMessageText
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from matrix_bot.core import MatrixBot  # noqa: E402
+from matrix_bot.modules.base import MatrixBotModule, ValidationError, arg  # noqa: E402
+
+SCENARIOS = {
+    "hit": "!cmd7-3 some argument",
+    "miss": "just people talking in the room, nothing to see here",
+    "prefix": "\\look at the mailbox",
+    "validation_error": "!strict not-a-number",
+}
+
+
+class StubClient:
+    user = "@bench:localhost"
+    user_id = "@bench:localhost"
+
+    async def room_send(self, room_id, message_type, content):
+        pass
+
+
+class StubRoom:
+    def __init__(self, room_id):
+        self.room_id = room_id
+
+
+def make_stub_module(index, with_extras):
+    class StubModule(MatrixBotModule):
+        def register_commands(self):
+            for i in range(5):
+                self.add_command(
+                    "!cmd{}-{}".format(index, i),
+                    arg("value", self.validate, optional=True, multi_word=True),
+                    callback=self.noop,
+                    help="stub command",
+                )
+
+            if not with_extras:
+                return
+
+            self.add_command(
+                "!strict",
+                arg("number", self.validate_number),
+                callback=self.noop,
+                help="only takes numbers",
+            )
+            self.add_command(
+                "\\",
+                arg("command", self.validate),
+                callback=self.noop,
+                prefix=True,
+                help="prefix command",
+            )
+
+        def validate(self, value):
+            pass
+
+        def validate_number(self, value):
+            if not value.isdigit():
+                raise ValidationError("not a number")
+
+        async def noop(self, **kwargs):
+            pass
+
+    return StubModule({})
+
+
+def make_bot(module_count):
+    config = configparser.ConfigParser()
+    # don't let the send rate limit dominate the validation error scenario
+    config.read_dict(
+        {
+            "main": {
+                "media_cache": ":memory:",
+                "send_rate": "1000000000",
+                "send_burst": "1000000000",
+            }
+        }
+    )
+    bot = MatrixBot(config)
+    bot.accounts[0].client = StubClient()
+    bot.use_modules(
+        [make_stub_module(i, i == module_count - 1) for i in range(module_count)]
+    )
+    return bot
+
+
+def make_event(body, i):
+    return RoomMessageText.from_dict(
+        {
+            "event_id": "$event{}".format(i),
+            "sender": "@user{}:localhost".format(i % 10),
+            "origin_server_ts": int(time.time() * 1000),
+            "type": "m.room.message",
+            "content": {"msgtype": "m.text", "body": body},
+        }
+    )
+
+
+def percentile(sorted_values, p):
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, total_time):
+    latencies.sort()
+    return dict(
+        events=len(latencies),
+        events_per_second=len(latencies) / total_time,
+        p50_us=percentile(latencies, 50) * 1e6,
+        p99_us=percentile(latencies, 99) * 1e6,
+    )
+
+
+async def legacy_dispatch(bot, room, event):
+    # what on_room_message did before the command router existed
+    for module in bot.modules:
+        try:
+            await module.handle_room_message(bot, room, event)
+        except Exception:
+            pass
+
+
+async def bench_dispatch(dispatch, bot, body, count):
+    rooms = [StubRoom("!room{}:localhost".format(i)) for i in range(10)]
+    events = [make_event(body, i) for i in range(count)]
+    latencies = []
+    clock = time.perf_counter
+    start = clock()
+    for i, event in enumerate(events):
+        t = clock()
+        await dispatch(bot, rooms[i % len(rooms)], event)
+        latencies.append(clock() - t)
+
+    return summarize(latencies, clock() - start)
+
+
+async def bench_queue(bot, body, count):
+    rooms = [StubRoom("!room{}:localhost".format(i)) for i in range(10)]
+    events = [make_event(body, i) for i in range(count)]
+    bot.event_queue.start()
+    start = time.perf_counter()
+    for i, event in enumerate(events):
+        await bot.on_room_message(bot.accounts[0], rooms[i % len(rooms)], event)
+
+    await bot.event_queue.join()
+    total_time = time.perf_counter() - start
+    await bot.event_queue.stop()
+    return dict(events=count, events_per_second=count / total_time)
+
+
+async def run(args):
+    bot = make_bot(args.modules)
+
+    async def router_dispatch(bot, room, event):
+        await bot.handle_room_message(room, event)
+
+    results = {}
+    for name, body in SCENARIOS.items():
+        # warm up
+        await bench_dispatch(router_dispatch, bot, body, min(args.events, 1000))
+        results[name] = dict(
+            router=await bench_dispatch(router_dispatch, bot, body, args.events),
+            module_scan=await bench_dispatch(legacy_dispatch, bot, body, args.events),
+            queue=await bench_queue(bot, body, args.events),
+        )
+
+    return dict(
+        meta=dict(
+            python=platform.python_version(),
+            machine=platform.machine(),
+            modules=args.modules,
+            events=args.events,
+            timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        ),
+        results=results,
+    )
+
+
+def print_report(report, baseline=None):
+    print(
+        "{:<18} {:<12} {:>14} {:>10} {:>10}".format(
+            "scenario", "path", "events/s", "p50 us", "p99 us"
+        )
+    )
+    for scenario, paths in report["results"].items():
+        for path, result in paths.items():
+            line = "{:<18} {:<12} {:>14.0f} {:>10} {:>10}".format(
+                scenario,
+                path,
+                result["events_per_second"],
+                "{:.1f}".format(result["p50_us"]) if "p50_us" in result else "-",
+                "{:.1f}".format(result["p99_us"]) if "p99_us" in result else "-",
+            )
+            if baseline is not None:
+                try:
+                    old = baseline["results"][scenario][path]["events_per_second"]
+                    line += "  {:+.1f}%".format(
+                        (result["events_per_second"] / old - 1) * 100
+                    )
+                except KeyError:
+                    pass
+
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--modules", type=int, default=20)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
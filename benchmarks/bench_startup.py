@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""Measure how long it takes to start the bot from a fresh interpreter
+
+For every scenario a new Python process imports matrix_bot.core and creates
+a MatrixBot from a config with only some module sections, like a container
+restart does before logging in. Reports the median and p90 of the time spent
+importing and creating the bot and which optional dependencies were
+imported.
+
+    python benchmarks/bench_startup.py --output bench-startup.json
+    python benchmarks/bench_startup.py --compare bench-startup.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+SCENARIOS = {
+    "no_modules": [],
+    "gifs": ["giphy", "tenor"],
+    "all_modules": ["giphy", "tenor", "xkcd", "zgame"],
+}
+
+# imported only by the modules or features that need them
+OPTIONAL_IMPORTS = ["lxml", "aiohttp.web", "matrix_bot.modules.zgame"]
+
+CHILD = """
+import configparser, json, sys, time
+start = time.monotonic()
+from matrix_bot.core import MatrixBot
+imported = time.monotonic()
+config = configparser.ConfigParser()
+config.read_dict(json.loads(sys.argv[1]))
+bot = MatrixBot(config, started=start)
+created = time.monotonic()
+print(json.dumps(dict(
+    import_s=imported - start,
+    init_s=created - imported,
+    modules=[type(m).__name__ for m in bot.modules],
+    optional_imports=[m for m in json.loads(sys.argv[2]) if m in sys.modules],
+)))
+"""
+
+
+def make_config(sections, data_dir):
+    config = {
+        "main": {"store_path": data_dir},
+        "giphy": {"api_key": "key"},
+        "tenor": {"api_key": "key"},
+        "xkcd": {"index_file": os.path.join(data_dir, "xkcd.json")},
+        "zgame": {
+            "session_dir": os.path.join(data_dir, "sessions"),
+            "save_dir": os.path.join(data_dir, "saves"),
+        },
+    }
+    return {name: config[name] for name in ["main"] + sections}
+
+
+def start_once(sections):
+    with tempfile.TemporaryDirectory() as data_dir:
+        start = time.perf_counter()
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                CHILD,
+                json.dumps(make_config(sections, data_dir)),
+                json.dumps(OPTIONAL_IMPORTS),
+            ],
+            cwd=ROOT,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        total = time.perf_counter() - start
+
+    result = json.loads(output.splitlines()[-1])
+    result["process_s"] = total
+    return result
+
+
+def percentile(sorted_values, p):
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run(args):
+    results = {}
+    for name, sections in SCENARIOS.items():
+        # warm up the file system cache
+        start_once(sections)
+        runs = [start_once(sections) for unused in range(args.runs)]
+        result = dict(
+            modules=runs[-1]["modules"],
+            optional_imports=runs[-1]["optional_imports"],
+        )
+        for phase in ("import_s", "init_s", "process_s"):
+            values = sorted(run[phase] for run in runs)
+            result[phase] = dict(p50=percentile(values, 50), p90=percentile(values, 90))
+
+        results[name] = result
+
+    return dict(
+        meta=dict(
+            python=platform.python_version(),
+            machine=platform.machine(),
+            runs=args.runs,
+            timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        ),
+        results=results,
+    )
+
+
+def print_report(report, baseline=None):
+    print(
+        "{:<12} {:>14} {:>14} {:>14}  {}".format(
+            "scenario", "import ms", "init ms", "process ms", "optional imports"
+        )
+    )
+    for name, result in report["results"].items():
+        line = "{:<12}".format(name)
+        for phase in ("import_s", "init_s", "process_s"):
+            line += " {:>14}".format(
+                "{:.0f} / {:.0f}".format(
+                    result[phase]["p50"] * 1000, result[phase]["p90"] * 1000
+                )
+            )
+
+        line += "  {}".format(", ".join(result["optional_imports"]) or "-")
+        if baseline is not None and name in baseline["results"]:
+            old = baseline["results"][name]["process_s"]["p50"]
+            line += "  {:+.1f}%".format((result["process_s"]["p50"] / old - 1) * 100)
+
+        print(line)
+
+    print("(p50 / p90)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run")
+    args = parser.parse_args()
+
+    report = run(args)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
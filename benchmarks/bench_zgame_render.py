@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""Compare the zgame output renderer with the lxml based one it replaced
+
+Replays the interpreter output in test-data/zgame-transcripts.json through
+both renderers, checks that they produce the same html and body for every
+turn and reports the throughput and the p50/p99 latency of rendering a
+single turn. The lxml renderer is kept here as the reference, the corpus
+stores its output, --write-expected regenerates that after adding
+transcripts.
+
+    python benchmarks/bench_zgame_render.py --output bench-render.json
+    python benchmarks/bench_zgame_render.py --compare bench-render.json
+    python benchmarks/bench_zgame_render.py --write-expected
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import sys
+import time
+
+import lxml.html
+from lxml.html import builder as E
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from matrix_bot.modules.zgame_render import render_output  # noqa: E402
+
+CORPUS_FILE = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "../test-data/zgame-transcripts.json")
+)
+
+
+def count_leading_spaces(s):
+    for i in range(len(s)):
+        if s[i] != " ":
+            return i
+
+
+def add_text(element, text):
+    children = element.getchildren()
+    if children:
+        last_element = children[-1]
+        if last_element.tail:
+            last_element.tail += "\n" + text
+        else:
+            last_element.tail = text
+
+    else:
+        if element.text:
+            element.text += "\n" + text
+        else:
+            element.text = text
+
+
+def remove_trailing_brs(element):
+    children = element.getchildren()
+    for child in children:
+        remove_trailing_brs(child)
+
+    if children:
+        last_child = children[-1]
+        if last_child.tag == "br" and not last_child.tail:
+            element.remove(last_child)
+
+
+def legacy_render_output(data, status_line):
+    # ZGameModule.convert_to_html and MatrixBot.send_room_html before the
+    # single pass renderer
+    data = data.rstrip("> \n\r")
+    data = data.replace("</i><i>", "")
+    data = data.replace("</b><b>", "")
+    lines = data.split("\n")
+
+    main_div = E.DIV()
+
+    first_line_chunks = re.split("    +", lines[0], 1)
+    if len(first_line_chunks) > 1:
+        lines.pop(0)
+        location, score = first_line_chunks
+        location = location.strip()
+        location_full = location
+        score = score.strip()
+
+        if lines:
+            line = lines[0].strip()
+            if line.startswith("- "):
+                lines.pop(0)
+                location_full = location + " (" + line[2:] + ")"
+
+        if location_full != status_line.get("location", ""):
+            main_div.append(E.DIV(E.CLASS("location"), location_full))
+
+        if score != status_line.get("score", ""):
+            main_div.append(E.DIV(E.CLASS("score"), score))
+    else:
+        location = None
+        location_full = None
+        score = None
+
+    status_line["location"] = location_full
+    status_line["score"] = score
+
+    base_leading_spaces = min(count_leading_spaces(s) for s in lines if s.strip(". "))
+
+    current = main_div
+    for raw_line in lines:
+        line = raw_line.strip()
+        if line == ".":
+            line = ""
+
+        line_without_tags = re.sub(r"</?[bi]>", "", line)
+        if location and line_without_tags.startswith(location):
+            continue
+
+        if line.startswith("[") and line.endswith("]"):
+            current.attrib["title"] = line
+            continue
+
+        if current.tag != "p" and not line:
+            continue
+
+        if current.tag != "p" or not line:
+            current = E.P()
+            main_div.append(current)
+
+        fixed_line = raw_line
+        if base_leading_spaces > 0 and fixed_line.startswith(" " * base_leading_spaces):
+            fixed_line = fixed_line[base_leading_spaces:]
+
+        fixed_line = fixed_line.replace("  ", "\xa0 ")
+
+        add_text(current, fixed_line)
+
+        if fixed_line and len(fixed_line) < 50:
+            br = E.BR()
+            current.append(br)
+
+    remove_trailing_brs(main_div)
+
+    html_data = lxml.html.tostring(main_div, pretty_print=True).decode("utf-8")
+    html_data = html_data.replace("&lt;i&gt;", "<i>")
+    html_data = html_data.replace("&lt;/i&gt;", "</i>")
+    html_data = html_data.replace("&lt;b&gt;", "<b>")
+    html_data = html_data.replace("&lt;/b&gt;", "</b>")
+
+    return html_data, re.sub("<[^<]+?>", "", html_data)
+
+
+def load_corpus():
+    with open(CORPUS_FILE) as f:
+        return json.load(f)
+
+
+def replay(render, transcript):
+    """Render all turns of a transcript like a room playing it would"""
+    status_line = {}
+    for turn in transcript["turns"]:
+        try:
+            html, body = render(turn["output"], status_line)
+        except ValueError as e:
+            yield dict(error=type(e).__name__)
+        else:
+            yield dict(html=html, body=body)
+
+
+def write_expected(corpus):
+    for transcript in corpus:
+        for turn, result in zip(
+            transcript["turns"], replay(legacy_render_output, transcript)
+        ):
+            for key in ("html", "body", "error"):
+                turn.pop(key, None)
+
+            turn.update(result)
+
+    with open(CORPUS_FILE, "w") as f:
+        json.dump(corpus, f, indent=1, ensure_ascii=False)
+        f.write("\n")
+
+
+def check(corpus):
+    mismatches = 0
+    for transcript in corpus:
+        results = zip(
+            transcript["turns"],
+            replay(legacy_render_output, transcript),
+            replay(render_output, transcript),
+        )
+        for i, (turn, legacy, result) in enumerate(results):
+            if legacy != result:
+                mismatches += 1
+                print(
+                    "{} turn {} ({!r}) differs".format(
+                        transcript["game"], i, turn["command"]
+                    )
+                )
+
+    return mismatches
+
+
+def percentile(sorted_values, p):
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def bench(render, corpus, rounds):
+    turns = [
+        turn["output"]
+        for transcript in corpus
+        for turn in transcript["turns"]
+        if "error" not in turn
+    ]
+    latencies = []
+    clock = time.perf_counter
+    start = clock()
+    for unused in range(rounds):
+        status_line = {}
+        for output in turns:
+            t = clock()
+            render(output, status_line)
+            latencies.append(clock() - t)
+
+    total_time = clock() - start
+    latencies.sort()
+    return dict(
+        turns=len(latencies),
+        turns_per_second=len(latencies) / total_time,
+        p50_us=percentile(latencies, 50) * 1e6,
+        p99_us=percentile(latencies, 99) * 1e6,
+    )
+
+
+def run(args, corpus):
+    results = {}
+    for name, render in (
+        ("lxml", legacy_render_output),
+        ("single_pass", render_output),
+    ):
+        # warm up
+        bench(render, corpus, 1)
+        results[name] = bench(render, corpus, args.rounds)
+
+    return dict(
+        meta=dict(
+            python=platform.python_version(),
+            machine=platform.machine(),
+            lxml=".".join(map(str, lxml.etree.LXML_VERSION)),
+            rounds=args.rounds,
+            timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        ),
+        results=results,
+    )
+
+
+def print_report(report, baseline=None):
+    print(
+        "{:<12} {:>14} {:>10} {:>10}".format("renderer", "turns/s", "p50 us", "p99 us")
+    )
+    for name, result in report["results"].items():
+        line = "{:<12} {:>14.0f} {:>10.1f} {:>10.1f}".format(
+            name, result["turns_per_second"], result["p50_us"], result["p99_us"]
+        )
+        if baseline is not None and name in baseline["results"]:
+            old = baseline["results"][name]["turns_per_second"]
+            line += "  {:+.1f}%".format((result["turns_per_second"] / old - 1) * 100)
+
+        print(line)
+
+    results = report["results"]
+    print(
+        "speedup: {:.1f}x".format(
+            results["single_pass"]["turns_per_second"]
+            / results["lxml"]["turns_per_second"]
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run")
+    parser.add_argument(
+        "--write-expected",
+        action="store_true",
+        help="store the output of the lxml renderer in the corpus",
+    )
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    if args.write_expected:
+        write_expected(corpus)
+        return
+
+    mismatches = check(corpus)
+    if mismatches:
+        sys.exit("{} turns render differently".format(mismatches))
+
+    report = run(args, corpus)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,19 @@
 #!/usr/bin/env python3
-import asyncio
-import configparser
-import logging
+import time
 
-from matrix_bot.core import MatrixBot
+# before the other imports, so the startup metrics include them
+STARTED = time.monotonic()
+
+import asyncio  # noqa: E402
+import configparser  # noqa: E402
+import logging  # noqa: E402
+
+from matrix_bot.core import MatrixBot  # noqa: E402
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.WARNING)
     config = configparser.ConfigParser()
     config.read("config.cfg")
 
-    bot = MatrixBot(config)
-    asyncio.get_event_loop().run_until_complete(bot.run())
+    bot = MatrixBot(config, started=STARTED)
+    asyncio.run(bot.run())
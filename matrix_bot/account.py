@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+import asyncio
+import os
+import time
+import traceback
+
+from nio import (
+    AsyncClient,
+    AsyncClientConfig,
+    InviteEvent,
+    RoomMessageText,
+    SyncResponse,
+)
+
+from matrix_bot.sendqueue import SendQueue
+from matrix_bot.sync import SyncFilter, SyncToken, limit_timeline
+
+
+def get_account_configs(config):
+    """Return (name, settings) of the accounts in `config`
+
+    [main] is an account unless there are [main:<name>] sections and it has
+    no user_id. The settings of a [main:<name>] account default to those in
+    [main], except store_path, which defaults to a <name> directory in the
+    store_path of [main].
+    """
+    main = dict(config["main"])
+    accounts = []
+    for section in config.sections():
+        if not section.startswith("main:"):
+            continue
+
+        name = section[len("main:") :]
+        settings = dict(main)
+        settings.update(config[section])
+        if "store_path" not in config[section]:
+            settings["store_path"] = os.path.join(main.get("store_path", "."), name)
+
+        accounts.append((name, settings))
+
+    if "user_id" in main or not accounts:
+        accounts.insert(0, ("main", main))
+
+    return accounts
+
+
+class Account:
+    """One identity of the bot, with its own client, sync and send queue
+
+    The rooms the account joined are served by the MatrixBot it belongs to.
+    If logging in or syncing fails the account retries after a growing delay
+    without affecting the other accounts, meanwhile its rooms are served by
+    other accounts that joined them.
+    """
+
+    def __init__(self, bot, name, config):
+        self.bot = bot
+        self.name = name
+        self.config = config
+        self.user_id = config.get("user_id")
+        self.client = None
+        # the account synced successfully and isn't restarting
+        self.healthy = False
+        self.send_queue = SendQueue.create(config)
+        self.sync_filter = SyncFilter.create(config)
+        self.sync_token = SyncToken.create(config)
+        # skip: only the latest message of each room is fetched on startup,
+        # resume: everything since the last sync is fetched, in both cases
+        # messages older than max_event_age seconds are ignored
+        self.catch_up = config.get("catch_up", "skip").lower()
+        if self.catch_up not in ("skip", "resume"):
+            raise ValueError("catch_up must be skip or resume")
+
+        self.max_restart_delay = float(config.get("max_restart_delay", "300"))
+        self.restarts = bot.account_restarts.labels(account=name)
+
+    def has_joined(self, room_id):
+        return self.healthy and room_id in self.client.rooms
+
+    async def on_room_message(self, room, event):
+        # nio calls on_sync after the event callbacks of a sync, getting
+        # events means the sync worked, so the account serves its rooms now
+        self.healthy = True
+        await self.bot.on_room_message(self, room, event)
+
+    async def on_invite(self, room, event):
+        await self.client.join(room.room_id)
+
+    async def on_sync(self, response):
+        self.healthy = True
+        self.sync_token.save(response.next_batch)
+
+    async def login(self):
+        if self.client is not None:
+            # left over from a failed attempt
+            await self.client.close()
+
+        # rate limits are handled by the send queue, which knows about all
+        # outgoing requests, rather than by nio sleeping inside each request
+        client_config = AsyncClientConfig(store_sync_tokens=True, max_limit_exceeded=0)
+        self.client = AsyncClient(
+            homeserver=self.config["base_url"],
+            user=self.user_id,
+            device_id=self.config["device_id"],
+            store_path=self.config["store_path"],
+            config=client_config,
+        )
+        self.client.add_event_callback(self.on_invite, InviteEvent)
+        self.client.add_event_callback(self.on_room_message, RoomMessageText)
+        self.client.add_response_callback(self.on_sync, SyncResponse)
+
+        phase_start = time.monotonic()
+        print("{}: logging in...".format(self.name))
+        await self.client.login(
+            self.config["password"], device_name=self.config["device_name"]
+        )
+
+        if not self.client.logged_in:
+            print("{}: error logging in.".format(self.name))
+            return False
+
+        print("{}: logged in as user {}".format(self.name, self.client.user_id))
+        self.bot.startup_duration.labels(phase="login").observe(
+            time.monotonic() - phase_start
+        )
+        return True
+
+    async def get_sync_options(self):
+        if self.sync_filter is not None:
+            sync_filter = await self.sync_filter.get_filter_id(self.client)
+            full_state = None
+        else:
+            sync_filter = None
+            full_state = True
+
+        if self.catch_up == "skip":
+            # the backlog is left on the server instead of being fetched and
+            # thrown away because it's too old
+            if self.sync_filter is not None:
+                first_sync_filter = limit_timeline(self.sync_filter.get_filter(), 1)
+            else:
+                first_sync_filter = limit_timeline(None, 1)
+        else:
+            first_sync_filter = None
+
+        return dict(
+            sync_filter=sync_filter,
+            first_sync_filter=first_sync_filter,
+            full_state=full_state,
+        )
+
+    async def run(self):
+        ready_task = None
+        sync_options = None
+        delay = 1
+        try:
+            while True:
+                try:
+                    if self.client is None or not self.client.logged_in:
+                        sync_options = None
+                        await self.login()
+
+                    if self.client.logged_in:
+                        if sync_options is None:
+                            sync_options = await self.get_sync_options()
+
+                        if ready_task is None:
+                            ready_task = asyncio.create_task(
+                                self.report_ready(time.monotonic())
+                            )
+
+                        await self.client.sync_forever(
+                            timeout=30000, since=self.sync_token.load(), **sync_options
+                        )
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    traceback.print_exc()
+
+                if self.healthy:
+                    # it was syncing fine until now
+                    delay = 1
+
+                self.healthy = False
+                self.restarts.inc()
+                print("{}: restarting in {}s".format(self.name, delay))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_restart_delay)
+        finally:
+            if ready_task is not None:
+                ready_task.cancel()
+
+    async def report_ready(self, sync_start):
+        await self.client.synced.wait()
+        now = time.monotonic()
+        self.bot.startup_duration.labels(phase="first_sync").observe(now - sync_start)
+        self.bot.startup_duration.labels(phase="total").observe(now - self.bot.started)
+        print("{}: ready after {:.2f}s".format(self.name, now - self.bot.started))
+
+    async def close(self):
+        await self.send_queue.stop()
+        if self.client is not None:
+            await self.client.close()
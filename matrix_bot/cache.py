@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+import time
+from collections import OrderedDict
+
+
+def normalize_query(query):
+    """Make queries that only differ in case or spacing share a cache entry"""
+    return " ".join(query.lower().split())
+
+
+class TTLCache:
+    """A bounded mapping whose entries expire `ttl` seconds after being set
+
+    When more than `max_entries` are stored, the least recently used entry is
+    dropped.
+    """
+
+    def __init__(self, max_entries, ttl, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        # key -> (expiry time, value), oldest first
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def create(config, prefix):
+        return TTLCache(
+            max_entries=int(config.get(prefix + "_size", "1000")),
+            ttl=float(config.get(prefix + "_ttl", "3600")),
+        )
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+
+        expires, value = entry
+        if expires <= self.clock():
+            del self.entries[key]
+            return default
+
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        if self.max_entries <= 0:
+            return
+
+        self.entries[key] = (self.clock() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return default
+
+        return entry[1]
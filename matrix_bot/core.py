@@ -1,15 +1,23 @@
 #!/usr/bin/env python3
-import inspect
+import asyncio
+import io
 import re
+import signal
+import time
 import traceback
-from datetime import datetime
+from collections import deque
 
-import lxml.html
-from lxml.html import builder as E
-from nio import AsyncClient, ClientConfig, InviteEvent, RoomMessageText
+from nio import ErrorResponse, UploadResponse
 
 from matrix_bot import modules
-from matrix_bot.modules.base import MatrixBotModule
+from matrix_bot.account import Account, get_account_configs
+from matrix_bot.cache import TTLCache
+from matrix_bot.cpupool import CpuPool
+from matrix_bot.httpclient import HttpClient
+from matrix_bot.media import BufferedBody, MediaCache, MediaError, StreamedBody
+from matrix_bot.metrics import MetricsExporter, MetricsRegistry
+from matrix_bot.modules.base import ValidationError
+from matrix_bot.singleflight import SingleFlight
 
 
 def read_base64_file(filename):
@@ -18,35 +26,295 @@ def read_base64_file(filename):
         return f.read().replace(b"\r\n", b"")
 
 
+class CommandRouter:
+    """Finds the command for a message across all modules in one lookup
+
+    Built once at startup from every registered Command. Plain commands are
+    looked up by their first word in a dict of aliases, prefix commands by
+    walking a character trie, the longest prefix wins. A plain command beats
+    a prefix command if both match. Messages whose first character can't
+    start any alias or prefix are rejected without further work.
+    """
+
+    # key of the command in a trie node, can't clash with a character
+    COMMAND = None
+
+    def __init__(self, modules=()):
+        self.aliases = {}
+        self.prefixes = {}
+        self.first_chars = set()
+        for module in modules:
+            for command in module.commands:
+                self.add(command)
+
+    def add(self, command):
+        for alias in command.aliases:
+            if command.prefix:
+                node = self.prefixes
+                for c in alias:
+                    node = node.setdefault(c, {})
+
+                if self.COMMAND in node:
+                    print("prefix '{}' is registered twice, ignoring".format(alias))
+                    continue
+
+                node[self.COMMAND] = command
+                self.first_chars.add(alias[0])
+            else:
+                if alias in self.aliases:
+                    print("alias '{}' is registered twice, ignoring".format(alias))
+                    continue
+
+                self.aliases[alias] = command
+                # aliases are lowercase, but matched case-insensitively
+                self.first_chars.add(alias[0])
+                self.first_chars.add(alias[0].upper())
+
+    def match(self, line):
+        """Return (command, args) for the line or None if nothing matches
+
+        `args` is what Command.invoke expects: the rest of the line for
+        prefix commands, the list of words after the alias otherwise.
+        """
+        line = line.lstrip()
+        if not line or line[0] not in self.first_chars:
+            return None
+
+        line = line.rstrip()
+        words = line.split()
+        command = self.aliases.get(words[0].lower())
+        if command is not None:
+            return command, words[1:]
+
+        match = None
+        node = self.prefixes
+        for i, c in enumerate(line):
+            node = node.get(c)
+            if node is None:
+                break
+
+            if self.COMMAND in node:
+                match = node[self.COMMAND], line[i + 1 :]
+
+        return match
+
+
+class RoomEventQueue:
+    """Hands room events to a fixed pool of workers
+
+    Events of the same room are handled one at a time in the order they
+    arrived, different rooms are handled in parallel. At most `max_pending`
+    events are queued, `put` waits for a free slot after that.
+    """
+
+    def __init__(self, handler, workers, max_pending):
+        self.handler = handler
+        self.workers = workers
+        self.slots = asyncio.Semaphore(max_pending)
+        # room_id -> deque of (room, event), a room is in here while it has
+        # events that are queued or being handled
+        self.pending = {}
+        # room ids that have events queued and no worker on them
+        self.ready = asyncio.Queue()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.tasks = []
+        # workers in the middle of handling an event
+        self.busy = set()
+        self.stopping = False
+
+    def start(self):
+        self.stopping = False
+        for i in range(self.workers):
+            self.tasks.append(asyncio.create_task(self.work()))
+
+    async def stop(self, timeout=None):
+        """Let the workers finish the events they are handling, queued events
+        are dropped. Workers still busy after `timeout` seconds are cancelled."""
+        self.stopping = True
+        for task in self.tasks:
+            if task not in self.busy:
+                task.cancel()
+
+        if self.tasks:
+            unused_done, pending = await asyncio.wait(self.tasks, timeout=timeout)
+            for task in pending:
+                print("cancelling a room worker that didn't finish in time")
+                task.cancel()
+
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def put(self, room, event):
+        await self.slots.acquire()
+        self.idle.clear()
+        queue = self.pending.get(room.room_id)
+        if queue is None:
+            self.pending[room.room_id] = deque([(room, event)])
+            self.ready.put_nowait(room.room_id)
+        else:
+            queue.append((room, event))
+
+    async def join(self):
+        """Wait until every queued event has been handled"""
+        await self.idle.wait()
+
+    async def work(self):
+        task = asyncio.current_task()
+        while not self.stopping:
+            room_id = await self.ready.get()
+            queue = self.pending[room_id]
+            room, event = queue[0]
+            self.busy.add(task)
+            try:
+                await self.handler(room, event)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.busy.discard(task)
+                queue.popleft()
+                self.slots.release()
+
+            if queue:
+                # go to the back of the line so busy rooms don't starve others
+                self.ready.put_nowait(room_id)
+            else:
+                del self.pending[room_id]
+                if not self.pending:
+                    self.idle.set()
+
+
 class MatrixBot:
-    def __init__(self, config):
+    def __init__(self, config, started=None):
+        """`started` is the time.monotonic() at which the process started, if
+        known, so the startup metrics include the time spent on imports"""
+        init_start = time.monotonic()
+        self.started = init_start if started is None else started
         self.config = config
-        self.modules = []
         if self.config["main"].get("debug", "").lower() == "true":
             self.debug = True
         else:
             self.debug = False
 
-        for key, value in modules.__dict__.items():
-            if inspect.isclass(value) and issubclass(value, MatrixBotModule):
-                print("loading {}...".format(value))
-                m = value.create(config)
-                if m:
-                    self.modules.append(m)
+        self.metrics = MetricsRegistry()
+        self.metrics_exporter = MetricsExporter.create(self.config, self.metrics)
+        self.command_duration = self.metrics.histogram(
+            "matrix_bot_command_duration_seconds",
+            "Time spent handling a command",
+            ["module", "command"],
+        )
+        self.commands_total = self.metrics.counter(
+            "matrix_bot_commands_total",
+            "Number of handled commands by outcome",
+            ["module", "command", "outcome"],
+        )
+        self.matrix_request_duration = self.metrics.histogram(
+            "matrix_bot_matrix_request_duration_seconds",
+            "Duration of requests to the homeserver",
+            ["account", "request"],
+        )
+        self.account_restarts = self.metrics.counter(
+            "matrix_bot_account_restarts_total",
+            "Number of times an account's sync failed and was restarted",
+            ["account"],
+        )
+        self.startup_duration = self.metrics.histogram(
+            "matrix_bot_startup_seconds",
+            "Time spent in each phase of starting the bot",
+            ["phase"],
+            buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+        )
 
-    async def send_room_text(self, room, content):
-        await self.client.room_send(
-            room_id=room.room_id,
-            message_type="m.room.message",
-            content={"body": content, "msgtype": "m.text"},
+        self.cpu_pool = CpuPool.create(self.config["main"], self.metrics)
+        self.http = HttpClient.create(self.config["main"], self.metrics, self.cpu_pool)
+        self.media_cache = MediaCache.create(self.config["main"])
+        self.uploads_in_flight = SingleFlight(
+            self.metrics.counter(
+                "matrix_bot_coalesced_requests_total",
+                "Number of requests that waited for an identical one in flight",
+                ["kind"],
+            ).labels(kind="upload")
+        )
+        self.search_cache = TTLCache.create(self.config["main"], "search_cache")
+        self.accounts = [
+            Account(self, name, account_config)
+            for name, account_config in get_account_configs(self.config)
+        ]
+        self.user_ids = {
+            account.user_id for account in self.accounts if account.user_id
+        }
+        self.max_event_age = float(self.config["main"].get("max_event_age", "5")) * 1000
+        # ids of the latest events that were handled, while accounts start or
+        # restart more than one of them can pick up an event of a shared room
+        self.handled_events = deque(maxlen=1000)
+        self.event_queue = RoomEventQueue(
+            handler=self.handle_room_message,
+            workers=int(self.config["main"].get("workers", "8")),
+            max_pending=int(self.config["main"].get("queue_size", "1000")),
         )
+        self.shutdown_timeout = float(self.config["main"].get("shutdown_timeout", "5"))
+
+        self.use_modules(modules.create_modules(self.config))
+
+        if started is not None:
+            self.startup_duration.labels(phase="import").observe(init_start - started)
+
+        self.startup_duration.labels(phase="init").observe(
+            time.monotonic() - init_start
+        )
+
+    def use_modules(self, modules):
+        self.modules = modules
+        self.router = CommandRouter(self.modules)
+        self.unmatched_message_modules = [
+            m for m in self.modules if m.wants_unmatched_messages()
+        ]
+
+    def get_account(self, room_id=None):
+        """Return the account that serves the room
+
+        That's the first healthy account in the config that joined it, the
+        first healthy account if no room is given and the first account if
+        there's none.
+        """
+        if len(self.accounts) == 1:
+            return self.accounts[0]
+
+        for account in self.accounts:
+            if account.healthy and (room_id is None or account.has_joined(room_id)):
+                return account
+
+        return self.accounts[0]
+
+    async def room_send(self, room, content):
+        account = self.get_account(room.room_id)
+
+        async def request():
+            with self.matrix_request_duration.labels(
+                account=account.name, request="room_send"
+            ).time():
+                return await account.client.room_send(
+                    room_id=room.room_id, message_type="m.room.message", content=content
+                )
+
+        response = await account.send_queue.send(room.room_id, request)
+        if isinstance(response, ErrorResponse):
+            print("sending to {} failed: {}".format(room.room_id, response))
 
-    async def send_room_html(self, room, content):
-        await self.client.room_send(
-            room_id=room.room_id,
-            message_type="m.room.message",
+        return response
+
+    async def send_room_text(self, room, content):
+        await self.room_send(room, content={"body": content, "msgtype": "m.text"})
+
+    async def send_room_html(self, room, content, body=None):
+        """Send `content` as html, `body` defaults to the html without tags"""
+        if body is None:
+            body = re.sub("<[^<]+?>", "", content)
+
+        await self.room_send(
+            room,
             content={
-                "body": re.sub("<[^<]+?>", "", content),
+                "body": body,
                 "msgtype": "m.text",
                 "format": "org.matrix.custom.html",
                 "formatted_body": content,
@@ -54,9 +322,8 @@ class MatrixBot:
         )
 
     async def send_room_content(self, room, msgtype, url, name, extra):
-        await self.client.room_send(
-            room_id=room.room_id,
-            message_type="m.room.message",
+        await self.room_send(
+            room,
             content={
                 "body": name or "no-title",
                 "msgtype": msgtype,
@@ -75,50 +342,220 @@ class MatrixBot:
             room=room, msgtype="m.file", url=url, name=name, extra=extra
         )
 
-    async def on_room_message(self, room, event):
-        if event.sender == self.client.user:
+    async def upload_data(self, data, mimetype="application/octet-stream", room=None):
+        """Upload `data` to the homeserver and return its content URI
+
+        The upload is made by the account serving `room`, if given.
+        """
+        account = self.get_account(room and room.room_id)
+
+        async def request():
+            with self.matrix_request_duration.labels(
+                account=account.name, request="upload"
+            ).time():
+                upload_response, unused_keys = await account.client.upload(
+                    lambda got_429, got_timeouts: io.BytesIO(data),
+                    content_type=mimetype,
+                    filesize=len(data),
+                )
+
+            return upload_response
+
+        upload_response = await account.send_queue.call(request)
+        if not isinstance(upload_response, UploadResponse):
+            raise MediaError(str(upload_response))
+
+        return upload_response.content_uri
+
+    async def upload_remote_media(self, url, mimetype=None, room=None):
+        """Make the media at `url` available on the homeserver
+
+        Returns (content_uri, mimetype, size). Media that was uploaded from
+        the same URL before isn't downloaded or uploaded again. The download
+        is streamed into the upload, size and type come from the response
+        headers, `mimetype` is used if the server doesn't send a Content-Type.
+        The upload is made by the account serving `room`, if given. Concurrent
+        calls for the same URL share one download and upload.
+        """
+        cached = self.media_cache.get_by_url(url)
+        if cached:
+            return cached
+
+        return await self.uploads_in_flight.run(
+            url, self.upload_remote_media_uncached, url, mimetype, room
+        )
+
+    async def upload_remote_media_uncached(self, url, mimetype, room):
+        account = self.get_account(room and room.room_id)
+
+        async with self.http.stream(url) as response:
+            mimetype = response.headers.get("Content-Type") or mimetype
+            # the body of chunked or compressed responses has no known size
+            # until it's read, aiohttp decompresses while reading
+            if response.content_length is None or response.headers.get(
+                "Content-Encoding", "identity"
+            ) not in ("", "identity"):
+                body = BufferedBody(await response.read())
+                filesize = body.size
+            else:
+                body = StreamedBody(self.http, url, response)
+                filesize = response.content_length
+
+            async def request():
+                with self.matrix_request_duration.labels(
+                    account=account.name, request="upload"
+                ).time():
+                    upload_response, unused_keys = await account.client.upload(
+                        body,
+                        content_type=mimetype or "application/octet-stream",
+                        filesize=filesize,
+                    )
+
+                return upload_response
+
+            upload_response = await account.send_queue.call(request)
+
+        if not isinstance(upload_response, UploadResponse):
+            raise MediaError(str(upload_response))
+
+        sha256 = body.sha256.hexdigest()
+        cached = self.media_cache.get_by_hash(sha256)
+        if cached:
+            # same content as an earlier upload, keep using that one
+            self.media_cache.add_url(url, sha256)
+            return cached
+
+        content_uri = upload_response.content_uri
+        self.media_cache.add(url, sha256, content_uri, mimetype, body.size)
+        return content_uri, mimetype, body.size
+
+    async def send_remote_image(self, room, url, name, extra=None, mimetype=None):
+        """Send the image at `url` to the room, see upload_remote_media
+
+        `extra` is merged into the image info, the mimetype and size of the
+        uploaded file are filled in automatically.
+        """
+        content_uri, mimetype, size = await self.upload_remote_media(
+            url, mimetype, room
+        )
+        info = dict(mimetype=mimetype, size=size)
+        info.update(extra or {})
+        await self.send_room_image(room, url=content_uri, name=name, extra=info)
+
+    async def on_room_message(self, account, room, event):
+        if event.sender in self.user_ids:
             return
 
-        age = datetime.now().timestamp() * 1000 - event.server_timestamp
-        if age > 5000:
+        if self.get_account(room.room_id) is not account:
+            # another account is in the room as well and answers instead
             return
 
-        for module in self.modules:
-            try:
-                await module.handle_room_message(self, room, event)
-            except Exception:
-                if self.debug:
-                    msg = E.PRE(traceback.format_exc())
-                    html_data = lxml.html.tostring(msg).decode("utf-8")
-                    await self.send_room_html(room=room, content=html_data)
-                else:
-                    await self.send_room_text(room=room, content="There was an error.")
+        age = time.time() * 1000 - event.server_timestamp
+        if age > self.max_event_age:
+            return
+
+        if event.event_id in self.handled_events:
+            return
+
+        self.handled_events.append(event.event_id)
+        # hand the event off so the sync loop isn't held up by slow handlers
+        await self.event_queue.put(room, event)
+
+    async def handle_room_message(self, room, event):
+        content = event.source["content"]
+        if content.get("msgtype") != "m.text":
+            return
+
+        match = self.router.match(content["body"])
+        if match is not None:
+            command, args = match
+            await self.run_handler(
+                room,
+                command.invoke(bot=self, args=args, room=room, user=None, event=event),
+                module=type(command.module).__name__,
+                command=command.aliases[0],
+            )
+            return
 
-    async def on_invite(self, room, event):
-        self.client.join(room.room_id)
+        for module in self.unmatched_message_modules:
+            await self.run_handler(
+                room,
+                module.handle_unmatched_message(bot=self, room=room, event=event),
+                module=type(module).__name__,
+                command="unmatched",
+            )
+
+    async def run_handler(self, room, handler, module, command):
+        labels = dict(module=module, command=command)
+        start = time.perf_counter()
+        try:
+            await handler
+        except ValidationError as e:
+            self.commands_total.labels(outcome="validation_error", **labels).inc()
+            await self.send_room_text(room, str(e))
+        except Exception:
+            self.commands_total.labels(outcome="error", **labels).inc()
+            if self.debug:
+                import lxml.html
+                from lxml.html import builder as E
+
+                msg = E.PRE(traceback.format_exc())
+                html_data = lxml.html.tostring(msg).decode("utf-8")
+                await self.send_room_html(room=room, content=html_data)
+            else:
+                await self.send_room_text(room=room, content="There was an error.")
+        else:
+            self.commands_total.labels(outcome="ok", **labels).inc()
+        finally:
+            self.command_duration.labels(**labels).observe(time.perf_counter() - start)
 
     async def run(self):
-        client_config = ClientConfig(store_sync_tokens=True)
-        self.client = AsyncClient(
-            homeserver=self.config["main"]["base_url"],
-            user=self.config["main"]["user_id"],
-            device_id=self.config["main"]["device_id"],
-            store_path=self.config["main"]["store_path"],
-            config=client_config,
+        phase_start = time.monotonic()
+        for module in self.modules:
+            await module.start(self)
+
+        if self.metrics_exporter is not None:
+            await self.metrics_exporter.start()
+
+        self.startup_duration.labels(phase="start_modules").observe(
+            time.monotonic() - phase_start
         )
-        self.client.add_event_callback(self.on_invite, InviteEvent)
-        self.client.add_event_callback(self.on_room_message, RoomMessageText)
 
-        print("Logging in...")
-        await self.client.login(
-            self.config["main"]["password"],
-            device_name=self.config["main"]["device_name"],
+        # make sure sessions get saved when the container is stopped
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, asyncio.current_task().cancel
         )
 
-        if not self.client.logged_in:
-            print("Error logging in.")
-            return
+        self.event_queue.start()
+        try:
+            # accounts retry failed logins and syncs themselves, this is only
+            # for bugs, which shouldn't take the other accounts down
+            results = await asyncio.gather(
+                *(account.run() for account in self.accounts),
+                return_exceptions=True,
+            )
+            for account, result in zip(self.accounts, results):
+                if isinstance(result, Exception):
+                    print("{}: stopped: {!r}".format(account.name, result))
+        finally:
+            await self.shutdown()
+
+    async def shutdown(self):
+        # modules save their state on shutdown, handlers that are still
+        # running would change it underneath them
+        await self.event_queue.stop(timeout=self.shutdown_timeout)
+        if self.metrics_exporter is not None:
+            await self.metrics_exporter.stop()
+
+        for module in self.modules:
+            try:
+                await module.shutdown()
+            except Exception:
+                traceback.print_exc()
 
-        print(f"Logged in as user {self.client.user_id}")
+        for account in self.accounts:
+            await account.close()
 
-        await self.client.sync_forever(timeout=30000, full_state=True)
+        await self.http.close()
+        self.cpu_pool.close()
+        self.media_cache.close()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+class CpuPool:
+    """Runs CPU heavy functions in worker processes
+
+    Keeps the event loop responsive and uses more than one core. Functions
+    and their arguments are pickled, so they have to be defined at module
+    level. Sending work to another process costs more than small inputs
+    take to handle, those with a `size` below `min_size` are run right away
+    on the event loop, as is everything if there are no workers.
+    """
+
+    def __init__(self, workers=0, min_size=65536, metrics=None):
+        self.workers = workers
+        self.min_size = min_size
+        self.executor = None
+        self.task_duration = None
+        if metrics is not None:
+            self.task_duration = metrics.histogram(
+                "matrix_bot_cpu_task_seconds",
+                "Time until CPU heavy work was done, including waiting for a worker",
+                ["task", "offloaded"],
+            )
+
+    @staticmethod
+    def create(config, metrics=None):
+        return CpuPool(
+            workers=int(config.get("cpu_workers", "0")),
+            min_size=int(config.get("cpu_offload_min_size", "65536")),
+            metrics=metrics,
+        )
+
+    def get_executor(self):
+        if self.executor is None:
+            # fork isn't safe with the threads the event loop may have started
+            self.executor = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+
+        return self.executor
+
+    async def run(self, func, *args, size=None):
+        """Return func(*args), computed in a worker process if `size`, e.g.
+        the length of the input, is at least min_size or not given"""
+        offload = self.workers > 0 and (size is None or size >= self.min_size)
+        start = time.perf_counter()
+        try:
+            if not offload:
+                return func(*args)
+
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.get_executor(), func, *args)
+        finally:
+            if self.task_duration is not None:
+                self.task_duration.labels(
+                    task=func.__name__, offloaded=str(offload).lower()
+                ).observe(time.perf_counter() - start)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+import json
+import time
+from contextlib import asynccontextmanager
+
+import aiohttp
+from yarl import URL
+
+from matrix_bot.singleflight import SingleFlight
+
+
+class HttpClient:
+    """HTTP client shared by all modules
+
+    Wraps a single aiohttp session, so connections to the same host are kept
+    alive and reused. The total number of connections and the number of
+    connections per host are capped, every request has a timeout. Streams
+    only time out while connecting or when no data arrives for that long, as
+    the caller decides how fast their body is read. If a metrics registry is
+    passed, the duration of every request is recorded per host and status. If
+    a CpuPool is passed, large JSON responses are decoded in it. Concurrent
+    get_json or get_bytes calls for the same URL and parameters are made only
+    once and share the result.
+    """
+
+    def __init__(
+        self,
+        timeout=10,
+        max_connections=100,
+        max_connections_per_host=10,
+        metrics=None,
+        cpu_pool=None,
+    ):
+        self.cpu_pool = cpu_pool
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.stream_timeout = aiohttp.ClientTimeout(
+            sock_connect=timeout, sock_read=timeout
+        )
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self._session = None
+        self.request_duration = None
+        coalesced = None
+        if metrics is not None:
+            self.request_duration = metrics.histogram(
+                "matrix_bot_http_request_duration_seconds",
+                "Duration of upstream HTTP requests, including reading the body",
+                ["host", "status"],
+            )
+            coalesced = metrics.counter(
+                "matrix_bot_coalesced_requests_total",
+                "Number of requests that waited for an identical one in flight",
+                ["kind"],
+            ).labels(kind="http")
+
+        self.in_flight = SingleFlight(coalesced)
+
+    @staticmethod
+    def create(config, metrics=None, cpu_pool=None):
+        return HttpClient(
+            timeout=float(config.get("http_timeout", "10")),
+            max_connections=int(config.get("http_max_connections", "100")),
+            max_connections_per_host=int(
+                config.get("http_max_connections_per_host", "10")
+            ),
+            metrics=metrics,
+            cpu_pool=cpu_pool,
+        )
+
+    @property
+    def session(self):
+        # the session has to be created inside the running event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections, limit_per_host=self.max_connections_per_host
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=self.timeout
+            )
+
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @asynccontextmanager
+    async def request(self, url, params=None, timeout=None):
+        start = time.perf_counter()
+        status = "error"
+        try:
+            async with self.session.get(
+                url, params=params, timeout=timeout or self.timeout
+            ) as response:
+                status = response.status
+                response.raise_for_status()
+                yield response
+        finally:
+            if self.request_duration is not None:
+                self.request_duration.labels(host=URL(url).host, status=status).observe(
+                    time.perf_counter() - start
+                )
+
+    @staticmethod
+    def get_key(kind, url, params):
+        return kind, url, tuple(sorted((params or {}).items()))
+
+    async def get_json(self, url, params=None):
+        return await self.in_flight.run(
+            self.get_key("json", url, params), self.fetch_json, url, params
+        )
+
+    async def fetch_json(self, url, params):
+        async with self.request(url, params=params) as response:
+            data = await response.read()
+
+        if not data.strip():
+            return None
+
+        if self.cpu_pool is None:
+            return json.loads(data)
+
+        return await self.cpu_pool.run(json.loads, data, size=len(data))
+
+    @asynccontextmanager
+    async def stream(self, url, params=None):
+        """Open a request whose body is read by the caller
+
+        Yields the response as soon as the headers are in.
+        """
+        async with self.request(
+            url, params=params, timeout=self.stream_timeout
+        ) as response:
+            yield response
+
+    async def get_bytes(self, url, params=None):
+        """Return the body and the headers of the response"""
+        return await self.in_flight.run(
+            self.get_key("bytes", url, params), self.fetch_bytes, url, params
+        )
+
+    async def fetch_bytes(self, url, params):
+        async with self.request(url, params=params) as response:
+            return await response.read(), response.headers
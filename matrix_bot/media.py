@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+import hashlib
+import os
+import sqlite3
+
+CHUNK_SIZE = 64 * 1024
+
+
+class MediaError(Exception):
+    pass
+
+
+class StreamedBody:
+    """Upload data provider that passes a download through in chunks
+
+    The body is hashed and counted on the way, so only a few chunks are in
+    memory at any time. The first upload attempt reads from the already open
+    `response`, retries after rate limits or timeouts start a new download.
+    """
+
+    def __init__(self, http, url, response):
+        self.http = http
+        self.url = url
+        self.response = response
+        self.sha256 = None
+        self.size = 0
+
+    def __call__(self, got_429, got_timeouts):
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        response, self.response = self.response, None
+        if response is None or got_429 or got_timeouts:
+            return self.download()
+
+        return self.read(response)
+
+    async def read(self, response):
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            self.sha256.update(chunk)
+            self.size += len(chunk)
+            yield chunk
+
+    async def download(self):
+        async with self.http.stream(self.url) as response:
+            async for chunk in self.read(response):
+                yield chunk
+
+
+class BufferedBody:
+    """Upload data provider for a download that was read into memory
+
+    Used when the size isn't known before the download is done, uploads
+    need a Content-Length.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.sha256 = hashlib.sha256(data)
+        self.size = len(data)
+
+    def __call__(self, got_429, got_timeouts):
+        return self.read()
+
+    async def read(self):
+        yield self.data
+
+
+class MediaCache:
+    """Remembers which mxc:// URI remote media was uploaded to
+
+    Entries are looked up by the URL the media was downloaded from and by the
+    SHA-256 of its content, so the same file behind different URLs ends up
+    using a single mxc:// URI.
+    """
+
+    def __init__(self, path):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self.db = sqlite3.connect(path)
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS media (
+                sha256 TEXT PRIMARY KEY,
+                content_uri TEXT NOT NULL,
+                mimetype TEXT,
+                size INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS source_urls (
+                url TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL REFERENCES media(sha256)
+            );
+            """
+        )
+
+    @staticmethod
+    def create(config):
+        path = config.get("media_cache")
+        if not path:
+            path = os.path.join(config.get("store_path", "."), "media.db")
+
+        return MediaCache(path)
+
+    def get_by_url(self, url):
+        """Return (content_uri, mimetype, size) or None"""
+        return self.db.execute(
+            "SELECT content_uri, mimetype, size FROM media"
+            " JOIN source_urls USING (sha256) WHERE url = ?",
+            (url,),
+        ).fetchone()
+
+    def get_by_hash(self, sha256):
+        """Return (content_uri, mimetype, size) or None"""
+        return self.db.execute(
+            "SELECT content_uri, mimetype, size FROM media WHERE sha256 = ?",
+            (sha256,),
+        ).fetchone()
+
+    def add_url(self, url, sha256):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO source_urls (url, sha256) VALUES (?, ?)",
+                (url, sha256),
+            )
+
+    def add(self, url, sha256, content_uri, mimetype, size):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO media (sha256, content_uri, mimetype, size)"
+                " VALUES (?, ?, ?, ?)",
+                (sha256, content_uri, mimetype, size),
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO source_urls (url, sha256) VALUES (?, ?)",
+                (url, sha256),
+            )
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+import asyncio
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join('{}="{}"'.format(k, escape(v)) for k, v in items) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # tuple of label values -> child metric
+        self.children = {}
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self.children.get(key)
+        if child is None:
+            child = self.children[key] = self.create_child()
+
+        return child
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} {}".format(self.name, self.TYPE),
+        ]
+        for key, child in sorted(self.children.items()):
+            labels = list(zip(self.labelnames, key))
+            lines.extend(child.render(self.name, labels))
+
+        return lines
+
+
+class CounterValue:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self, name, labels):
+        return ["{}{} {}".format(name, format_labels(labels), format_value(self.value))]
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def create_child(self):
+        return CounterValue()
+
+
+class HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for le, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(
+                "{}_bucket{} {}".format(
+                    name, format_labels(labels, [("le", format_value(le))]), cumulative
+                )
+            )
+
+        lines.append(
+            "{}_bucket{} {}".format(
+                name, format_labels(labels, [("le", "+Inf")]), self.count
+            )
+        )
+        lines.append("{}_sum{} {}".format(name, format_labels(labels), self.sum))
+        lines.append("{}_count{} {}".format(name, format_labels(labels), self.count))
+        return lines
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def create_child(self):
+        return HistogramValue(self.buckets)
+
+
+class MetricsRegistry:
+    """Counters and latency histograms, rendered in Prometheus text format
+
+    `counter` and `histogram` return the existing metric if one with that
+    name was registered before, so modules can simply ask for them where they
+    need them.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, cls, name, *args, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, *args, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError("metric '{}' is a {}".format(name, metric.TYPE))
+
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram, name, help, labelnames, buckets=buckets)
+
+    def render(self):
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+
+        return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    """Makes the metrics available to Prometheus
+
+    Serves them on http://host:port/metrics and/or writes them to `file`
+    every `interval` seconds, depending on what is configured in the
+    [metrics] section.
+    """
+
+    def __init__(self, registry, host=None, port=None, file=None, interval=15):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.file = file
+        self.interval = interval
+        self.runner = None
+        self.task = None
+
+    @staticmethod
+    def create(config, registry):
+        if "metrics" not in config:
+            return None
+
+        section = config["metrics"]
+        port = section.get("port")
+        return MetricsExporter(
+            registry,
+            host=section.get("host", "127.0.0.1"),
+            port=int(port) if port else None,
+            file=section.get("file"),
+            interval=float(section.get("interval", "15")),
+        )
+
+    async def handle_metrics(self, request):
+        from aiohttp import web
+
+        return web.Response(
+            text=self.registry.render(),
+            content_type="text/plain",
+            headers={"X-Prometheus-Format": "0.0.4"},
+        )
+
+    async def start(self):
+        if self.port is not None:
+            # aiohttp.web takes a while to import, most setups don't need it
+            from aiohttp import web
+
+            app = web.Application()
+            app.router.add_get("/metrics", self.handle_metrics)
+            self.runner = web.AppRunner(app)
+            await self.runner.setup()
+            await web.TCPSite(self.runner, self.host, self.port).start()
+            print(
+                "serving metrics on http://{}:{}/metrics".format(self.host, self.port)
+            )
+
+        if self.file:
+            self.task = asyncio.create_task(self.write_periodically())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+            self.write_file()
+
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def write_file(self):
+        temp_file = self.file + ".tmp"
+        with open(temp_file, "w") as f:
+            f.write(self.registry.render())
+
+        os.replace(temp_file, self.file)
+
+    async def write_periodically(self):
+        while True:
+            self.write_file()
+            await asyncio.sleep(self.interval)
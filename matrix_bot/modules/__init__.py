@@ -1,5 +1,60 @@
-from .giphy import GiphyModule
-from .tenor import TenorModule
-from .xkcd import XkcdModule
+import importlib
 
-# from .zgame import ZGameModule
+# config section -> module:class implementing it, a module is only imported
+# if its section is in the config
+MODULES = {
+    "giphy": "matrix_bot.modules.giphy:GiphyModule",
+    "tenor": "matrix_bot.modules.tenor:TenorModule",
+    "xkcd": "matrix_bot.modules.xkcd:XkcdModule",
+    "zgame": "matrix_bot.modules.zgame:ZGameModule",
+}
+
+# other packages can provide modules for further sections through entry
+# points in this group, named after the section
+ENTRY_POINT_GROUP = "matrix_bot.modules"
+
+# sections that configure the bot itself
+CORE_SECTIONS = {"main", "metrics"}
+
+
+def get_entry_points():
+    from importlib.metadata import entry_points
+
+    return {ep.name: ep for ep in entry_points(group=ENTRY_POINT_GROUP)}
+
+
+def load_class(name):
+    module_name, class_name = name.split(":")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def create_modules(config):
+    """Import and create the modules for the sections in `config`"""
+    entry_points = None
+    loaded_modules = []
+    for section in config.sections():
+        if section.split(":")[0] in CORE_SECTIONS or "/" in section:
+            # "/" is used for sections belonging to a module, e.g. zgame/anchor,
+            # main:<name> for further accounts
+            continue
+
+        if section in MODULES:
+            cls = load_class(MODULES[section])
+        else:
+            if entry_points is None:
+                # finding entry points means looking at every installed
+                # package, only do it if it's needed
+                entry_points = get_entry_points()
+
+            if section not in entry_points:
+                print("no module for section [{}]".format(section))
+                continue
+
+            cls = entry_points[section].load()
+
+        print("loading {}...".format(cls))
+        m = cls.create(config)
+        if m:
+            loaded_modules.append(m)
+
+    return loaded_modules
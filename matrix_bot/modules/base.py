@@ -1,8 +1,5 @@
 import re
 
-import lxml.html
-from lxml.html import builder as E
-
 
 class ValidationError(Exception):
     pass
@@ -15,6 +12,8 @@ class Command:
         self.prefix = kwargs.get("prefix", False)
         self.help = kwargs.get("help")
         self.callback = kwargs["callback"]
+        # the MatrixBotModule the command belongs to, if any
+        self.module = kwargs.get("module")
         assert callable(self.callback)
 
         args = list(args)
@@ -39,34 +38,7 @@ class Command:
 
         return self.help.format(**arg_names)
 
-    async def run(self, bot, line, room, user, event):
-        stripped_line = line.strip()
-        if self.prefix:
-            for alias in self.aliases:
-                if stripped_line.startswith(alias):
-                    # cut off the prefix
-                    stripped_line = stripped_line[len(alias) :]
-                    break
-            else:
-                # not an invocation of this command
-                return False
-
-            self.arguments[0].validator(stripped_line)
-            await self.callback(
-                bot=bot,
-                event=event,
-                room=room,
-                user=user,
-                **{self.arguments[0].get_variable_name(): stripped_line}
-            )
-            return
-
-        words = stripped_line.split()
-        first_word = words.pop(0).lower()
-        if first_word not in self.aliases:
-            # not an invocation of this command
-            return False
-
+    def parse_arguments(self, words):
         kwargs = {}
         for i, arg in enumerate(self.arguments):
             if len(words) <= i:
@@ -88,7 +60,43 @@ class Command:
 
             kwargs[arg.get_variable_name()] = value
 
+        return kwargs
+
+    async def invoke(self, bot, args, room, user, event):
+        """Run the callback with arguments that were already split off
+
+        `args` is the rest of the line after the prefix for prefix commands
+        and the list of words after the alias otherwise.
+        """
+        if self.prefix:
+            self.arguments[0].validator(args)
+            kwargs = {self.arguments[0].get_variable_name(): args}
+        else:
+            kwargs = self.parse_arguments(args)
+
         await self.callback(bot=bot, event=event, room=room, user=user, **kwargs)
+
+    async def run(self, bot, line, room, user, event):
+        stripped_line = line.strip()
+        if self.prefix:
+            for alias in self.aliases:
+                if stripped_line.startswith(alias):
+                    # cut off the prefix
+                    args = stripped_line[len(alias) :]
+                    break
+            else:
+                # not an invocation of this command
+                return False
+
+        else:
+            words = stripped_line.split()
+            if not words or words[0].lower() not in self.aliases:
+                # not an invocation of this command
+                return False
+
+            args = words[1:]
+
+        await self.invoke(bot=bot, args=args, room=room, user=user, event=event)
         return True
 
 
@@ -113,6 +121,22 @@ def arg(name, validator, optional=False, multi_word=False):
     return CommandArgument(name, validator, optional, multi_word)
 
 
+def render_help(rows):
+    """Return the html table of (aliases, arguments, details) rows"""
+    import lxml.html
+    from lxml.html import builder as E
+
+    table = E.TABLE(
+        E.TR(E.TH("command"), E.TH("arguments"), E.TH("details")),
+    )
+    html = E.DIV(E.P("Command list:"), table)
+
+    for aliases, arguments, details in rows:
+        table.append(E.TR(E.TD(aliases), E.TD(arguments), E.TD(details)))
+
+    return lxml.html.tostring(html, pretty_print=True).decode("utf-8")
+
+
 class MatrixBotModule:
     @staticmethod
     def create(cls, config):
@@ -127,9 +151,18 @@ class MatrixBotModule:
     def register_commands(self):
         pass
 
+    async def start(self, bot):
+        pass
+
+    async def shutdown(self):
+        pass
+
     async def handle_room_message(self, bot, room, event):
-        room_id = room.room_id
-        sender_id = event.sender
+        """Run the first of this module's commands that matches the message
+
+        The bot itself dispatches through the CommandRouter, which covers all
+        modules at once, this is for using a module on its own.
+        """
         content = event.source["content"]
 
         if content["msgtype"] != "m.text":
@@ -148,24 +181,35 @@ class MatrixBotModule:
                 await bot.send_room_text(room, str(e))
                 return True
 
-    def add_command(self, *args, **kwargs):
-        self.commands.append(Command(*args, **kwargs))
+        return await self.handle_unmatched_message(bot=bot, room=room, event=event)
 
-    async def show_help(self, bot, room, user, event):
-        table = E.TABLE(
-            E.TR(E.TH("command"), E.TH("arguments"), E.TH("details")),
+    async def handle_unmatched_message(self, bot, room, event):
+        """Called for text messages that didn't match any command
+
+        Only modules overriding this get to see those messages.
+        """
+        pass
+
+    def wants_unmatched_messages(self):
+        return (
+            type(self).handle_unmatched_message
+            is not MatrixBotModule.handle_unmatched_message
         )
-        html = E.DIV(E.P("Command list:"), table)
 
-        for command in self.commands:
-            table.append(
-                E.TR(
-                    E.TD(", ".join(command.aliases)),
-                    E.TD("\xa0".join(arg.get_help_name() for arg in command.arguments)),
-                    E.TD(command.get_help()),
-                )
-            )
+    def add_command(self, *args, **kwargs):
+        self.commands.append(Command(*args, module=self, **kwargs))
 
-        html_data = lxml.html.tostring(html, pretty_print=True).decode("utf-8")
+    async def show_help(self, bot, room, user, event):
+        rows = [
+            (
+                ", ".join(command.aliases),
+                "\xa0".join(arg.get_help_name() for arg in command.arguments),
+                command.get_help(),
+            )
+            for command in self.commands
+        ]
+        html_data = await bot.cpu_pool.run(
+            render_help, rows, size=sum(len(s) for row in rows for s in row)
+        )
         print(html_data)
         await bot.send_room_html(room, html_data)
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+import asyncio
+import os
+import re
+import tempfile
+import time
+from asyncio.subprocess import PIPE
+
+# dfrotz is done with a turn once it prints the command prompt or asks one of
+# its follow-up questions (filename for save/restore, overwrite, more/any key)
+PROMPT_PATTERNS = [
+    r"(?:^|\n)>\s*$",
+    r"Please enter a filename \[[^\]\n]*\]: $",
+    r"Overwrite existing file\? $",
+    r"\[(?:MORE|Hit any key[^\]\n]*|Press any key[^\]\n]*)\]\s*$",
+]
+PROMPT_RE = re.compile("|".join(PROMPT_PATTERNS))
+COMMAND_PROMPT_RE = re.compile(PROMPT_PATTERNS[0])
+# games ask their own yes/no questions ("Are you sure you want to quit? "),
+# those look like any output that was cut off after a question mark, so they
+# only count as a prompt if nothing follows for QUESTION_WAIT seconds
+QUESTION_RE = re.compile(r"\?[ \t]*$")
+QUESTION_WAIT = 0.2
+
+
+class FrotzError(Exception):
+    pass
+
+
+def get_default_dfrotz_path():
+    return os.path.abspath(os.path.join(__file__, "../../../bin/dfrotz"))
+
+
+def get_default_scratch_dir():
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+
+    return tempfile.gettempdir()
+
+
+def get_games(config):
+    """Return the [zgame/<id>] sections of `config` by game id"""
+    games = {}
+    for section in config.sections():
+        if not section.startswith("zgame/"):
+            continue
+
+        game_id = section[len("zgame/") :]
+        data = config[section]
+        data["id"] = game_id
+        games[game_id] = data
+
+    return games
+
+
+class FrotzSession:
+    """A running dfrotz interpreter bound to a single room"""
+
+    def __init__(self, executable, game, room_id, read_timeout=5.0, round_trips=None):
+        self.executable = executable
+        self.game = game
+        self.game_id = game["id"]
+        self.room_id = room_id
+        self.read_timeout = read_timeout
+        # optional histogram for the time from sending data to the next prompt
+        self.round_trips = round_trips
+        self.process = None
+        self.last_used = time.monotonic()
+
+    async def start(self):
+        command = [self.executable, "-w", "100000", "-h", "100000", self.game["file"]]
+        print("running:", " ".join(command))
+        self.process = await asyncio.create_subprocess_exec(
+            *command, stdin=PIPE, stdout=PIPE, stderr=PIPE
+        )
+
+    def is_alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def read(self, prompt_re=PROMPT_RE):
+        """Read output until the interpreter waits for input
+
+        Stops at the first match of `prompt_re`, at EOF or after `read_timeout`
+        seconds, whichever comes first, and returns whatever was read so far.
+        With PROMPT_RE it also stops at a question the game asks.
+        """
+        data = b""
+        question = False
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.read_timeout
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                print("timed out waiting for a prompt from {}".format(self.game_id))
+                break
+
+            try:
+                chunk = await asyncio.wait_for(
+                    self.process.stdout.read(65536),
+                    min(remaining, QUESTION_WAIT) if question else remaining,
+                )
+            except asyncio.TimeoutError:
+                if question:
+                    # nothing followed the question, the game waits for an answer
+                    break
+
+                print("timed out waiting for a prompt from {}".format(self.game_id))
+                break
+
+            if not chunk:
+                # the interpreter exited, most likely it didn't like the game file
+                stderr = (await self.process.stderr.read()).decode("utf-8", "replace")
+                await self.quit()
+                if stderr:
+                    raise FrotzError(stderr)
+
+                break
+
+            data += chunk
+            # prompts are short, only look at the tail of the output
+            tail = data[-200:].decode("utf-8", "replace")
+            if prompt_re.search(tail):
+                break
+
+            question = prompt_re is PROMPT_RE and QUESTION_RE.search(tail) is not None
+
+        data = data.decode("utf-8", "replace")
+        print("---")
+        print(data)
+        print("---")
+        return data
+
+    async def send(self, data, prompt_re=PROMPT_RE):
+        print("sending: '{}'".format(data))
+        self.last_used = time.monotonic()
+        start = time.perf_counter()
+        self.process.stdin.write(data.encode("utf-8"))
+        await self.process.stdin.drain()
+        output = await self.read(prompt_re)
+        if self.round_trips is not None:
+            self.round_trips.labels(game=self.game_id).observe(
+                time.perf_counter() - start
+            )
+
+        return output
+
+    async def send_prefix(self):
+        prefix = (
+            self.game.get("command_prefix", "")
+            .replace(r"\\", "\\")
+            .replace(r"\n", "\n")
+        )
+        if not prefix:
+            return await self.read(COMMAND_PROMPT_RE)
+
+        # the prefix answers whatever the game asks before the first turn, so
+        # wait for the real command prompt rather than the first question
+        return await self.send(prefix, COMMAND_PROMPT_RE)
+
+    async def save(self, path):
+        # send a hash and a new line in case we're stuck in a follow-up prompt
+        # to clarify, which would cause the save to fail
+        # a hash also won't advance the time or move counter
+        await self.send("#\n")
+        await self.send("save\n")
+        return await self.send(path + "\n")
+
+    async def restore(self, path):
+        await self.send("restore\n")
+        return await self.send(path + "\n")
+
+    async def quit(self):
+        if self.process is None:
+            return
+
+        process, self.process = self.process, None
+        if process.returncode is None:
+            process.kill()
+
+        await process.wait()
+
+
+class SessionManager:
+    """Keeps one live interpreter per active room
+
+    Sessions are evicted when they have been idle for longer than
+    `idle_timeout` seconds or when more than `max_sessions` are running, the
+    least recently used one goes first. `on_evict` is awaited with the session
+    before its process is killed, so its state can be saved.
+
+    Whoever uses a room's session holds `lock(room_id)` for as long as it does,
+    sessions that are in use or still starting are never evicted.
+    """
+
+    def __init__(self, max_sessions, idle_timeout, on_evict):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.on_evict = on_evict
+        self.sessions = {}
+        self.locks = {}
+
+    def __contains__(self, room_id):
+        return room_id in self.sessions
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def lock(self, room_id):
+        lock = self.locks.get(room_id)
+        if lock is None:
+            lock = self.locks[room_id] = asyncio.Lock()
+
+        return lock
+
+    async def get(self, room_id):
+        await self.evict()
+        session = self.sessions.get(room_id)
+        if session is None:
+            return None
+
+        if not session.is_alive():
+            # the interpreter died on us, there's nothing left to save
+            del self.sessions[room_id]
+            return None
+
+        session.last_used = time.monotonic()
+        return session
+
+    async def add(self, session):
+        """The caller holds the room's lock until the session has started"""
+        await self._close(session.room_id)
+        await self.evict(limit=self.max_sessions - 1)
+        self.sessions[session.room_id] = session
+
+    async def close(self, room_id, save=True):
+        async with self.lock(room_id):
+            await self._close(room_id, save=save)
+
+    async def _close(self, room_id, save=True):
+        session = self.sessions.get(room_id)
+        if session is None:
+            return
+
+        try:
+            if save and session.is_alive():
+                await self.on_evict(session)
+        finally:
+            # forgotten only once it's saved, the room's next turn waits for
+            # the lock and then starts over from the saved state
+            self.sessions.pop(room_id, None)
+            await session.quit()
+
+    async def _evict(self, room_id):
+        lock = self.lock(room_id)
+        if lock.locked():
+            # in the middle of a turn or still starting
+            return False
+
+        async with lock:
+            await self._close(room_id)
+
+        return True
+
+    async def evict(self, limit=None):
+        """Close idle sessions, then the least recently used ones until at most
+        `limit` are left. Sessions in use are skipped, if they push the count
+        over the limit they go once they are done."""
+        if limit is None:
+            limit = self.max_sessions
+
+        now = time.monotonic()
+        for room_id, session in list(self.sessions.items()):
+            if now - session.last_used > self.idle_timeout:
+                if await self._evict(room_id):
+                    print("evicted idle session in {}".format(room_id))
+
+        while len(self.sessions) > limit:
+            unused = [
+                s for s in self.sessions.values() if not self.lock(s.room_id).locked()
+            ]
+            if not unused:
+                break
+
+            lru = min(unused, key=lambda s: s.last_used)
+            if not await self._evict(lru.room_id):
+                break
+
+    async def close_all(self):
+        for room_id in list(self.sessions):
+            await self.close(room_id)
+
+    async def detach_all(self):
+        """Save and forget all sessions without stopping their interpreters,
+        for interpreters that outlive the bot"""
+        for room_id in list(self.sessions):
+            async with self.lock(room_id):
+                session = self.sessions.get(room_id)
+                if session is None:
+                    continue
+
+                try:
+                    if session.is_alive():
+                        await self.on_evict(session)
+                finally:
+                    self.sessions.pop(room_id, None)
@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+"""Runs the dfrotz interpreters in a separate process, possibly on another host
+
+Messages are JSON objects, each prefixed with its length as a 4 byte big
+endian number. The client sends requests with an "id", an "op" and the
+"room_id" the op is about, the server answers each with a reply carrying the
+same "id", "ok" and "alive", the latter says whether the room's interpreter
+is running. Failed requests get an "error" instead of the op's results.
+
+    attach      game_id           is the room still playing game_id?
+    start       game_id           start a new interpreter for the room
+    send_prefix                   -> output
+    send        data, prompt      -> output, prompt is "command" or "any"
+    save                          -> output, data (base64 or null)
+    restore     data (base64)     -> output
+    quit                          stop the room's interpreter
+
+Requests for different rooms run concurrently, the ones for the same room
+in order. Interpreters keep running when clients disconnect, so a restarted
+bot can attach to them again.
+"""
+import asyncio
+import base64
+import itertools
+import json
+import os
+import shutil
+import signal
+import stat
+import struct
+import tempfile
+import time
+
+from matrix_bot.modules.frotz import (
+    COMMAND_PROMPT_RE,
+    PROMPT_RE,
+    FrotzError,
+    FrotzSession,
+    get_default_dfrotz_path,
+    get_default_scratch_dir,
+    get_games,
+)
+
+HEADER = struct.Struct(">I")
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+
+def write_message(writer, message):
+    data = json.dumps(message).encode("utf-8")
+    writer.write(HEADER.pack(len(data)) + data)
+
+
+async def read_message(reader):
+    """Return the next message or None if the connection was closed"""
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise FrotzError("connection closed in a message header")
+
+        return None
+
+    (size,) = HEADER.unpack(header)
+    if size > MAX_MESSAGE_SIZE:
+        raise FrotzError("message of {} bytes is too large".format(size))
+
+    try:
+        data = await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        raise FrotzError("connection closed in a message")
+
+    return json.loads(data)
+
+
+def parse_address(address):
+    """Return (path, None) for "unix:<path>", (host, port) for "<host>:<port>" """
+    if address.startswith("unix:"):
+        return address[len("unix:") :], None
+
+    host, separator, port = address.rpartition(":")
+    if not separator or not port.isdigit():
+        raise ValueError("invalid zgame daemon address '{}'".format(address))
+
+    return host.strip("[]"), int(port)
+
+
+async def start_server(client_connected, address):
+    path, port = parse_address(address)
+    if port is not None:
+        return await asyncio.start_server(client_connected, path, port)
+
+    # left behind by a daemon that was killed
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.remove(path)
+
+    return await asyncio.start_unix_server(client_connected, path)
+
+
+async def open_connection(address):
+    path, port = parse_address(address)
+    if port is not None:
+        return await asyncio.open_connection(path, port)
+
+    return await asyncio.open_unix_connection(path)
+
+
+class FrotzServer:
+    """Owns the interpreters and serves the requests of FrotzClients
+
+    Interpreters nobody sent a request to in `idle_timeout` seconds are
+    stopped, the bot keeps snapshots to restore them.
+    """
+
+    OPS = ("attach", "start", "send_prefix", "send", "save", "restore", "quit")
+
+    def __init__(
+        self,
+        executable,
+        games,
+        read_timeout=5.0,
+        idle_timeout=86400.0,
+        scratch_dir=None,
+    ):
+        self.executable = executable
+        self.games = games
+        self.read_timeout = read_timeout
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        # room_id -> lock, requests for a room must not interleave
+        self.locks = {}
+        self.scratch_dir = tempfile.mkdtemp(
+            prefix="matrix-bot-zgame-daemon-",
+            dir=scratch_dir or get_default_scratch_dir(),
+        )
+        self.scratch_names = itertools.count()
+
+    @staticmethod
+    def create(config):
+        return FrotzServer(
+            config["zgame"].get("dfrotz_bin", get_default_dfrotz_path()),
+            get_games(config),
+            read_timeout=float(config["zgame"].get("read_timeout", "5")),
+            idle_timeout=float(config["zgame"].get("daemon_idle_timeout", "86400")),
+            scratch_dir=config["zgame"].get("scratch_dir"),
+        )
+
+    def is_alive(self, room_id):
+        session = self.sessions.get(room_id)
+        return session is not None and session.is_alive()
+
+    def get_session(self, room_id):
+        if not self.is_alive(room_id):
+            raise FrotzError("no interpreter running for {}".format(room_id))
+
+        session = self.sessions[room_id]
+        session.last_used = time.monotonic()
+        return session
+
+    def get_scratch_filename(self):
+        # the file must not exist yet, dfrotz asks before overwriting
+        return os.path.join(self.scratch_dir, str(next(self.scratch_names)))
+
+    async def quit_session(self, room_id):
+        session = self.sessions.pop(room_id, None)
+        if session is not None:
+            await session.quit()
+
+    async def op_attach(self, room_id, request):
+        # "alive" in the reply tells whether the game is still running
+        if self.is_alive(room_id):
+            self.sessions[room_id].last_used = time.monotonic()
+
+        return {}
+
+    async def op_start(self, room_id, request):
+        game = self.games.get(request["game_id"])
+        if game is None:
+            raise FrotzError("unknown game '{}'".format(request["game_id"]))
+
+        await self.quit_session(room_id)
+        session = FrotzSession(
+            self.executable, game, room_id, read_timeout=self.read_timeout
+        )
+        self.sessions[room_id] = session
+        await session.start()
+        return {}
+
+    async def op_send_prefix(self, room_id, request):
+        return {"output": await self.get_session(room_id).send_prefix()}
+
+    async def op_send(self, room_id, request):
+        if request.get("prompt") == "command":
+            prompt_re = COMMAND_PROMPT_RE
+        else:
+            prompt_re = PROMPT_RE
+
+        output = await self.get_session(room_id).send(request["data"], prompt_re)
+        return {"output": output}
+
+    async def op_save(self, room_id, request):
+        session = self.get_session(room_id)
+        temp_file = self.get_scratch_filename()
+        try:
+            output = await session.save(temp_file)
+            data = None
+            if os.path.exists(temp_file) and os.stat(temp_file).st_size != 0:
+                with open(temp_file, "rb") as f:
+                    data = base64.b64encode(f.read()).decode("ascii")
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+        return {"output": output, "data": data}
+
+    async def op_restore(self, room_id, request):
+        session = self.get_session(room_id)
+        temp_file = self.get_scratch_filename()
+        with open(temp_file, "wb") as f:
+            f.write(base64.b64decode(request["data"]))
+
+        try:
+            return {"output": await session.restore(temp_file)}
+        finally:
+            os.remove(temp_file)
+
+    async def op_quit(self, room_id, request):
+        await self.quit_session(room_id)
+        return {}
+
+    async def handle_request(self, request):
+        reply = {"id": request.get("id")}
+        room_id = request.get("room_id")
+        try:
+            if request.get("op") not in self.OPS:
+                raise FrotzError("unknown op '{}'".format(request.get("op")))
+
+            handler = getattr(self, "op_" + request["op"])
+            async with self.locks.setdefault(room_id, asyncio.Lock()):
+                reply.update(await handler(room_id, request))
+
+            reply["ok"] = True
+        except Exception as e:
+            reply["ok"] = False
+            reply["error"] = str(e) or repr(e)
+
+        # attach is the only op asking about a specific game
+        reply["alive"] = self.is_alive(room_id) and (
+            request.get("op") != "attach"
+            or self.sessions[room_id].game_id == request.get("game_id")
+        )
+        return reply
+
+    async def reply(self, request, writer, write_lock):
+        reply = await self.handle_request(request)
+        async with write_lock:
+            try:
+                write_message(writer, reply)
+                await writer.drain()
+            except ConnectionError:
+                # the interpreter stays, the client can attach again
+                pass
+
+    async def handle_client(self, reader, writer):
+        write_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                request = await read_message(reader)
+                if request is None:
+                    break
+
+                task = asyncio.create_task(self.reply(request, writer, write_lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (ConnectionError, FrotzError, ValueError) as e:
+            print("zgame client connection failed: {}".format(e))
+        finally:
+            # requests that are already running get to finish, cancelling one
+            # in the middle of a read would leave output for the next request
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+            writer.close()
+
+    async def evict_idle(self):
+        now = time.monotonic()
+        for room_id, session in list(self.sessions.items()):
+            lock = self.locks.get(room_id)
+            if lock is not None and lock.locked():
+                continue
+
+            if now - session.last_used > self.idle_timeout:
+                print("stopping idle interpreter in {}".format(room_id))
+                await self.quit_session(room_id)
+
+    async def keep_evicting(self):
+        while True:
+            await asyncio.sleep(min(60, self.idle_timeout))
+            await self.evict_idle()
+
+    async def close(self):
+        for room_id in list(self.sessions):
+            await self.quit_session(room_id)
+
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
+
+    async def serve(self, address):
+        server = await start_server(self.handle_client, address)
+        print("zgame daemon listening on {}".format(address))
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, asyncio.current_task().cancel
+        )
+        evict_task = asyncio.create_task(self.keep_evicting())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            evict_task.cancel()
+            await self.close()
+
+
+class FrotzClient:
+    """Connection to a FrotzServer, shared by all RemoteFrotzSessions
+
+    Connects on the first request and again after the connection was lost.
+    Replies are matched to requests by id, so rooms don't wait for each other.
+    """
+
+    def __init__(self, address, timeout=30.0):
+        self.address = address
+        self.timeout = timeout
+        self.writer = None
+        self.read_task = None
+        # request id -> future of the reply
+        self.pending = {}
+        self.ids = itertools.count()
+        self.connect_lock = asyncio.Lock()
+
+    @staticmethod
+    def create(config):
+        """Return a client if `config`, the [zgame] section, has a daemon"""
+        address = config.get("daemon_address")
+        if not address:
+            return None
+
+        return FrotzClient(address, timeout=float(config.get("daemon_timeout", "30")))
+
+    async def connect(self):
+        async with self.connect_lock:
+            if self.writer is not None:
+                return
+
+            try:
+                reader, self.writer = await open_connection(self.address)
+            except OSError as e:
+                raise FrotzError(
+                    "can't connect to the zgame daemon at {}: {}".format(
+                        self.address, e
+                    )
+                )
+
+            self.read_task = asyncio.create_task(self.read_replies(reader))
+
+    async def read_replies(self, reader):
+        try:
+            while True:
+                reply = await read_message(reader)
+                if reply is None:
+                    break
+
+                future = self.pending.pop(reply.get("id"), None)
+                if future is not None and not future.done():
+                    future.set_result(reply)
+        except (ConnectionError, FrotzError, ValueError) as e:
+            print("zgame daemon connection failed: {}".format(e))
+        finally:
+            self.writer.close()
+            self.writer = None
+            pending, self.pending = self.pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(
+                        FrotzError("lost the connection to the zgame daemon")
+                    )
+
+    async def request(self, op, **params):
+        """Send a request and return the reply, whether it failed or not
+
+        Raises FrotzError if the daemon can't be reached or doesn't answer.
+        """
+        await self.connect()
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            write_message(self.writer, dict(params, id=request_id, op=op))
+            await self.writer.drain()
+            return await asyncio.wait_for(future, self.timeout)
+        except ConnectionError as e:
+            raise FrotzError("lost the connection to the zgame daemon: {}".format(e))
+        except asyncio.TimeoutError:
+            raise FrotzError("the zgame daemon didn't answer in time")
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+        if self.read_task is not None:
+            await self.read_task
+
+
+class RemoteFrotzSession:
+    """An interpreter run by a FrotzServer, used like a FrotzSession"""
+
+    def __init__(self, client, game, room_id, round_trips=None):
+        self.client = client
+        self.game = game
+        self.game_id = game["id"]
+        self.room_id = room_id
+        self.round_trips = round_trips
+        # as of the last reply
+        self.alive = False
+        self.last_used = time.monotonic()
+
+    async def request(self, op, **params):
+        try:
+            reply = await self.client.request(op, room_id=self.room_id, **params)
+        except FrotzError:
+            # the interpreter might still be running, but the session manager
+            # should drop this session, attaching again finds out
+            self.alive = False
+            raise
+
+        self.alive = reply["alive"]
+        if not reply["ok"]:
+            raise FrotzError(reply["error"])
+
+        return reply
+
+    def is_alive(self):
+        return self.alive
+
+    async def attach(self):
+        """Return whether the daemon still runs this game for the room"""
+        await self.request("attach", game_id=self.game_id)
+        return self.alive
+
+    async def start(self):
+        print("starting {} on the zgame daemon".format(self.game_id))
+        await self.request("start", game_id=self.game_id)
+
+    async def send(self, data, prompt_re=PROMPT_RE):
+        self.last_used = time.monotonic()
+        start = time.perf_counter()
+        prompt = "command" if prompt_re is COMMAND_PROMPT_RE else "any"
+        reply = await self.request("send", data=data, prompt=prompt)
+        if self.round_trips is not None:
+            self.round_trips.labels(game=self.game_id).observe(
+                time.perf_counter() - start
+            )
+
+        return reply["output"]
+
+    async def send_prefix(self):
+        return (await self.request("send_prefix"))["output"]
+
+    async def save(self, path):
+        reply = await self.request("save")
+        if reply["data"] is not None:
+            with open(path, "wb") as f:
+                f.write(base64.b64decode(reply["data"]))
+
+        return reply["output"]
+
+    async def restore(self, path):
+        with open(path, "rb") as f:
+            data = base64.b64encode(f.read()).decode("ascii")
+
+        return (await self.request("restore", data=data))["output"]
+
+    async def quit(self):
+        if not self.alive:
+            return
+
+        try:
+            await self.request("quit")
+        except FrotzError as e:
+            print("stopping the interpreter for {} failed: {}".format(self.room_id, e))
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+import asyncio
+import random
+
+
+class SearchError(Exception):
+    pass
+
+
+class ResultPool:
+    """Search results of one query, fetched page by page as they're needed
+
+    `fetch_page(cursor)` returns the results of a page and the cursor of the
+    next page, None after the last one; the first page is fetched with the
+    cursor None. Every room gets results it hasn't seen yet, in random
+    order. When fewer than `low_water` are left for a room, the next page is
+    fetched in the background, until there are `max_results`. Rooms that
+    have seen all results start over.
+    """
+
+    def __init__(self, fetch_page, key, low_water=10, max_results=500):
+        self.fetch_page = fetch_page
+        # returns the id of a result, results with the same id are dropped
+        self.key = key
+        self.low_water = low_water
+        self.max_results = max_results
+        self.results = []
+        self.ids = set()
+        self.cursor = None
+        self.exhausted = False
+        # room_id -> indices of the results the room got
+        self.seen = {}
+        self.refill_task = None
+        self.pages = 0
+
+    @staticmethod
+    def create(config, fetch_page, key):
+        return ResultPool(
+            fetch_page,
+            key,
+            low_water=int(config.get("pool_low_water", "10")),
+            max_results=int(config.get("pool_max_results", "500")),
+        )
+
+    async def fill(self):
+        results, cursor = await self.fetch_page(self.cursor)
+        self.pages += 1
+        for result in results:
+            key = self.key(result)
+            if key not in self.ids:
+                self.ids.add(key)
+                self.results.append(result)
+
+        self.cursor = cursor
+        if cursor is None or not results or len(self.results) >= self.max_results:
+            self.exhausted = True
+
+    def refill(self):
+        """Start fetching the next page unless that's already happening"""
+        if self.refill_task is None or self.refill_task.done():
+            self.refill_task = asyncio.create_task(self.fill())
+            self.refill_task.add_done_callback(self.refill_done)
+
+        return self.refill_task
+
+    @staticmethod
+    def refill_done(task):
+        if not task.cancelled() and task.exception() is not None:
+            print("fetching more results failed: {!r}".format(task.exception()))
+
+    def get_unseen(self, room_id):
+        seen = self.seen.get(room_id, ())
+        return [i for i in range(len(self.results)) if i not in seen]
+
+    async def get(self, room_id):
+        """Return a result `room_id` hasn't seen yet, None if there are none
+
+        Only waits for the provider if there's nothing left to hand out.
+        Errors fetching the first page are raised.
+        """
+        if not self.results and not self.exhausted:
+            await self.refill()
+
+        unseen = self.get_unseen(room_id)
+        if not unseen and not self.exhausted:
+            try:
+                await self.refill()
+            except Exception:
+                # already printed, repeat results instead
+                pass
+
+            unseen = self.get_unseen(room_id)
+
+        if not unseen:
+            if not self.results:
+                return None
+
+            self.seen.pop(room_id, None)
+            unseen = list(range(len(self.results)))
+
+        index = random.choice(unseen)
+        self.seen.setdefault(room_id, set()).add(index)
+        if len(unseen) - 1 < self.low_water and not self.exhausted:
+            self.refill()
+
+        return self.results[index]
@@ -1,12 +1,14 @@
 #!/usr/bin/env python3
-import json
+import functools
 import logging
-import random
-from io import BytesIO
 
-import requests
+from aiohttp import ClientResponseError
 
+from matrix_bot.cache import normalize_query
+from matrix_bot.media import MediaError
 from matrix_bot.modules.base import MatrixBotModule, arg
+from matrix_bot.modules.gifpool import ResultPool, SearchError
+from matrix_bot.modules.renditions import RenditionSelector, get_giphy_renditions
 
 
 class GiphyModule(MatrixBotModule):
@@ -17,6 +19,11 @@ class GiphyModule(MatrixBotModule):
 
         return None
 
+    def __init__(self, config):
+        super(GiphyModule, self).__init__(config)
+        self.page_size = int(self.config["giphy"].get("page_size", "50"))
+        self.renditions = RenditionSelector.create(self.config["giphy"])
+
     def register_commands(self):
         self.add_command(
             "!giphy",
@@ -28,43 +35,77 @@ class GiphyModule(MatrixBotModule):
     def validate_search(self, value):
         pass
 
+    async def fetch_page(self, bot, search, offset):
+        try:
+            results = await bot.http.get_json(
+                "https://api.giphy.com/v1/gifs/search",
+                params=dict(
+                    api_key=self.config["giphy"]["api_key"],
+                    limit=self.page_size,
+                    offset=offset or 0,
+                    lang="en",
+                    fmt="json",
+                    q=search,
+                ),
+            )
+        except ClientResponseError as e:
+            # a bad key or rate limits
+            raise SearchError("giphy answered {} {}".format(e.status, e.message))
+
+        if not results:
+            raise SearchError("giphy sent an empty response")
+
+        data = results.get("data") or []
+        pagination = results.get("pagination") or {}
+        next_offset = pagination.get("offset", offset or 0) + len(data)
+        # giphy doesn't go beyond offset 4999
+        if next_offset >= min(pagination.get("total_count", 0), 5000):
+            next_offset = None
+
+        return data, next_offset
+
     async def search_giphy(self, bot, event, search, room, user):
-        search = search.replace(" ", "+")
-        response = requests.get(
-            "https://api.giphy.com/v1/gifs/search",
-            params=dict(
-                api_key=self.config["giphy"]["api_key"],
-                limit=100,
-                lang="en",
-                fmt="json",
-                q=search,
-            ),
-        )
-        results = json.loads(response.content.decode("utf-8"))
-        match = random.choice(results["data"])
+        cache_key = ("giphy", normalize_query(search))
+        pool = bot.search_cache.get(cache_key)
+        if pool is None:
+            pool = ResultPool.create(
+                self.config["giphy"],
+                functools.partial(
+                    self.fetch_page, bot, normalize_query(search).replace(" ", "+")
+                ),
+                key=lambda result: result["id"],
+            )
+            bot.search_cache.set(cache_key, pool)
+
+        try:
+            match = await pool.get(room.room_id)
+        except SearchError as e:
+            print(e)
+            await bot.send_room_text(room, "It appears something went wrong.")
+            return
+        finally:
+            if not pool.results:
+                bot.search_cache.pop(cache_key)
+
+        if match is None:
+            await bot.send_room_text(room, "That doesn't exist.")
+            return
+
         title = match["title"]
-        url = match["images"]["original"]["url"]
-        height = match["images"]["original"]["height"]
-        width = match["images"]["original"]["width"]
-        size = match["images"]["original"]["size"]
-        image_response = requests.get(url)
-        mimetype = image_response.headers.get("Content-Type")
-
-        def data_provider(_x, _y):
-            return BytesIO(image_response.content)
-
-        response, error = await bot.client.upload(
-            data_provider, content_type="image/gif"
-        )
-        if error:
-            print(error)
+        rendition = self.renditions.select(get_giphy_renditions(match["images"]))
+        if rendition is None:
             await bot.send_room_text(room, "Something went wrong.")
             return
 
-        image_url = response.content_uri
-        await bot.send_room_image(
-            room,
-            url=image_url,
-            name=title,
-            extra=dict(mimetype=mimetype, h=height, w=width, size=size),
-        )
+        try:
+            # the size is filled in from the upload
+            await bot.send_remote_image(
+                room,
+                url=rendition.url,
+                name=title,
+                extra=dict(h=rendition.height, w=rendition.width),
+                mimetype=rendition.mimetype,
+            )
+        except MediaError as e:
+            print(e)
+            await bot.send_room_text(room, "Something went wrong.")
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+from collections import namedtuple
+
+# size is None if the provider didn't say
+Rendition = namedtuple("Rendition", ["url", "mimetype", "width", "height", "size"])
+
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_giphy_renditions(images):
+    """Return the renditions in the `images` of a giphy result"""
+    renditions = []
+    for name, image in images.items():
+        if "still" in name or name.startswith("preview"):
+            # single frames and previews with a few frames
+            continue
+
+        width = to_int(image.get("width"))
+        height = to_int(image.get("height"))
+        for url_key, size_key, mimetype in (
+            ("url", "size", "image/gif"),
+            ("webp", "webp_size", "image/webp"),
+        ):
+            if image.get(url_key) and width and height:
+                renditions.append(
+                    Rendition(
+                        image[url_key],
+                        mimetype,
+                        width,
+                        height,
+                        to_int(image.get(size_key)),
+                    )
+                )
+
+    return renditions
+
+
+def get_tenor_renditions(media):
+    """Return the renditions in an entry of the `media` of a tenor result"""
+    renditions = []
+    for name, item in media.items():
+        if name.endswith("gif"):
+            mimetype = "image/gif"
+        elif name.endswith("webp"):
+            mimetype = "image/webp"
+        else:
+            continue
+
+        dims = item.get("dims") or [None, None]
+        if item.get("url") and dims[0] and dims[1]:
+            renditions.append(
+                Rendition(
+                    item["url"], mimetype, dims[0], dims[1], to_int(item.get("size"))
+                )
+            )
+
+    return renditions
+
+
+class RenditionSelector:
+    """Picks the rendition of a GIF to send
+
+    That's the one with the most pixels of those within both budgets, the
+    smaller one if that's a tie. If none is, the smallest one is used.
+    Renditions of unknown size don't fit the byte budget.
+    """
+
+    def __init__(self, max_size=2000000, max_pixels=307200, mimetypes=("image/gif",)):
+        self.max_size = max_size
+        self.max_pixels = max_pixels
+        self.mimetypes = mimetypes
+
+    @staticmethod
+    def create(config):
+        return RenditionSelector(
+            max_size=int(config.get("max_size", "2000000")),
+            max_pixels=int(config.get("max_pixels", "307200")),
+            mimetypes=tuple(
+                mimetype.strip()
+                for mimetype in config.get("mimetypes", "image/gif").split(",")
+            ),
+        )
+
+    def select(self, renditions):
+        """Return the rendition to send or None if none has an allowed type"""
+        renditions = [r for r in renditions if r.mimetype in self.mimetypes]
+        if not renditions:
+            return None
+
+        fitting = [
+            r
+            for r in renditions
+            if r.size is not None
+            and r.size <= self.max_size
+            and r.width * r.height <= self.max_pixels
+        ]
+        if fitting:
+            return max(fitting, key=lambda r: (r.width * r.height, -r.size))
+
+        return min(
+            renditions,
+            key=lambda r: (
+                r.size is None,
+                r.size or 0,
+                r.width * r.height,
+            ),
+        )
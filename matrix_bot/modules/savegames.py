@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+import hashlib
+import os
+import sqlite3
+import time
+import zlib
+
+
+class SavegameStore:
+    """Stores Quetzal save files by content
+
+    Every distinct save file is kept once, zlib compressed, in
+    blobs/<first two hex digits>/<sha256>. Names point at blobs and blobs are
+    reference counted, so identical saves of a room share one file, and a
+    blob is deleted as soon as no name points at it anymore. A room's current
+    session is kept under the name SESSION.
+    """
+
+    SESSION = ""
+
+    def __init__(self, path, compression_level=6):
+        os.makedirs(path, exist_ok=True)
+        self.blob_dir = os.path.join(path, "blobs")
+        self.compression_level = compression_level
+        self.db = sqlite3.connect(os.path.join(path, "savegames.db"))
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS blobs (
+                sha256 TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                refs INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS savegames (
+                room TEXT NOT NULL,
+                game_id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                sha256 TEXT NOT NULL REFERENCES blobs(sha256),
+                mtime REAL NOT NULL,
+                PRIMARY KEY (room, game_id, name)
+            );
+            """
+        )
+
+    def get_blob_path(self, sha256):
+        return os.path.join(self.blob_dir, sha256[:2], sha256)
+
+    def write_blob(self, sha256, data):
+        path = self.get_blob_path(sha256)
+        if os.path.exists(path):
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_file = path + ".tmp"
+        with open(temp_file, "wb") as f:
+            f.write(zlib.compress(data, self.compression_level))
+
+        os.replace(temp_file, path)
+
+    def get_hash(self, room, game_id, name):
+        row = self.db.execute(
+            "SELECT sha256 FROM savegames WHERE room = ? AND game_id = ? AND name = ?",
+            (room, game_id, name),
+        ).fetchone()
+        return row[0] if row else None
+
+    def exists(self, room, game_id, name):
+        return self.get_hash(room, game_id, name) is not None
+
+    def get(self, room, game_id, name):
+        """Return the save file's content or None"""
+        sha256 = self.get_hash(room, game_id, name)
+        if sha256 is None:
+            return None
+
+        with open(self.get_blob_path(sha256), "rb") as f:
+            return zlib.decompress(f.read())
+
+    def put(self, room, game_id, name, data, mtime=None):
+        sha256 = hashlib.sha256(data).hexdigest()
+        self.write_blob(sha256, data)
+        self.point(room, game_id, name, sha256, len(data), mtime)
+
+    def link(self, room, game_id, name, new_name):
+        """Make `new_name` point at the same save file as `name`
+
+        Returns False if there is no save file called `name`.
+        """
+        row = self.db.execute(
+            "SELECT sha256, size FROM savegames JOIN blobs USING (sha256)"
+            " WHERE room = ? AND game_id = ? AND name = ?",
+            (room, game_id, name),
+        ).fetchone()
+        if row is None:
+            return False
+
+        self.point(room, game_id, new_name, *row)
+        return True
+
+    def point(self, room, game_id, name, sha256, size, mtime=None):
+        old_sha256 = self.get_hash(room, game_id, name)
+        with self.db:
+            self.db.execute(
+                "INSERT OR IGNORE INTO blobs (sha256, size, refs) VALUES (?, ?, 0)",
+                (sha256, size),
+            )
+            if old_sha256 != sha256:
+                self.db.execute(
+                    "UPDATE blobs SET refs = refs + 1 WHERE sha256 = ?", (sha256,)
+                )
+
+            self.db.execute(
+                "INSERT OR REPLACE INTO savegames (room, game_id, name, sha256, mtime)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (room, game_id, name, sha256, mtime or time.time()),
+            )
+
+        if old_sha256 is not None and old_sha256 != sha256:
+            self.release(old_sha256)
+
+    def delete(self, room, game_id, name):
+        sha256 = self.get_hash(room, game_id, name)
+        if sha256 is None:
+            return
+
+        with self.db:
+            self.db.execute(
+                "DELETE FROM savegames WHERE room = ? AND game_id = ? AND name = ?",
+                (room, game_id, name),
+            )
+
+        self.release(sha256)
+
+    def release(self, sha256):
+        with self.db:
+            self.db.execute(
+                "UPDATE blobs SET refs = refs - 1 WHERE sha256 = ?", (sha256,)
+            )
+            unused = self.db.execute(
+                "DELETE FROM blobs WHERE sha256 = ? AND refs <= 0", (sha256,)
+            ).rowcount
+
+        if unused:
+            try:
+                os.remove(self.get_blob_path(sha256))
+            except FileNotFoundError:
+                pass
+
+    def list(self, room, game_id):
+        """Return (name, mtime) of all saves except the session, oldest first"""
+        return self.db.execute(
+            "SELECT name, mtime FROM savegames"
+            " WHERE room = ? AND game_id = ? AND name != ? ORDER BY mtime",
+            (room, game_id, self.SESSION),
+        ).fetchall()
+
+    def import_file(self, path, room, game_id, name):
+        with open(path, "rb") as f:
+            self.put(room, game_id, name, f.read(), mtime=os.path.getmtime(path))
+
+        os.remove(path)
+
+    def migrate(self, session_dir, save_dir):
+        """Move the plain files older versions kept into the store
+
+        Those were session_dir/<room>/<game-id> for sessions and
+        save_dir/<room>/<game-id>/<name> for savegames.
+        """
+        for room, room_dir in self.list_dirs(session_dir):
+            for game_id in os.listdir(room_dir):
+                path = os.path.join(room_dir, game_id)
+                if os.path.isfile(path):
+                    self.import_file(path, room, game_id, self.SESSION)
+
+            self.remove_empty_dir(room_dir)
+
+        for room, room_dir in self.list_dirs(save_dir):
+            if room_dir == self.blob_dir:
+                continue
+
+            for game_id, game_dir in self.list_dirs(room_dir):
+                for name in os.listdir(game_dir):
+                    path = os.path.join(game_dir, name)
+                    if os.path.isfile(path):
+                        self.import_file(path, room, game_id, name)
+
+                self.remove_empty_dir(game_dir)
+
+            self.remove_empty_dir(room_dir)
+
+    @staticmethod
+    def list_dirs(path):
+        if not os.path.isdir(path):
+            return []
+
+        return [
+            (name, os.path.join(path, name))
+            for name in os.listdir(path)
+            if os.path.isdir(os.path.join(path, name))
+        ]
+
+    @staticmethod
+    def remove_empty_dir(path):
+        if not os.listdir(path):
+            os.rmdir(path)
+
+    def close(self):
+        self.db.close()
+
+
+class SessionSnapshots:
+    """Keeps the latest session snapshots in memory in front of a store
+
+    Snapshots are only written to the SavegameStore when flushed, which is
+    meant to happen every now and then and on shutdown, so evicting and
+    restoring interpreters doesn't touch the disk. Flushed snapshots are
+    dropped from memory.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        # (room, game_id) -> snapshot that isn't in the store yet
+        self.dirty = {}
+
+    def __len__(self):
+        return len(self.dirty)
+
+    def put(self, room, game_id, data):
+        self.dirty[(room, game_id)] = data
+
+    def get(self, room, game_id):
+        data = self.dirty.get((room, game_id))
+        if data is None:
+            data = self.store.get(room, game_id, self.store.SESSION)
+
+        return data
+
+    def exists(self, room, game_id):
+        return (room, game_id) in self.dirty or self.store.exists(
+            room, game_id, self.store.SESSION
+        )
+
+    def save_as(self, room, game_id, name):
+        """Store the current snapshot under `name`
+
+        Returns False if there is no snapshot.
+        """
+        data = self.dirty.get((room, game_id))
+        if data is None:
+            return self.store.link(room, game_id, self.store.SESSION, name)
+
+        self.store.put(room, game_id, name, data)
+        return True
+
+    def flush(self):
+        while self.dirty:
+            (room, game_id), data = self.dirty.popitem()
+            self.store.put(room, game_id, self.store.SESSION, data)
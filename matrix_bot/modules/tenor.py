@@ -1,12 +1,14 @@
 #!/usr/bin/env python3
-import json
+import functools
 import logging
-import random
-from io import BytesIO
 
-import requests
+from aiohttp import ClientResponseError
 
+from matrix_bot.cache import normalize_query
+from matrix_bot.media import MediaError
 from matrix_bot.modules.base import MatrixBotModule, arg
+from matrix_bot.modules.gifpool import ResultPool, SearchError
+from matrix_bot.modules.renditions import RenditionSelector, get_tenor_renditions
 
 
 class TenorModule(MatrixBotModule):
@@ -17,6 +19,13 @@ class TenorModule(MatrixBotModule):
 
         return None
 
+    def __init__(self, config):
+        super(TenorModule, self).__init__(config)
+        self.page_size = int(self.config["tenor"].get("page_size", "20"))
+        # all formats by default, so there's a choice of sizes
+        self.media_filter = self.config["tenor"].get("media_filter", "")
+        self.renditions = RenditionSelector.create(self.config["tenor"])
+
     def register_commands(self):
         self.add_command(
             "!tenor",
@@ -31,34 +40,66 @@ class TenorModule(MatrixBotModule):
     def validate_search(self, value):
         pass
 
-    async def search_tenor(self, bot, event, search, room, user):
-        search = search.replace(" ", "+")
-        response = requests.get(
-            "https://api.tenor.com/v1/search",
-            params=dict(
-                api_key=self.config["tenor"]["api_key"],
-                limit=20,
-                media_filter="minimal",
-                q=search,
-            ),
+    async def fetch_page(self, bot, search, pos):
+        params = dict(
+            api_key=self.config["tenor"]["api_key"],
+            limit=self.page_size,
+            q=search,
         )
-        results = json.loads(response.content.decode("utf-8"))
+        if self.media_filter:
+            params["media_filter"] = self.media_filter
+        if pos is not None:
+            params["pos"] = pos
+
+        try:
+            results = await bot.http.get_json(
+                "https://api.tenor.com/v1/search", params=params
+            )
+        except ClientResponseError as e:
+            # a bad key or rate limits
+            raise SearchError("tenor answered {} {}".format(e.status, e.message))
+
+        if not results or "results" not in results:
+            raise SearchError(results)
+
+        # "0" or "" after the last page
+        next_pos = results.get("next")
+        if next_pos in (None, "", "0") or not results["results"]:
+            next_pos = None
+
+        return results["results"], next_pos
+
+    async def search_tenor(self, bot, event, search, room, user):
+        cache_key = ("tenor", normalize_query(search))
+        pool = bot.search_cache.get(cache_key)
+        if pool is None:
+            pool = ResultPool.create(
+                self.config["tenor"],
+                functools.partial(
+                    self.fetch_page, bot, normalize_query(search).replace(" ", "+")
+                ),
+                key=lambda result: result["id"],
+            )
+            bot.search_cache.set(cache_key, pool)
 
-        if "results" not in results:
+        try:
+            match = await pool.get(room.room_id)
+        except SearchError as e:
+            print(e)
             await bot.send_room_text(room, "It appears something went wrong.")
             return
+        finally:
+            if not pool.results:
+                bot.search_cache.pop(cache_key)
 
-        if not results["results"]:
+        if match is None:
             await bot.send_room_text(room, "That doesn't exist.")
             return
 
-        match = random.choice(results["results"])
-        url = match["media"][0]["gif"]["url"]
-        height = match["media"][0]["gif"]["dims"][1]
-        width = match["media"][0]["gif"]["dims"][0]
-        size = match["media"][0]["gif"]["size"]
-        image_response = requests.get(url)
-        mimetype = image_response.headers.get("Content-Type")
+        rendition = self.renditions.select(get_tenor_renditions(match["media"][0]))
+        if rendition is None:
+            await bot.send_room_text(room, "Something went wrong.")
+            return
 
         title = match["title"].strip()
         if not title:
@@ -73,21 +114,15 @@ class TenorModule(MatrixBotModule):
         if not title:
             title = "no-title"
 
-        def data_provider(_x, _y):
-            return BytesIO(image_response.content)
-
-        response, error = await bot.client.upload(
-            data_provider, content_type="image/gif"
-        )
-        if error:
-            print(error)
+        try:
+            # the size is filled in from the upload
+            await bot.send_remote_image(
+                room=room,
+                url=rendition.url,
+                name=title + "." + rendition.mimetype.split("/")[1],
+                extra=dict(h=rendition.height, w=rendition.width),
+                mimetype=rendition.mimetype,
+            )
+        except MediaError as e:
+            print(e)
             await bot.send_room_text(room, "Something went wrong.")
-            return
-
-        image_url = response.content_uri
-        await bot.send_room_image(
-            room=room,
-            url=image_url,
-            name=title + ".gif",
-            extra=dict(mimetype=mimetype, h=height, w=width, size=size),
-        )
@@ -0,0 +1,233 @@
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+from matrix_bot.modules.frotz import FrotzError, FrotzSession, SessionManager
+
+FAKE_DFROTZ = """\
+#!{python}
+import sys, time
+sys.stdout.write("Welcome.\\n\\n>")
+sys.stdout.flush()
+for line in sys.stdin:
+    if line.strip() == "save":
+        sys.stdout.write("Please enter a filename [game.qzl]: ")
+    else:
+        # answer in two parts, slower than a single read would wait for
+        sys.stdout.write("You " + line.strip())
+        sys.stdout.flush()
+        time.sleep(0.2)
+        sys.stdout.write(".\\n\\n>")
+    sys.stdout.flush()
+"""
+
+
+class FakeSession:
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.last_used = time.monotonic()
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+    async def quit(self):
+        self.alive = False
+
+
+@pytest.fixture
+def fake_dfrotz(tmp_path):
+    path = tmp_path / "dfrotz"
+    path.write_text(FAKE_DFROTZ.format(python=sys.executable))
+    os.chmod(path, 0o755)
+    return str(path)
+
+
+@pytest.fixture
+def evicted():
+    return []
+
+
+@pytest.fixture
+def manager(evicted):
+    async def on_evict(session):
+        evicted.append(session)
+
+    return SessionManager(max_sessions=2, idle_timeout=60, on_evict=on_evict)
+
+
+@pytest.mark.asyncio
+async def test_frotz_session_reads_until_prompt(fake_dfrotz):
+    session = FrotzSession(fake_dfrotz, {"id": "fake", "file": "x"}, "!a:x")
+    await session.start()
+
+    assert await session.send_prefix() == "Welcome.\n\n>"
+    assert await session.send("look\n") == "You look.\n\n>"
+    assert await session.send("save\n") == "Please enter a filename [game.qzl]: "
+
+    await session.quit()
+    assert not session.is_alive()
+
+
+QUESTIONS_DFROTZ = """\
+#!{python}
+import sys, time
+sys.stdout.write("Welcome.\\n\\n>")
+sys.stdout.flush()
+for line in sys.stdin:
+    if line.strip() == "quit":
+        sys.stdout.write("Are you sure you want to quit? ")
+    else:
+        # a question in the output, cut off by a pause
+        sys.stdout.write("Who goes there?")
+        sys.stdout.flush()
+        time.sleep(0.1)
+        sys.stdout.write(" Nobody.\\n\\n>")
+    sys.stdout.flush()
+"""
+
+
+@pytest.mark.asyncio
+async def test_frotz_session_waits_for_more_after_question_mark(tmp_path):
+    script = tmp_path / "dfrotz"
+    script.write_text(QUESTIONS_DFROTZ.format(python=sys.executable))
+    os.chmod(script, 0o755)
+    session = FrotzSession(str(script), {"id": "fake", "file": "x"}, "!a:x")
+    await session.start()
+    await session.send_prefix()
+
+    assert await session.send("look\n") == "Who goes there? Nobody.\n\n>"
+
+    start = time.monotonic()
+    assert await session.send("quit\n") == "Are you sure you want to quit? "
+    assert time.monotonic() - start < session.read_timeout
+
+    await session.quit()
+
+
+@pytest.mark.asyncio
+async def test_frotz_session_raises_when_interpreter_fails(tmp_path):
+    script = tmp_path / "dfrotz"
+    script.write_text(
+        "#!{}\nimport sys\nsys.exit('Error opening story file')\n".format(
+            sys.executable
+        )
+    )
+    os.chmod(script, 0o755)
+    session = FrotzSession(str(script), {"id": "fake", "file": "x"}, "!a:x")
+    await session.start()
+
+    with pytest.raises(FrotzError):
+        await session.send_prefix()
+
+
+@pytest.mark.asyncio
+async def test_session_manager_reuses_live_session(manager):
+    session = FakeSession("!a:x")
+    await manager.add(session)
+
+    assert await manager.get("!a:x") is session
+    assert await manager.get("!b:x") is None
+
+
+@pytest.mark.asyncio
+async def test_session_manager_evicts_least_recently_used(manager, evicted):
+    a, b, c = FakeSession("!a:x"), FakeSession("!b:x"), FakeSession("!c:x")
+    await manager.add(a)
+    await manager.add(b)
+    a.last_used = b.last_used + 1
+
+    await manager.add(c)
+
+    assert evicted == [b]
+    assert not b.alive
+    assert "!a:x" in manager and "!c:x" in manager
+
+
+@pytest.mark.asyncio
+async def test_session_manager_evicts_idle_sessions(manager, evicted):
+    session = FakeSession("!a:x")
+    await manager.add(session)
+    session.last_used -= 61
+
+    assert await manager.get("!a:x") is None
+    assert evicted == [session]
+
+
+@pytest.mark.asyncio
+async def test_session_manager_drops_dead_sessions_without_saving(manager, evicted):
+    session = FakeSession("!a:x")
+    await manager.add(session)
+    session.alive = False
+
+    assert await manager.get("!a:x") is None
+    assert evicted == []
+
+
+@pytest.mark.asyncio
+async def test_session_manager_close_all_saves_everything(manager, evicted):
+    a, b = FakeSession("!a:x"), FakeSession("!b:x")
+    await manager.add(a)
+    await manager.add(b)
+
+    await manager.close_all()
+
+    assert evicted == [a, b]
+    assert len(manager) == 0
+
+
+@pytest.mark.asyncio
+async def test_session_manager_detach_all_keeps_interpreters(manager, evicted):
+    a, b = FakeSession("!a:x"), FakeSession("!b:x")
+    await manager.add(a)
+    await manager.add(b)
+
+    await manager.detach_all()
+
+    assert evicted == [a, b]
+    assert a.is_alive() and b.is_alive()
+    assert len(manager) == 0
+
+
+@pytest.mark.asyncio
+async def test_session_manager_two_rooms_share_one_slot():
+    started, evicted = [], []
+
+    async def on_evict(session):
+        assert session.alive
+        await asyncio.sleep(0.01)
+        evicted.append(session)
+
+    manager = SessionManager(max_sessions=1, idle_timeout=60, on_evict=on_evict)
+
+    async def turn(room_id):
+        async with manager.lock(room_id):
+            session = await manager.get(room_id)
+            if session is None:
+                session = FakeSession(room_id)
+                started.append(session)
+                await manager.add(session)
+                # starting the interpreter
+                await asyncio.sleep(0.01)
+
+            await asyncio.sleep(0.01)
+            # neither evicted nor replaced in the middle of the turn
+            assert session.alive
+            assert await manager.get(room_id) is session
+
+    await asyncio.gather(*(turn(room_id) for room_id in ["!a:x", "!b:x"] * 5))
+
+    # every interpreter that was started is either saved and stopped or live
+    live = [s for s in started if s.alive]
+    assert live == list(manager.sessions.values())
+    assert all(not s.alive for s in evicted)
+    assert len(evicted) + len(live) == len(started)
+
+    await turn("!a:x")
+    assert len(manager) == 1
+
+    await manager.close_all()
+    assert not any(s.alive for s in started)
@@ -0,0 +1,238 @@
+import asyncio
+import configparser
+import contextlib
+import os
+import sys
+from unittest.mock import AsyncMock, Mock
+
+import pytest
+
+from matrix_bot.modules.frotz import FrotzError
+from matrix_bot.modules.frotz_daemon import (
+    FrotzClient,
+    FrotzServer,
+    RemoteFrotzSession,
+    parse_address,
+    read_message,
+    start_server,
+    write_message,
+)
+from matrix_bot.modules.zgame import ZGameModule
+
+# remembers the commands it got, save and restore write and read them
+FAKE_DFROTZ = """\
+#!{python}
+import sys
+commands = []
+pending = None
+sys.stdout.write("Welcome.\\n\\n>")
+sys.stdout.flush()
+for line in sys.stdin:
+    line = line.strip()
+    if line in ("save", "restore"):
+        pending = line
+        sys.stdout.write("Please enter a filename [game.qzl]: ")
+    elif pending == "save":
+        with open(line, "w") as f:
+            f.write(",".join(commands))
+        pending = None
+        sys.stdout.write("Ok.\\n\\n>")
+    elif pending == "restore":
+        with open(line) as f:
+            commands = f.read().split(",")
+        pending = None
+        sys.stdout.write("Ok.\\n\\n>")
+    elif line == "#":
+        sys.stdout.write("\\n>")
+    else:
+        commands.append(line)
+        sys.stdout.write("You " + " then ".join(commands) + ".\\n\\n>")
+    sys.stdout.flush()
+"""
+
+GAME = {"id": "fake", "file": "x"}
+
+
+class FakeWriter:
+    def __init__(self):
+        self.data = b""
+
+    def write(self, data):
+        self.data += data
+
+
+@pytest.fixture
+def fake_dfrotz(tmp_path):
+    path = tmp_path / "dfrotz"
+    path.write_text(FAKE_DFROTZ.format(python=sys.executable))
+    os.chmod(path, 0o755)
+    return str(path)
+
+
+@pytest.fixture
+def address(tmp_path):
+    return "unix:{}".format(tmp_path / "zgame.sock")
+
+
+@pytest.fixture
+def daemon(fake_dfrotz, tmp_path):
+    return FrotzServer(fake_dfrotz, {"fake": GAME}, scratch_dir=str(tmp_path))
+
+
+@contextlib.asynccontextmanager
+async def serving(server, address):
+    listener = await start_server(server.handle_client, address)
+    try:
+        yield
+    finally:
+        listener.close()
+        await server.close()
+
+
+def test_parse_address():
+    assert parse_address("unix:/run/zgame.sock") == ("/run/zgame.sock", None)
+    assert parse_address("zgame.local:7000") == ("zgame.local", 7000)
+    assert parse_address("[::1]:7000") == ("::1", 7000)
+    with pytest.raises(ValueError):
+        parse_address("/run/zgame.sock")
+
+
+@pytest.mark.asyncio
+async def test_messages_are_length_prefixed():
+    writer = FakeWriter()
+    write_message(writer, {"op": "send", "data": "look\n"})
+    write_message(writer, {"id": 1})
+
+    reader = asyncio.StreamReader()
+    reader.feed_data(writer.data)
+    reader.feed_eof()
+    assert await read_message(reader) == {"op": "send", "data": "look\n"}
+    assert await read_message(reader) == {"id": 1}
+    assert await read_message(reader) is None
+
+    reader = asyncio.StreamReader()
+    reader.feed_data(writer.data[:-1])
+    reader.feed_eof()
+    await read_message(reader)
+    with pytest.raises(FrotzError):
+        await read_message(reader)
+
+
+@pytest.mark.asyncio
+async def test_remote_session_plays_saves_and_restores(daemon, address, tmp_path):
+    async with serving(daemon, address):
+        client = FrotzClient(address)
+        session = RemoteFrotzSession(client, GAME, "!a:x")
+        await session.start()
+        assert session.is_alive()
+
+        assert await session.send_prefix() == "Welcome.\n\n>"
+        assert await session.send("look\n") == "You look.\n\n>"
+
+        path = str(tmp_path / "save")
+        await session.save(path)
+        with open(path) as f:
+            assert f.read() == "look"
+
+        assert await session.send("jump\n") == "You look then jump.\n\n>"
+        await session.restore(path)
+        assert await session.send("sing\n") == "You look then sing.\n\n>"
+
+        await session.quit()
+        assert not session.is_alive()
+        assert daemon.sessions == {}
+        assert os.listdir(daemon.scratch_dir) == []
+        await client.close()
+
+
+@pytest.mark.asyncio
+async def test_remote_session_survives_reconnecting(daemon, address):
+    async with serving(daemon, address):
+        client = FrotzClient(address)
+        session = RemoteFrotzSession(client, GAME, "!a:x")
+        await session.start()
+        await session.send_prefix()
+        await client.close()
+
+        client = FrotzClient(address)
+        assert not await RemoteFrotzSession(client, GAME, "!b:x").attach()
+        assert not await RemoteFrotzSession(client, {"id": "other"}, "!a:x").attach()
+
+        session = RemoteFrotzSession(client, GAME, "!a:x")
+        assert await session.attach()
+        assert await session.send("look\n") == "You look.\n\n>"
+        await client.close()
+
+
+@pytest.mark.asyncio
+async def test_rooms_dont_wait_for_each_other(daemon, address):
+    async with serving(daemon, address):
+        client = FrotzClient(address)
+        sessions = [RemoteFrotzSession(client, GAME, room) for room in ("!a", "!b")]
+        for session in sessions:
+            await session.start()
+            await session.send_prefix()
+
+        outputs = await asyncio.gather(
+            *(session.send("look\n") for session in sessions for unused in range(3))
+        )
+        assert (
+            outputs
+            == [
+                "You look.\n\n>",
+                "You look then look.\n\n>",
+                "You look then look then look.\n\n>",
+            ]
+            * 2
+        )
+        await client.close()
+
+
+@pytest.mark.asyncio
+async def test_remote_session_errors(daemon, address, tmp_path):
+    async with serving(daemon, address):
+        client = FrotzClient(address)
+        with pytest.raises(FrotzError, match="unknown game"):
+            await RemoteFrotzSession(client, {"id": "other"}, "!a:x").start()
+
+        session = RemoteFrotzSession(client, GAME, "!a:x")
+        with pytest.raises(FrotzError, match="no interpreter"):
+            await session.send("look\n")
+
+        assert not session.is_alive()
+        await client.close()
+
+        client = FrotzClient("unix:{}".format(tmp_path / "nothing.sock"))
+        with pytest.raises(FrotzError, match="can't connect"):
+            await RemoteFrotzSession(client, GAME, "!a:x").start()
+
+
+@pytest.mark.asyncio
+async def test_zgame_games_survive_restarts(daemon, address, tmp_path):
+    async with serving(daemon, address):
+        config = configparser.ConfigParser()
+        config.read_dict(
+            {
+                "zgame": {
+                    "session_dir": str(tmp_path / "sessions"),
+                    "save_dir": str(tmp_path / "saves"),
+                    "scratch_dir": str(tmp_path),
+                    "daemon_address": address,
+                },
+                "zgame/fake": {"file": "x"},
+            }
+        )
+        bot = AsyncMock()
+        room = Mock(room_id="!a:x")
+
+        zgame = ZGameModule.create(config)
+        await zgame.zstart(bot, None, "fake", room, None)
+        await zgame.zcommand(bot, None, "look", room, None)
+        await zgame.shutdown()
+        assert "!a:x" in daemon.sessions
+
+        # picks up where it left off, without restoring
+        zgame = ZGameModule.create(config)
+        await zgame.zcommand(bot, None, "jump", room, None)
+        assert "You look then jump." in bot.send_room_html.call_args.args[2]
+        await zgame.shutdown()
@@ -0,0 +1,190 @@
+import asyncio
+import configparser
+from unittest.mock import AsyncMock, Mock
+
+import pytest
+from aiohttp import ClientResponseError
+
+from matrix_bot.cache import TTLCache
+from matrix_bot.modules.gifpool import ResultPool
+from matrix_bot.modules.giphy import GiphyModule
+from matrix_bot.modules.tenor import TenorModule
+
+
+class FakePages:
+    def __init__(self, pages):
+        # cursor -> (results, next cursor)
+        self.pages = pages
+        self.fetched = []
+
+    async def __call__(self, cursor):
+        self.fetched.append(cursor)
+        return self.pages[cursor]
+
+
+def make_pool(pages, **kwargs):
+    return ResultPool(FakePages(pages), key=lambda result: result, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_result_pool_hands_out_unseen_results_per_room():
+    pool = make_pool({None: ([1, 2, 3], None)}, low_water=0)
+
+    results = [await pool.get("!a") for unused in range(3)]
+    assert sorted(results) == [1, 2, 3]
+    assert await pool.get("!b") in [1, 2, 3]
+
+    # starts over once everything was seen
+    assert await pool.get("!a") in [1, 2, 3]
+    assert len(pool.seen["!a"]) == 1
+    assert pool.fetch_page.fetched == [None]
+
+
+@pytest.mark.asyncio
+async def test_result_pool_refills_in_background():
+    pool = make_pool(
+        {None: ([1, 2, 3], 3), 3: ([3, 4, 5], 6), 6: ([6], None)}, low_water=2
+    )
+
+    results = [await pool.get("!a")]
+    assert pool.fetch_page.fetched == [None]
+
+    # two left, below the low water mark
+    results.append(await pool.get("!a"))
+    await pool.refill_task
+    assert pool.results == [1, 2, 3, 4, 5]
+
+    for unused in range(4):
+        results.append(await pool.get("!a"))
+        await pool.refill_task
+
+    assert sorted(results) == [1, 2, 3, 4, 5, 6]
+    assert pool.fetch_page.fetched == [None, 3, 6]
+    assert pool.exhausted
+
+
+@pytest.mark.asyncio
+async def test_result_pool_max_results():
+    pool = make_pool({None: ([1, 2], 2), 2: ([3, 4], 4)}, max_results=2)
+    await pool.get("!a")
+    assert pool.exhausted
+
+
+@pytest.mark.asyncio
+async def test_result_pool_empty_and_errors():
+    pool = make_pool({None: ([], None)})
+    assert await pool.get("!a") is None
+
+    pool = ResultPool(AsyncMock(side_effect=ValueError("down")), key=id)
+    with pytest.raises(ValueError):
+        await pool.get("!a")
+
+
+@pytest.fixture
+def bot():
+    bot = Mock(search_cache=TTLCache(10, 60))
+    bot.send_remote_image = AsyncMock()
+    bot.send_room_text = AsyncMock()
+    return bot
+
+
+def make_config(section):
+    config = configparser.ConfigParser()
+    config.read_dict({section: {"api_key": "key", "page_size": "2"}})
+    return config
+
+
+@pytest.mark.asyncio
+async def test_giphy_pages_through_results(bot):
+    def make_gif(i):
+        original = {"url": "https://giphy/{}.gif".format(i), "width": 1, "height": 1}
+        return {"id": str(i), "title": str(i), "images": {"original": original}}
+
+    async def get_json(url, params):
+        offset = params["offset"]
+        return {
+            "data": [make_gif(i) for i in range(offset, min(offset + 2, 3))],
+            "pagination": {"offset": offset, "total_count": 3},
+        }
+
+    bot.http.get_json = AsyncMock(side_effect=get_json)
+    giphy = GiphyModule(make_config("giphy"))
+    room = Mock(room_id="!a")
+
+    names = set()
+    for unused in range(3):
+        await giphy.search_giphy(bot, None, "Cat", room, None)
+        names.add(bot.send_remote_image.call_args.kwargs["name"])
+        await asyncio.sleep(0)
+
+    assert names == {"0", "1", "2"}
+    assert [c.kwargs["params"]["offset"] for c in bot.http.get_json.mock_calls] == [
+        0,
+        2,
+    ]
+
+
+@pytest.mark.asyncio
+async def test_tenor_no_results(bot):
+    bot.http.get_json = AsyncMock(return_value={"results": [], "next": "0"})
+    tenor = TenorModule(make_config("tenor"))
+    room = Mock(room_id="!a")
+
+    await tenor.search_tenor(bot, None, "nothing", room, None)
+    bot.send_room_text.assert_called_with(room, "That doesn't exist.")
+    assert len(bot.search_cache) == 0
+
+    bot.http.get_json.return_value = {"error": "bad key"}
+    await tenor.search_tenor(bot, None, "nothing", room, None)
+    bot.send_room_text.assert_called_with(room, "It appears something went wrong.")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "module_class, section, search",
+    [(GiphyModule, "giphy", "search_giphy"), (TenorModule, "tenor", "search_tenor")],
+)
+async def test_search_errors(bot, module_class, section, search):
+    search = getattr(module_class(make_config(section)), search)
+    room = Mock(room_id="!a")
+
+    bot.http.get_json = AsyncMock(
+        side_effect=ClientResponseError(Mock(), (), status=401, message="no")
+    )
+    await search(bot, None, "cat", room, None)
+    bot.send_room_text.assert_called_with(room, "It appears something went wrong.")
+
+    # empty body
+    bot.http.get_json = AsyncMock(return_value=None)
+    await search(bot, None, "cat", room, None)
+    bot.send_room_text.assert_called_with(room, "It appears something went wrong.")
+    assert len(bot.search_cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_tenor_sends_gif(bot):
+    gif = {"url": "https://tenor/1.gif", "dims": [320, 240], "size": 1000}
+    bot.http.get_json = AsyncMock(
+        return_value={
+            "results": [
+                {
+                    "id": "1",
+                    "title": "",
+                    "itemurl": "https://tenor.com/view/cat-typing-123",
+                    "media": [{"gif": gif}],
+                }
+            ],
+            "next": "0",
+        }
+    )
+    tenor = TenorModule(make_config("tenor"))
+    room = Mock(room_id="!a")
+
+    await tenor.search_tenor(bot, None, "cat", room, None)
+    bot.send_remote_image.assert_called_with(
+        room=room,
+        url="https://tenor/1.gif",
+        name="cat-typing.gif",
+        extra=dict(h=240, w=320),
+        mimetype="image/gif",
+    )
@@ -0,0 +1,48 @@
+import configparser
+import sys
+from unittest.mock import Mock, patch
+
+import matrix_bot.modules as modules
+
+
+class FakeModule:
+    @staticmethod
+    def create(config):
+        return FakeModule()
+
+
+def make_config(sections):
+    config = configparser.ConfigParser()
+    config.read_dict({section: {} for section in sections})
+    return config
+
+
+def test_create_modules_only_configured_sections():
+    with patch.dict(
+        modules.MODULES, {"fake": "matrix_bot.modules.test_modules:FakeModule"}
+    ), patch.object(modules, "get_entry_points") as get_entry_points:
+        loaded = modules.create_modules(make_config(["main", "metrics", "fake"]))
+
+    assert [type(m) for m in loaded] == [FakeModule]
+    # all sections are built in, no need to look for entry points
+    get_entry_points.assert_not_called()
+
+
+def test_create_modules_does_not_import_unconfigured_modules():
+    with patch.dict(sys.modules):
+        sys.modules.pop("matrix_bot.modules.giphy", None)
+        assert modules.create_modules(make_config(["main"])) == []
+        assert "matrix_bot.modules.giphy" not in sys.modules
+
+
+def test_create_modules_entry_points():
+    entry_point = Mock(load=Mock(return_value=FakeModule))
+    with patch.object(
+        modules, "get_entry_points", return_value={"plugin": entry_point}
+    ) as get_entry_points:
+        loaded = modules.create_modules(
+            make_config(["main", "plugin", "unknown", "zgame/anchor"])
+        )
+
+    assert [type(m) for m in loaded] == [FakeModule]
+    get_entry_points.assert_called_once_with()
@@ -0,0 +1,115 @@
+from matrix_bot.modules.renditions import (
+    Rendition,
+    RenditionSelector,
+    get_giphy_renditions,
+    get_tenor_renditions,
+)
+
+GIPHY_IMAGES = {
+    "original": {
+        "url": "https://giphy/original.gif",
+        "width": "800",
+        "height": "600",
+        "size": "9000000",
+        "webp": "https://giphy/original.webp",
+        "webp_size": "3000000",
+    },
+    "downsized": {
+        "url": "https://giphy/downsized.gif",
+        "width": "400",
+        "height": "300",
+        "size": "1500000",
+    },
+    "fixed_height": {
+        "url": "https://giphy/fixed_height.gif",
+        "width": "267",
+        "height": "200",
+        "size": "700000",
+    },
+    "original_still": {
+        "url": "https://giphy/still.gif",
+        "width": "800",
+        "height": "600",
+        "size": "90000",
+    },
+    "preview_gif": {
+        "url": "https://giphy/preview.gif",
+        "width": "100",
+        "height": "75",
+        "size": "40000",
+    },
+}
+
+TENOR_MEDIA = {
+    "gif": {"url": "https://tenor/gif.gif", "dims": [498, 280], "size": 2500000},
+    "mediumgif": {
+        "url": "https://tenor/medium.gif",
+        "dims": [498, 280],
+        "size": 900000,
+    },
+    "tinygif": {"url": "https://tenor/tiny.gif", "dims": [220, 124], "size": 150000},
+    "mp4": {"url": "https://tenor/video.mp4", "dims": [498, 280], "size": 300000},
+}
+
+
+def test_giphy_renditions():
+    renditions = get_giphy_renditions(GIPHY_IMAGES)
+    assert (
+        Rendition("https://giphy/original.webp", "image/webp", 800, 600, 3000000)
+        in renditions
+    )
+    assert sorted(r.url for r in renditions if r.mimetype == "image/gif") == [
+        "https://giphy/downsized.gif",
+        "https://giphy/fixed_height.gif",
+        "https://giphy/original.gif",
+    ]
+
+
+def test_tenor_renditions():
+    renditions = get_tenor_renditions(TENOR_MEDIA)
+    assert [r.url for r in renditions] == [
+        "https://tenor/gif.gif",
+        "https://tenor/medium.gif",
+        "https://tenor/tiny.gif",
+    ]
+    assert renditions[2] == Rendition(
+        "https://tenor/tiny.gif", "image/gif", 220, 124, 150000
+    )
+
+
+def test_select_largest_within_budget():
+    renditions = get_giphy_renditions(GIPHY_IMAGES)
+    selector = RenditionSelector(max_size=2000000, max_pixels=400 * 300)
+    assert selector.select(renditions).url == "https://giphy/downsized.gif"
+
+    selector = RenditionSelector(max_size=1000000, max_pixels=400 * 300)
+    assert selector.select(renditions).url == "https://giphy/fixed_height.gif"
+
+    # same pixels, the smaller one wins
+    selector = RenditionSelector(max_size=2000000, max_pixels=498 * 280)
+    selected = selector.select(get_tenor_renditions(TENOR_MEDIA))
+    assert selected.url == "https://tenor/medium.gif"
+
+
+def test_select_smallest_if_nothing_fits():
+    selector = RenditionSelector(max_size=1000, max_pixels=100)
+    selected = selector.select(get_giphy_renditions(GIPHY_IMAGES))
+    assert selected.url == "https://giphy/fixed_height.gif"
+
+
+def test_select_allowed_types():
+    renditions = get_giphy_renditions(GIPHY_IMAGES)
+    selector = RenditionSelector(max_size=5000000, max_pixels=800 * 600)
+    assert selector.select(renditions).url == "https://giphy/downsized.gif"
+
+    selector = RenditionSelector.create(
+        {
+            "max_size": "5000000",
+            "max_pixels": "480000",
+            "mimetypes": "image/gif, image/webp",
+        }
+    )
+    assert selector.select(renditions).url == "https://giphy/original.webp"
+
+    selector = RenditionSelector(mimetypes=("video/mp4",))
+    assert selector.select(renditions) is None
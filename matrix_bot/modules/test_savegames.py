@@ -0,0 +1,85 @@
+import os
+
+from matrix_bot.modules.savegames import SavegameStore, SessionSnapshots
+
+
+def count_blobs(store):
+    return sum(len(files) for unused, unused, files in os.walk(store.blob_dir))
+
+
+def test_savegame_store_deduplicates(tmp_path):
+    store = SavegameStore(str(tmp_path))
+    store.put("room", "anchor", SavegameStore.SESSION, b"quetzal" * 100)
+    store.put("room", "anchor", "first", b"quetzal" * 100)
+    store.put("other-room", "anchor", "first", b"quetzal" * 100)
+
+    assert store.get("room", "anchor", "first") == b"quetzal" * 100
+    assert count_blobs(store) == 1
+    assert (
+        os.path.getsize(store.get_blob_path(store.get_hash("room", "anchor", "first")))
+        < 700
+    )
+
+
+def test_savegame_store_deletes_unreferenced_blobs(tmp_path):
+    store = SavegameStore(str(tmp_path))
+    store.put("room", "anchor", SavegameStore.SESSION, b"turn 1")
+    assert store.link("room", "anchor", SavegameStore.SESSION, "save")
+    store.put("room", "anchor", SavegameStore.SESSION, b"turn 2")
+
+    assert count_blobs(store) == 2
+    assert store.get("room", "anchor", "save") == b"turn 1"
+
+    store.delete("room", "anchor", "save")
+    assert count_blobs(store) == 1
+    assert store.get("room", "anchor", "save") is None
+    assert not store.link("room", "anchor", "missing", "save")
+
+
+def test_savegame_store_lists_saves_without_session(tmp_path):
+    store = SavegameStore(str(tmp_path))
+    store.put("room", "anchor", SavegameStore.SESSION, b"session")
+    store.put("room", "anchor", "b", b"b", mtime=2)
+    store.put("room", "anchor", "a", b"a", mtime=1)
+    store.put("room", "h2g2", "c", b"c", mtime=3)
+
+    assert store.list("room", "anchor") == [("a", 1), ("b", 2)]
+
+
+def test_savegame_store_migrates_plain_files(tmp_path):
+    session_dir = tmp_path / "sessions"
+    save_dir = tmp_path / "saves"
+    (session_dir / "room").mkdir(parents=True)
+    (session_dir / "room" / "anchor").write_bytes(b"session")
+    (session_dir / "state.db").write_bytes(b"")
+    (save_dir / "room" / "anchor").mkdir(parents=True)
+    (save_dir / "room" / "anchor" / "before-the-house").write_bytes(b"save")
+
+    store = SavegameStore(str(save_dir))
+    store.migrate(str(session_dir), str(save_dir))
+
+    assert store.get("room", "anchor", SavegameStore.SESSION) == b"session"
+    assert store.get("room", "anchor", "before-the-house") == b"save"
+    assert sorted(os.listdir(session_dir)) == ["state.db"]
+    assert not (save_dir / "room").exists()
+
+
+def test_session_snapshots_are_written_on_flush(tmp_path):
+    store = SavegameStore(str(tmp_path))
+    snapshots = SessionSnapshots(store)
+    assert not snapshots.save_as("room", "anchor", "save")
+
+    snapshots.put("room", "anchor", b"turn 1")
+    snapshots.put("room", "anchor", b"turn 2")
+    assert snapshots.get("room", "anchor") == b"turn 2"
+    assert snapshots.exists("room", "anchor")
+    assert store.get("room", "anchor", SavegameStore.SESSION) is None
+
+    assert snapshots.save_as("room", "anchor", "save")
+    assert store.get("room", "anchor", "save") == b"turn 2"
+
+    snapshots.flush()
+    assert len(snapshots) == 0
+    assert store.get("room", "anchor", SavegameStore.SESSION) == b"turn 2"
+    assert snapshots.get("room", "anchor") == b"turn 2"
+    assert snapshots.save_as("room", "anchor", "other")
@@ -0,0 +1,118 @@
+import configparser
+import os
+from unittest.mock import AsyncMock, Mock
+
+import aiohttp
+import pytest
+
+from matrix_bot.modules.xkcd import XkcdModule
+from matrix_bot.modules.xkcd_index import COMIC_URL, LATEST_URL, XkcdIndex
+
+
+@pytest.fixture
+def dump_file():
+    return os.path.abspath(
+        os.path.join(__file__, "../../../test-data/xkcd-sample.json")
+    )
+
+
+@pytest.fixture
+def index(dump_file):
+    return XkcdIndex.load_dump(dump_file)
+
+
+@pytest.fixture
+def xkcd(tmp_path, index):
+    config = configparser.ConfigParser()
+    config.read_dict({"xkcd": {"index_file": str(tmp_path / "xkcd.json")}})
+    module = XkcdModule.create(config)
+    module.index = index
+    return module
+
+
+def test_xkcd_index_search_ranks_titles_first(index):
+    results = index.search("standards")
+    assert [comic["num"] for comic in results] == [927]
+
+    results = index.search("python")
+    assert results[0]["num"] == 353
+
+
+def test_xkcd_index_search_uses_alt_text_and_transcript(index):
+    assert index.search("sudo make me a sandwich")[0]["num"] == 149
+    assert index.search("bobby tables")[0]["num"] == 327
+    assert index.search("supervolcano")[0]["num"] == 1053
+    assert index.search("nebraska")[0]["num"] == 2347
+
+
+def test_xkcd_index_search_without_matches(index):
+    assert index.search("xyzzy") == []
+    assert index.search("") == []
+
+
+def test_xkcd_index_save_and_load(index, tmp_path):
+    path = str(tmp_path / "xkcd.json")
+    index.missing.add(404)
+    index.save(path)
+
+    loaded = XkcdIndex.load(path)
+    assert loaded.comics == index.comics
+    assert loaded.postings == index.postings
+    assert loaded.missing == {404}
+
+
+def test_xkcd_index_replaces_updated_comics(index):
+    index.add(dict(num=927, title="Competing", alt="", transcript="", img=""))
+
+    assert index.search("standards") == []
+    assert index.search("competing")[0]["num"] == 927
+
+
+@pytest.mark.asyncio
+async def test_xkcd_index_refresh_only_fetches_new_comics(index):
+    fetched = []
+
+    async def get_json(url):
+        fetched.append(url)
+        if url == LATEST_URL:
+            return dict(num=2350, title="Latest", alt="", transcript="", img="")
+
+        num = int(url.split("/")[3])
+        if num == 2349:
+            raise aiohttp.ClientResponseError(Mock(), (), status=404)
+
+        return dict(num=num, title="Comic", alt="", transcript="", img="")
+
+    http = Mock(get_json=get_json)
+    index.comics = {num: index.comics[num] for num in [2347]}
+    index.comics.update({num: dict(num=num) for num in range(1, 2347)})
+
+    assert await index.refresh(http) == 2
+    assert fetched == [LATEST_URL, COMIC_URL.format(2348), COMIC_URL.format(2349)]
+    assert index.missing == {2349}
+
+    fetched.clear()
+    assert await index.refresh(http) == 0
+    assert fetched == [LATEST_URL]
+
+
+@pytest.mark.asyncio
+async def test_xkcd_command_by_number(xkcd):
+    bot = AsyncMock()
+    room = Mock()
+    await xkcd.search_xkcd(bot=bot, event=None, search="927", room=room, user=None)
+
+    bot.send_remote_image.assert_called_with(
+        room=room,
+        url="https://imgs.xkcd.com/comics/standards.png",
+        name=xkcd.index.get(927)["alt"],
+    )
+
+
+@pytest.mark.asyncio
+async def test_xkcd_command_unknown(xkcd):
+    bot = AsyncMock()
+    room = Mock()
+    await xkcd.search_xkcd(bot=bot, event=None, search="xyzzy", room=room, user=None)
+
+    bot.send_room_text.assert_called_with(room, "That doesn't exist.")
@@ -20,13 +20,14 @@ def room_id():
 
 
 @pytest.fixture
-def zgame_config(root_dir):
+def zgame_config(root_dir, tmp_path):
     config = configparser.ConfigParser()
     config.read_string(
         """
 [zgame]
-session_dir = {root}/test-data/zgame-sessions
-save_dir = {root}/test-data/zgame-savegames
+session_dir = {tmp}/zgame-sessions
+save_dir = {tmp}/zgame-savegames
+scratch_dir = {tmp}
 
 [zgame/make-it-good]
 name = Make It Good
@@ -41,7 +42,7 @@ file = {root}/test-data/anchor.z8
 name = Hitchhiker's Guide To The Galaxy
 file = {root}/test-data/hhgg.z3
  """.format(
-            root=root_dir
+            root=root_dir, tmp=tmp_path
         )
     )
 
@@ -273,3 +274,114 @@ async def test_zgame_room_message_direct_command(zgame, bot, room, event):
     zgame.zcommand.assert_called_with(
         bot=bot, event=event, command="examine", room=ANY, user=ANY
     )
+
+
+@pytest.mark.asyncio
+async def test_zgame_state_survives_restart(zgame, zgame_config, bot, room, event):
+    event.source["content"]["body"] = "!zdirect on"
+    await zgame.handle_room_message(bot=bot, room=room, event=event)
+    zgame.set_session(room.room_id, "anchor")
+    zgame.convert_to_html("Bedroom        Score: 0\n\nYou're in bed.\n> ", room.room_id)
+    await zgame.shutdown()
+
+    zgame = zgame_module.ZGameModule.create(zgame_config)
+
+    assert zgame.direct_mode == {room.room_id: {event.sender}}
+    assert zgame.sessions == {room.room_id: "anchor"}
+    assert zgame.status_line_cache == {
+        room.room_id: {"location": "Bedroom", "score": "Score: 0"}
+    }
+
+
+def test_zgame_migrates_sessions_manifest(zgame_config, room_id):
+    session_dir = zgame_config["zgame"]["session_dir"]
+    os.makedirs(session_dir)
+    with open(os.path.join(session_dir, "sessions"), "w") as f:
+        f.write('{"%s": "h2g2"}' % room_id)
+
+    zgame = zgame_module.ZGameModule.create(zgame_config)
+
+    assert zgame.sessions == {room_id: "h2g2"}
+    assert not os.path.exists(os.path.join(session_dir, "sessions"))
+
+
+@pytest.mark.asyncio
+async def test_zgame_zsave_links_session(zgame, bot, room, event):
+    zgame.set_session(room.room_id, "anchor")
+    escaped_room_id = zgame.escape_room_id(room.room_id)
+    zgame.savegames.put(escaped_room_id, "anchor", "", b"quetzal")
+
+    event.source["content"]["body"] = "!zsave house"
+    await zgame.handle_room_message(bot=bot, room=room, event=event)
+
+    bot.send_room_text.assert_called_with(
+        room, "Saved to file 'house' for game 'anchor'"
+    )
+    assert zgame.savegames.get(escaped_room_id, "anchor", "house") == b"quetzal"
+
+    event.source["content"]["body"] = "!zsave house"
+    await zgame.handle_room_message(bot=bot, room=room, event=event)
+
+    bot.send_room_text.assert_called_with(
+        room,
+        "Save file 'house' exists, pick another one or specify 'overwrite' as last argument",
+    )
+
+
+class FakeSession:
+    def __init__(self, room_id, game_id, data):
+        self.room_id = room_id
+        self.game_id = game_id
+        self.data = data
+        self.restored = None
+
+    async def save(self, path):
+        assert not os.path.exists(path)
+        with open(path, "wb") as f:
+            f.write(self.data)
+
+    async def restore(self, path):
+        with open(path, "rb") as f:
+            self.restored = f.read()
+
+        return "restored"
+
+
+@pytest.mark.asyncio
+async def test_zgame_session_snapshots_stay_in_memory(zgame, zgame_config, room_id):
+    escaped_room_id = zgame.escape_room_id(room_id)
+    session = FakeSession(room_id, "anchor", b"turn 1")
+    await zgame.save_game(session)
+    session.data = b"turn 2"
+    await zgame.save_game(session)
+
+    assert zgame.savegames.get(escaped_room_id, "anchor", "") is None
+    assert os.listdir(zgame.scratch_dir) == []
+
+    restored = FakeSession(room_id, "anchor", None)
+    assert await zgame.restore_game(restored) == "restored"
+    assert restored.restored == b"turn 2"
+
+    scratch_dir = zgame.scratch_dir
+    await zgame.shutdown()
+    assert not os.path.exists(scratch_dir)
+
+    zgame = zgame_module.ZGameModule.create(zgame_config)
+    assert zgame.savegames.get(escaped_room_id, "anchor", "") == b"turn 2"
+
+
+@pytest.mark.asyncio
+async def test_zgame_zdownload(zgame, bot, room, event):
+    zgame.savegames.put(zgame.escape_room_id(room.room_id), "anchor", "house", b"q")
+    bot.upload_data.return_value = "mxc://localhost/save"
+
+    event.source["content"]["body"] = "!zdownload anchor house"
+    await zgame.handle_room_message(bot=bot, room=room, event=event)
+
+    bot.upload_data.assert_called_with(b"q", "application/octet-stream", room=room)
+    bot.send_room_file.assert_called_with(
+        room=room,
+        url="mxc://localhost/save",
+        name="anchor-house",
+        extra=dict(mimetype="application/octet-stream", size=1),
+    )
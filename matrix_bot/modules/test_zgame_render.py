@@ -0,0 +1,49 @@
+import json
+import os
+
+import pytest
+
+from matrix_bot.modules.zgame_render import render_output
+
+CORPUS_FILE = os.path.abspath(
+    os.path.join(__file__, "../../../test-data/zgame-transcripts.json")
+)
+
+
+def load_transcripts():
+    with open(CORPUS_FILE) as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize(
+    "transcript", load_transcripts(), ids=lambda transcript: transcript["game"]
+)
+def test_render_output_matches_lxml_renderer(transcript):
+    # the expected html and body were generated by the lxml renderer, see
+    # benchmarks/bench_zgame_render.py
+    status_line = {}
+    for turn in transcript["turns"]:
+        if "error" in turn:
+            with pytest.raises(ValueError):
+                render_output(turn["output"], status_line)
+            continue
+
+        assert render_output(turn["output"], status_line) == (
+            turn["html"],
+            turn["body"],
+        )
+
+
+def test_render_output_only_shows_changed_status_line():
+    status_line = {}
+    html, body = render_output("Bedroom     Score: 0\nIt is dark.\n\n> ", status_line)
+    assert html == (
+        '<div>\n<div class="location">Bedroom</div>\n<div class="score">Score: 0</div>'
+        "\n<p>It is dark.</p>\n</div>\n"
+    )
+    assert body == "\nBedroom\nScore: 0\nIt is dark.\n\n"
+    assert status_line == {"location": "Bedroom", "score": "Score: 0"}
+
+    html, body = render_output("Bedroom     Score: 0\nStill dark.\n\n> ", status_line)
+    assert html == "<div><p>Still dark.</p></div>\n"
+    assert body == "Still dark.\n"
@@ -1,90 +1,82 @@
 #!/usr/bin/env python3
-import json
+import asyncio
 import logging
-import random
-import re
-
-import requests
-from bs4 import BeautifulSoup
+import os
 
+from matrix_bot.media import MediaError
 from matrix_bot.modules.base import MatrixBotModule, arg
+from matrix_bot.modules.xkcd_index import XkcdIndex
 
 
 class XkcdModule(MatrixBotModule):
     @staticmethod
     def create(config):
-        if (
-            "google" in config
-            and "api_key" in config["google"]
-            and "cx" in config["google"]
-        ):
+        if "xkcd" in config:
             return XkcdModule(config)
 
         return None
 
+    def __init__(self, config):
+        super(XkcdModule, self).__init__(config)
+        self.index_file = self.config["xkcd"].get(
+            "index_file", os.path.join("data", "xkcd.json")
+        )
+        self.refresh_interval = float(
+            self.config["xkcd"].get("refresh_interval", "3600")
+        )
+        self.index = XkcdIndex.load(self.index_file)
+        self.refresh_task = None
+
     def register_commands(self):
         self.add_command(
             "!xkcd",
             arg("search", self.validate_search, multi_word=True),
             callback=self.search_xkcd,
-            help="search giphy",
+            help="show xkcd number {arg1} or search for it",
         )
 
     def validate_search(self, value):
         pass
 
-    def search_xkcd(self, event, search, room_, user_):
-        search = search.replace(" ", "+")
-        search_response = requests.get(
-            "https://www.googleapis.com/customsearch/v1/",
-            params=dict(
-                key=self.config["google"]["api_key"],
-                cx=self.config["google"]["cx"],
-                q="site:xkcd.com " + search,
-            ),
-        )
-        results = json.loads(search_response.content.decode("utf-8"))
-        print(search_response.content)
-        links = []
-        for item in results["items"]:
-            link = item["link"]
-            mo = re.match(r"https://xkcd.com/\d+/?", link)
-            if mo:
-                links.append(link)
-
-        if not links:
-            return
+    async def start(self, bot):
+        self.refresh_task = asyncio.create_task(self.keep_index_fresh(bot))
 
-        found_xkcd_link = random.choice(links)
-        xkcd_response = requests.get(found_xkcd_link)
-        print(xkcd_response.content)
-        soup = BeautifulSoup(xkcd_response.content, "html.parser")
-        transcript = soup.find(id="transcript").string
-        comic = soup.find(id="comic")
-        if not comic:
-            return
+    async def shutdown(self):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
 
-        imgs = comic.find_all("img")
-        if not imgs:
-            return
+    async def keep_index_fresh(self, bot):
+        while True:
+            try:
+                added = await self.index.refresh(bot.http)
+                if added:
+                    print("added {} comics to the xkcd index".format(added))
+                    self.index.save(self.index_file)
 
-        img = imgs[0]
+            except Exception as e:
+                print("refreshing the xkcd index failed: {}".format(e))
 
-        alt_text = img.get("title")
-        img_url = img.get("src")
+            await asyncio.sleep(self.refresh_interval)
 
-        if img_url.startswith("//"):
-            img_url = "https://xkcd.com" + img_url[1:]
+    def find_comic(self, search):
+        search = search.strip()
+        if search.isdigit():
+            return self.index.get(int(search))
 
-        elif not img_url.startswith("http"):
-            img_url = found_xkcd_link + img_url
+        results = self.index.search(search, limit=1)
+        if not results:
+            return None
 
-        image_response = requests.get(img_url)
-        mimetype = image_response.headers.get("Content-Type")
-        image_url = self.client.upload(image_response.content, "image/gif")
-        room_.send_image(
-            url=image_url,
-            name=alt_text,
-            mimetype=mimetype,
-            size=len(image_response.content),
-        )
+        return results[0]
+
+    async def search_xkcd(self, bot, event, search, room, user):
+        comic = self.find_comic(search)
+        if comic is None:
+            await bot.send_room_text(room, "That doesn't exist.")
+            return
+
+        try:
+            await bot.send_remote_image(room=room, url=comic["img"], name=comic["alt"])
+        except MediaError as e:
+            print(e)
+            await bot.send_room_text(room, "Something went wrong.")
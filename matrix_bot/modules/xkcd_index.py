@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import math
+import os
+import re
+from collections import Counter
+
+import aiohttp
+
+LATEST_URL = "https://xkcd.com/info.0.json"
+COMIC_URL = "https://xkcd.com/{}/info.0.json"
+
+# how much a word counts depending on where it was found
+FIELD_WEIGHTS = {"title": 3.0, "alt": 2.0, "transcript": 1.0}
+
+
+def tokenize(text):
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+class XkcdIndex:
+    """Local copy of the xkcd metadata with an inverted index for searching
+
+    Comics are stored as the relevant fields of their info.0.json, the index
+    maps every word to the comics it appears in and its weighted frequency
+    there.
+    """
+
+    def __init__(self):
+        self.comics = {}
+        self.postings = {}
+        # comic numbers that don't exist, e.g. 404
+        self.missing = set()
+
+    def __len__(self):
+        return len(self.comics)
+
+    def add(self, info):
+        num = int(info["num"])
+        comic = dict(
+            num=num,
+            title=info.get("title", ""),
+            safe_title=info.get("safe_title", ""),
+            alt=info.get("alt", ""),
+            transcript=info.get("transcript", ""),
+            img=info.get("img", ""),
+        )
+        if num in self.comics:
+            self.remove(num)
+
+        self.comics[num] = comic
+        for token, weight in self.get_weights(comic).items():
+            self.postings.setdefault(token, {})[num] = weight
+
+    def remove(self, num):
+        comic = self.comics.pop(num)
+        for token in self.get_weights(comic):
+            postings = self.postings[token]
+            del postings[num]
+            if not postings:
+                del self.postings[token]
+
+    @staticmethod
+    def get_weights(comic):
+        weights = Counter()
+        titles = set(tokenize(comic["title"]) + tokenize(comic["safe_title"]))
+        for token in titles:
+            weights[token] += FIELD_WEIGHTS["title"]
+
+        for field in ["alt", "transcript"]:
+            for token in tokenize(comic[field]):
+                weights[token] += FIELD_WEIGHTS[field]
+
+        return weights
+
+    def get(self, num):
+        return self.comics.get(num)
+
+    def search(self, query, limit=10):
+        """Return up to `limit` comics matching the query, best match first
+
+        Scores are the weighted word frequencies times the inverse document
+        frequency of each word, summed over the words of the query.
+        """
+        scores = Counter()
+        for token in set(tokenize(query)):
+            postings = self.postings.get(token)
+            if not postings:
+                continue
+
+            idf = math.log(1 + len(self.comics) / len(postings))
+            for num, weight in postings.items():
+                scores[num] += weight * idf
+
+        ranked = sorted(scores.items(), key=lambda x: (-x[1], -x[0]))
+        return [self.comics[num] for num, unused_score in ranked[:limit]]
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        data = dict(
+            comics=list(self.comics.values()),
+            index=self.postings,
+            missing=sorted(self.missing),
+        )
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(data, f)
+
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def load(path):
+        index = XkcdIndex()
+        if not os.path.exists(path):
+            return index
+
+        with open(path, "r") as f:
+            data = json.load(f)
+
+        index.comics = {comic["num"]: comic for comic in data["comics"]}
+        # JSON only has string keys
+        index.postings = {
+            token: {int(num): weight for num, weight in postings.items()}
+            for token, postings in data["index"].items()
+        }
+        index.missing = set(data.get("missing", []))
+        return index
+
+    @staticmethod
+    def load_dump(path):
+        """Build an index from a JSON list of info.0.json documents"""
+        index = XkcdIndex()
+        with open(path, "r") as f:
+            for info in json.load(f):
+                index.add(info)
+
+        return index
+
+    async def refresh(self, http, concurrency=8):
+        """Fetch the comics that aren't in the index yet
+
+        Returns the number of comics added.
+        """
+        count = len(self.comics)
+        latest = await http.get_json(LATEST_URL)
+        self.add(latest)
+
+        new_nums = [
+            num
+            for num in range(1, int(latest["num"]))
+            if num not in self.comics and num not in self.missing
+        ]
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(num):
+            async with semaphore:
+                try:
+                    self.add(await http.get_json(COMIC_URL.format(num)))
+                except aiohttp.ClientResponseError as e:
+                    if e.status == 404:
+                        self.missing.add(num)
+                    else:
+                        print("failed to fetch xkcd {}: {}".format(num, e))
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    # try again on the next refresh
+                    print("failed to fetch xkcd {}: {}".format(num, e))
+
+        await asyncio.gather(*(fetch(num) for num in new_nums))
+        return len(self.comics) - count
@@ -1,22 +1,31 @@
 #!/usr/bin/env python3
+import asyncio
 import html
-import json
+import itertools
 import logging
 import os
-import random
 import re
 import shutil
-import string
-import time
+import tempfile
 from datetime import datetime
-from fcntl import F_GETFL, F_SETFL, fcntl
-from subprocess import PIPE, STDOUT, Popen
 
 import lxml.html
-import requests
 from lxml.html import builder as E
 
+from matrix_bot.cpupool import CpuPool
+from matrix_bot.media import MediaError
+from matrix_bot.modules import zgame_render
 from matrix_bot.modules.base import MatrixBotModule, ValidationError, arg
+from matrix_bot.modules.frotz import (
+    FrotzSession,
+    SessionManager,
+    get_default_dfrotz_path,
+    get_default_scratch_dir,
+    get_games,
+)
+from matrix_bot.modules.frotz_daemon import FrotzClient, RemoteFrotzSession
+from matrix_bot.modules.savegames import SavegameStore, SessionSnapshots
+from matrix_bot.modules.zgame_state import ZGameState
 
 
 class ZGameModule(MatrixBotModule):
@@ -36,29 +45,44 @@ class ZGameModule(MatrixBotModule):
         )
         self.session_dir = self.config["zgame"]["session_dir"]
         self.save_dir = self.config["zgame"]["save_dir"]
-        self.games = {}
-        for section in self.config.sections():
-            if not section.startswith("zgame/"):
-                continue
-
-            game_id = section[len("zgame/") :]
-            data = self.config[section]
-            data["id"] = game_id
-            self.games[game_id] = data
-
-        self.sessions = {}
-        self.status_line_cache = {}
-        self.load_sessions()
-        self.direct_mode = {}
-
-    async def handle_room_message(self, bot, room, event):
-        if await super().handle_room_message(bot=bot, room=room, event=event):
-            return
+        self.games = get_games(self.config)
 
+        self.state = ZGameState(
+            self.config["zgame"].get(
+                "state_db", os.path.join(self.session_dir, "state.db")
+            )
+        )
+        self.state.migrate_sessions_manifest(os.path.join(self.session_dir, "sessions"))
+        self.savegames = SavegameStore(self.save_dir)
+        self.savegames.migrate(self.session_dir, self.save_dir)
+        self.snapshots = SessionSnapshots(self.savegames)
+        self.flush_interval = float(self.config["zgame"].get("flush_interval", "60"))
+        self.flush_task = None
+        # the interpreter only takes file names for saving and restoring,
+        # those files live here, in RAM if possible
+        self.scratch_dir = tempfile.mkdtemp(
+            prefix="matrix-bot-zgame-",
+            dir=self.config["zgame"].get("scratch_dir", get_default_scratch_dir()),
+        )
+        self.scratch_names = itertools.count()
+        # in memory copies of the state, every change is written through
+        self.sessions = self.state.get_sessions()
+        self.status_line_cache = self.state.get_status_lines()
+        self.direct_mode = self.state.get_direct_mode()
+        self.live_sessions = SessionManager(
+            max_sessions=int(self.config["zgame"].get("max_live_sessions", "20")),
+            idle_timeout=float(self.config["zgame"].get("idle_timeout", "1800")),
+            on_evict=self.save_game,
+        )
+        self.read_timeout = float(self.config["zgame"].get("read_timeout", "5"))
+        # None runs the interpreters in the bot
+        self.daemon = FrotzClient.create(self.config["zgame"])
+        self.round_trips = None
+        # replaced by the bot's pool on start
+        self.cpu_pool = CpuPool()
+
+    async def handle_unmatched_message(self, bot, room, event):
         content = event.source["content"]
-        if content["msgtype"] != "m.text":
-            return
-
         room_id = room.room_id
         sender_id = event.sender
         command = content["body"].strip()
@@ -68,7 +92,9 @@ class ZGameModule(MatrixBotModule):
             return
 
         if sender_id in self.direct_mode.get(room_id, set()):
-            self.zcommand(bot=bot, event=event, command=command, room=room, user=None)
+            await self.zcommand(
+                bot=bot, event=event, command=command, room=room, user=None
+            )
 
     def register_commands(self):
         self.add_command("!zhelp", "!zh", callback=self.show_help, help="show help")
@@ -180,18 +206,15 @@ class ZGameModule(MatrixBotModule):
 
     async def zstart(self, bot, event, game_id, room, user):
         room_id = room.room_id
-        game = self.games[game_id]
 
-        p = self.start_frotz(game)
-        self.send_prefix(p, game)
+        async with self.live_sessions.lock(room_id):
+            data, session = await self.start_session(room_id, game_id)
 
-        data = self.send_data_to_process(p, "\n")
-        html_data = self.convert_to_html(data, room_id)
+        html_data, body = await self.render(data, room_id)
 
-        self.save_game(p, room_id, game_id)
-        self.quit_game(p)
+        self.set_session(room_id, game_id)
 
-        await bot.send_room_html(room, html_data)
+        await bot.send_room_html(room, html_data, body)
 
     async def zsave(self, bot, event, name, overwrite, room, user):
         room_id = room.room_id
@@ -203,14 +226,12 @@ class ZGameModule(MatrixBotModule):
 
         if room_id not in self.sessions:
             await bot.send_room_text(room, "No session to save")
+            return
 
         game_id = self.sessions[room_id]
-        game = self.games[game_id]
+        escaped_room_id = ZGameModule.escape_room_id(room_id)
 
-        target_path = os.path.join(
-            self.save_dir, ZGameModule.escape_room_id(room_id), game_id, name
-        )
-        if os.path.exists(target_path) and not overwrite:
+        if self.savegames.exists(escaped_room_id, game_id, name) and not overwrite:
             await bot.send_room_text(
                 room,
                 "Save file '{}' exists, pick another one or specify 'overwrite' as last argument".format(
@@ -219,17 +240,24 @@ class ZGameModule(MatrixBotModule):
             )
             return
 
-        os.makedirs(
-            os.path.abspath(os.path.join(target_path, os.pardir)), exist_ok=True
-        )
-        shutil.copy(self.get_session_file(room_id, game_id), target_path)
+        async with self.live_sessions.lock(room_id):
+            # the live interpreter is ahead of the session file, write it out first
+            session = await self.live_sessions.get(room_id)
+            if session is not None:
+                await self.save_game(session)
+
+            saved = self.snapshots.save_as(escaped_room_id, game_id, name)
+
+        if not saved:
+            await bot.send_room_text(room, "No session to save")
+            return
+
         await bot.send_room_text(
             room, "Saved to file '{}' for game '{}'".format(name, game_id)
         )
 
     async def zload(self, bot, event, game_id, name, room, user):
         room_id = room.room_id
-        game = self.games[game_id]
 
         if not re.match(r"^[a-zA-Z0-9-]+$", name):
             await bot.send_room_text(
@@ -238,33 +266,24 @@ class ZGameModule(MatrixBotModule):
             )
             return
 
-        target_path = os.path.join(
-            self.save_dir, ZGameModule.escape_room_id(room_id), game_id, name
-        )
-        if not os.path.exists(target_path):
+        if not self.savegames.exists(
+            ZGameModule.escape_room_id(room_id), game_id, name
+        ):
             await bot.send_room_text(room, "Save file '{}' doesn't exist".format(name))
             return
 
-        p = self.start_frotz(game)
-        self.send_prefix(p, game)
-        self.send_data_to_process(p, "\n")
-        data = self.load_game(p, room_id, game_id, name)
-        if data is None:
-            await bot.send_room_text(
-                room, "No session found for game-id '{}'".format(game_id)
-            )
-            return
+        async with self.live_sessions.lock(room_id):
+            unused_data, session = await self.start_session(room_id, game_id)
+            data = await self.load_game(session, name)
 
-        html_data = self.convert_to_html(data, room_id)
+        html_data, body = await self.render(data, room_id)
 
-        self.save_game(p, room_id, game_id)
-        self.quit_game(p)
+        self.set_session(room_id, game_id)
 
-        await bot.send_room_html(room, html_data)
+        await bot.send_room_html(room, html_data, body)
 
     async def zdownload(self, bot, event, game_id, name, room, user):
         room_id = room.room_id
-        game = self.games[game_id]
 
         if not re.match(r"^[a-zA-Z0-9-]+$", name):
             await bot.send_room_text(
@@ -273,37 +292,30 @@ class ZGameModule(MatrixBotModule):
             )
             return
 
-        target_path = os.path.join(
-            self.save_dir, ZGameModule.escape_room_id(room_id), game_id, name
-        )
-        if not os.path.exists(target_path):
+        data = self.savegames.get(ZGameModule.escape_room_id(room_id), game_id, name)
+        if data is None:
             await bot.send_room_text(room, "Save file '{}' doesn't exist".format(name))
             return
 
-        file_url = self.client.upload(
-            open(target_path, "rb").read(), "application/octet-stream"
-        )
+        try:
+            file_url = await bot.upload_data(
+                data, "application/octet-stream", room=room
+            )
+        except MediaError:
+            await bot.send_room_text(room, "Something went wrong.")
+            return
+
         await bot.send_room_file(
             room=room,
             url=file_url,
             name=game_id + "-" + name,
-            mimetype="application/octet-stream",
+            extra=dict(mimetype="application/octet-stream", size=len(data)),
         )
 
     async def zlistsaves(self, bot, event, game_id, room, user):
         room_id = room.room_id
 
-        specific_savegame_dir = os.path.join(
-            self.save_dir, ZGameModule.escape_room_id(room_id), game_id
-        )
-        os.makedirs(specific_savegame_dir, exist_ok=True)
-        filenames = [
-            (f, os.path.getmtime(os.path.join(specific_savegame_dir, f)))
-            for f in os.listdir(specific_savegame_dir)
-            if os.path.isfile(os.path.join(specific_savegame_dir, f))
-        ]
-        print(specific_savegame_dir, filenames)
-        filenames.sort(key=lambda x: x[1])
+        filenames = self.savegames.list(ZGameModule.escape_room_id(room_id), game_id)
         html = E.TABLE()
         if not filenames:
             await bot.send_room_text(
@@ -320,24 +332,22 @@ class ZGameModule(MatrixBotModule):
 
     async def zcontinue(self, bot, event, game_id, room, user):
         room_id = room.room_id
-        game = self.games[game_id]
 
-        p = self.start_frotz(game)
-        self.send_prefix(p, game)
-        self.send_data_to_process(p, "\n")
-        data = self.restore_game(p, room_id, game_id)
-        if data is None:
+        if not self.snapshots.exists(ZGameModule.escape_room_id(room_id), game_id):
             await bot.send_room_text(
                 room, "No session found for game-id '{}'".format(game_id)
             )
             return
 
-        html_data = self.convert_to_html(data, room_id)
+        async with self.live_sessions.lock(room_id):
+            unused_data, session = await self.start_session(room_id, game_id)
+            data = await self.restore_game(session)
 
-        self.save_game(p, room_id, game_id)
-        self.quit_game(p)
+        html_data, body = await self.render(data, room_id)
 
-        await bot.send_room_html(room, html_data)
+        self.set_session(room_id, game_id)
+
+        await bot.send_room_html(room, html_data, body)
 
     async def zdirect(self, bot, event, mode, room, user):
         room_id = room.room_id
@@ -347,11 +357,13 @@ class ZGameModule(MatrixBotModule):
                 self.direct_mode[room_id] = set()
 
             self.direct_mode[room_id].add(sender_id)
+            self.state.set_direct_mode(room_id, sender_id, True)
             await bot.send_room_text(room, "Direct mode enabled")
 
         else:
             if sender_id in self.direct_mode.get(room_id, set()):
                 self.direct_mode[room_id].remove(sender_id)
+                self.state.set_direct_mode(room_id, sender_id, False)
 
             await bot.send_room_text(
                 room,
@@ -365,296 +377,189 @@ class ZGameModule(MatrixBotModule):
 
         if room_id not in self.sessions:
             await bot.send_room_text(
-                room, room, "No active session, use !zstart to start a game"
+                room, "No active session, use !zstart to start a game"
             )
             return
 
-        game_id = self.sessions[room_id]
-        game = self.games[game_id]
+        async with self.live_sessions.lock(room_id):
+            session = await self.live_sessions.get(room_id)
+            if session is None:
+                session = await self.attach_session(room_id, self.sessions[room_id])
 
-        p = self.start_frotz(game)
-        self.send_prefix(p, game)
-        self.send_data_to_process(p, "\n")
-        self.restore_game(p, room_id, game_id)
+            if session is None:
+                # first command since the bot started or the session got evicted
+                unused_data, session = await self.start_session(
+                    room_id, self.sessions[room_id]
+                )
+                await self.restore_game(session)
 
-        command = command + "\n"
-        data = self.send_data_to_process(p, command)
-        html_data = self.convert_to_html(data, room_id)
+            data = await session.send(command + "\n")
 
-        # send a hash and anew line in case we're stuck in a follow-up prompt
-        # to clarify, which would case the save to fail
-        # a hash also won't advance the time or move counter
-        self.send_data_to_process(p, "#\n")
+        html_data, body = await self.render(data, room_id)
 
-        self.save_game(p, room_id, game_id)
-        self.quit_game(p)
+        await bot.send_room_html(room, html_data, body)
 
-        await bot.send_room_html(room, html_data)
+    async def start(self, bot):
+        self.round_trips = bot.metrics.histogram(
+            "matrix_bot_zgame_interpreter_seconds",
+            "Time from sending input to the interpreter until its next prompt",
+            ["game"],
+        )
+        self.cpu_pool = bot.cpu_pool
+        self.flush_task = asyncio.create_task(self.keep_flushing())
 
-    # most things below this line probably can be refactored into a frotz module
+    async def shutdown(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
 
-    @staticmethod
-    def get_default_dfrotz_path():
-        return os.path.abspath(os.path.join(__file__, "../../../bin/dfrotz"))
+        if self.daemon is None:
+            await self.live_sessions.close_all()
+        else:
+            # the daemon keeps the games running while the bot restarts
+            await self.live_sessions.detach_all()
+            await self.daemon.close()
+
+        self.snapshots.flush()
+        self.state.close()
+        self.savegames.close()
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
+
+    async def keep_flushing(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.snapshots.flush()
+            except Exception as e:
+                print("writing zgame sessions failed: {}".format(e))
 
-    @staticmethod
-    def read_stdout_from_process(process):
-        data = os.read(process.stdout.fileno(), 100000)
-        data = data.decode("utf-8")
-        print("---")
-        print(data)
-        print("---")
-        return data
+    # most things below this line probably can be refactored into a frotz module
 
     @staticmethod
-    def read_stderr_from_process(process):
-        try:
-            data = os.read(process.stderr.fileno(), 100000)
-        except BlockingIOError:
-            return ""
-
-        data = data.decode("utf-8")
-        print("---stderr---")
-        print(data)
-        print("---stderr---")
-        return data
+    def get_default_dfrotz_path():
+        return get_default_dfrotz_path()
 
     @staticmethod
     def escape_room_id(room_id):
         return re.sub(r"[^a-zA-Z0-9._-]", "_", room_id)
 
-    @staticmethod
-    def get_temporary_filename():
-        filename = ""
-        while len(filename) < 32:
-            filename += random.choice(string.ascii_lowercase + string.digits)
-
-        return "/tmp/" + filename
-
-    @staticmethod
-    def count_leading_spaces(s):
-        for i in range(len(s)):
-            if s[i] != " ":
-                return i
-
-    @staticmethod
-    def add_text(element, text):
-        children = element.getchildren()
-        if children:
-            last_element = children[-1]
-            if last_element.tail:
-                last_element.tail += "\n" + text
-            else:
-                last_element.tail = text
-
-        else:
-            if element.text:
-                element.text += "\n" + text
-            else:
-                element.text = text
+    def get_scratch_filename(self):
+        # the file must not exist yet, dfrotz asks before overwriting
+        return os.path.join(self.scratch_dir, str(next(self.scratch_names)))
 
-    @staticmethod
-    def remove_trailing_brs(element):
-        children = element.getchildren()
-        for child in children:
-            ZGameModule.remove_trailing_brs(child)
-
-        if children:
-            last_child = children[-1]
-            if last_child.tag == "br" and not last_child.tail:
-                element.remove(last_child)
+    def render_output(self, data, room_id):
+        """Return the html and the plain text body for showing `data`"""
+        status_line = self.status_line_cache.setdefault(room_id, {})
+        old_status_line = dict(status_line)
+        try:
+            return zgame_render.render_output(data, status_line)
+        finally:
+            if status_line != old_status_line:
+                self.state.set_status_line(
+                    room_id, status_line.get("location"), status_line.get("score")
+                )
+
+    async def render(self, data, room_id):
+        """Like render_output, large output is rendered in the CPU pool"""
+        status_line = self.status_line_cache.setdefault(room_id, {})
+        new_status_line = status_line
+        try:
+            html_data, body, new_status_line = await self.cpu_pool.run(
+                zgame_render.render_output_detached,
+                data,
+                dict(status_line),
+                size=len(data),
+            )
+        except ValueError as e:
+            # the status line is updated before the output is found invalid
+            new_status_line = e.status_line
+            raise
+        finally:
+            if new_status_line != status_line:
+                status_line.update(new_status_line)
+                self.state.set_status_line(
+                    room_id, status_line.get("location"), status_line.get("score")
+                )
+
+        return html_data, body
 
     def convert_to_html(self, data, room_id):
-        if room_id not in self.status_line_cache:
-            self.status_line_cache[room_id] = {}
-
-        data = data.rstrip("> \n\r")
-        data = data.replace("</i><i>", "")
-        data = data.replace("</b><b>", "")
-        lines = data.split("\n")
-
-        main_div = E.DIV()
-
-        first_line_chunks = re.split("    +", lines[0], 1)
-        if len(first_line_chunks) > 1:
-            lines.pop(0)
-            location, score = first_line_chunks
-            location = location.strip()
-            location_full = location
-            score = score.strip()
-
-            # Make It Good uses " - ..." on the second line as extension of the
-            # location in the status line
-            if lines:
-                line = lines[0].strip()
-                if line.startswith("- "):
-                    lines.pop(0)
-                    location_full = location + " (" + line[2:] + ")"
-
-            if location_full != self.status_line_cache[room_id].get("location", ""):
-                main_div.append(E.DIV(E.CLASS("location"), location_full))
-
-            if score != self.status_line_cache[room_id].get("score", ""):
-                main_div.append(E.DIV(E.CLASS("score"), score))
-        else:
-            location = None
-            location_full = None
-            score = None
-
-        self.status_line_cache[room_id]["location"] = location_full
-        self.status_line_cache[room_id]["score"] = score
-
-        base_leading_spaces = min(
-            self.count_leading_spaces(s) for s in lines if s.strip(". ")
-        )
-
-        current = main_div
-        for raw_line in lines:
-            line = raw_line.strip()
-            if line == ".":
-                line = ""
-
-            line_without_tags = re.sub(r"</?[bi]>", "", line)
-            if location and line_without_tags.startswith(location):
-                continue
-
-            if line.startswith("[") and line.endswith("]"):
-                current.attrib["title"] = line
-                continue
-
-            if current.tag != "p" and not line:
-                continue
-
-            if current.tag != "p" or not line:
-                current = E.P()
-                main_div.append(current)
-
-            fixed_line = raw_line
-            if base_leading_spaces > 0 and fixed_line.startswith(
-                " " * base_leading_spaces
-            ):
-                fixed_line = fixed_line[base_leading_spaces:]
-
-            fixed_line = fixed_line.replace("  ", "\xa0 ")
-
-            self.add_text(current, fixed_line)
-
-            if fixed_line and len(fixed_line) < 50:
-                br = E.BR()
-                current.append(br)
-
-        self.remove_trailing_brs(main_div)
-
-        html_data = lxml.html.tostring(main_div, pretty_print=True).decode("utf-8")
-        html_data = html_data.replace("&lt;i&gt;", "<i>")
-        html_data = html_data.replace("&lt;/i&gt;", "</i>")
-        html_data = html_data.replace("&lt;b&gt;", "<b>")
-        html_data = html_data.replace("&lt;/b&gt;", "</b>")
-
+        html_data, unused_body = self.render_output(data, room_id)
         return html_data
 
-    def update_status_line_cache(self, room_id, new_status_line_cache):
-        if room_id not in self.status_line_cache:
-            self.status_line_cache[room_id] = {}
-
-        self.status_line_cache[room_id].update(new_status_line_cache)
-
-    def start_frotz(self, game):
-        command = [self.executable, "-w", "100000", "-h", "100000", game["file"]]
-        print("running:", " ".join(command))
-        p = Popen(command, stdout=PIPE, stdin=PIPE, stderr=PIPE)
-
-        # set the O_NONBLOCK flag of p.stdout file descriptor:
-        flags = fcntl(p.stdout.fileno(), F_GETFL)  # get current p.stdout flags
-        fcntl(p.stdout.fileno(), F_SETFL, flags | os.O_NONBLOCK)
-
-        # set the O_NONBLOCK flag of p.stderr file descriptor:
-        flags = fcntl(p.stderr.fileno(), F_GETFL)  # get current p.stderr flags
-        fcntl(p.stderr.fileno(), F_SETFL, flags | os.O_NONBLOCK)
-
-        time.sleep(0.1)
-        data = self.read_stderr_from_process(p)
-        if data:
-            raise Exception(data)
-
-        return p
-
-    def send_prefix(self, process, game):
-        prefix = (
-            game.get("command_prefix", "").replace(r"\\", "\\").replace(r"\n", "\n")
-        )
-        if not prefix:
-            return ""
-
-        return self.send_data_to_process(process, prefix)
-
-    def send_options(self, process, game):
-        return self.send_data_to_process(process, r"\lt\cm\w")
-
-    def send_data_to_process(self, process, data):
-        print("sending: '{}'".format(data))
-        process.stdin.write(data.encode("utf-8"))
-        process.stdin.flush()
-        time.sleep(0.1)
-        return ZGameModule.read_stdout_from_process(process)
+    def new_session(self, room_id, game_id):
+        if self.daemon is not None:
+            return RemoteFrotzSession(
+                self.daemon,
+                self.games[game_id],
+                room_id,
+                round_trips=self.round_trips,
+            )
 
-    def get_session_file(self, room_id, game_id):
-        file_path = os.path.join(
-            self.session_dir, ZGameModule.escape_room_id(room_id), game_id
+        return FrotzSession(
+            self.executable,
+            self.games[game_id],
+            room_id,
+            read_timeout=self.read_timeout,
+            round_trips=self.round_trips,
         )
-        os.makedirs(os.path.abspath(os.path.join(file_path, os.pardir)), exist_ok=True)
-        return file_path
-
-    def save_game(self, process, room_id, game_id):
-        self.sessions[room_id] = game_id
-        session_file = self.get_session_file(room_id, game_id)
 
-        temp_file = ZGameModule.get_temporary_filename()
-        payload = "save\n{}\n".format(temp_file)
-        self.send_data_to_process(process, payload)
-        statinfo = os.stat(temp_file)
-        # only overwrite old file if the save didn't fail
-        if statinfo.st_size != 0:
-            shutil.move(temp_file, session_file)
-
-        self.save_sessions()
-
-    def restore_game(self, process, room_id, game_id):
-        session_file = self.get_session_file(room_id, game_id)
-        if not os.path.exists(session_file):
+    async def attach_session(self, room_id, game_id):
+        """Return the daemon's interpreter still running the game, if any"""
+        if self.daemon is None:
             return None
 
-        temp_file = ZGameModule.get_temporary_filename()
-        shutil.copy(session_file, temp_file)
-        self.send_data_to_process(process, "restore\n")
-        return self.send_data_to_process(process, temp_file + "\n")
-
-    def load_game(self, process, room_id, game_id, filename):
-        saved_file = os.path.join(
-            self.save_dir, ZGameModule.escape_room_id(room_id), game_id, filename
-        )
+        session = self.new_session(room_id, game_id)
+        if not await session.attach():
+            return None
 
-        temp_file = ZGameModule.get_temporary_filename()
-        shutil.copy(saved_file, temp_file)
-        payload = "restore\n{}\n".format(temp_file)
+        await self.live_sessions.add(session)
+        return session
 
-        return self.send_data_to_process(process, payload)
+    async def start_session(self, room_id, game_id):
+        session = self.new_session(room_id, game_id)
+        await self.live_sessions.add(session)
+        await session.start()
+        data = await session.send_prefix()
+        return data, session
 
-    def get_sessions_manifest_file(self):
-        return os.path.join(self.session_dir, "sessions")
+    async def save_game(self, session):
+        temp_file = self.get_scratch_filename()
+        try:
+            await session.save(temp_file)
+            # only overwrite the old session if the save didn't fail
+            if os.path.exists(temp_file) and os.stat(temp_file).st_size != 0:
+                with open(temp_file, "rb") as f:
+                    self.snapshots.put(
+                        ZGameModule.escape_room_id(session.room_id),
+                        session.game_id,
+                        f.read(),
+                    )
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+    async def restore_game(self, session):
+        return await self.load_game(session, SavegameStore.SESSION)
+
+    async def load_game(self, session, name):
+        escaped_room_id = ZGameModule.escape_room_id(session.room_id)
+        if name == SavegameStore.SESSION:
+            data = self.snapshots.get(escaped_room_id, session.game_id)
+        else:
+            data = self.savegames.get(escaped_room_id, session.game_id, name)
 
-    def save_sessions(self):
-        with open(self.get_sessions_manifest_file(), "w") as f:
-            json.dump(self.sessions, f)
+        if data is None:
+            return None
 
-    def load_sessions(self):
-        file_path = self.get_sessions_manifest_file()
-        if not os.path.exists(file_path):
-            self.sessions = {}
-            return
+        temp_file = self.get_scratch_filename()
+        with open(temp_file, "wb") as f:
+            f.write(data)
 
-        with open(file_path, "r") as f:
-            self.sessions = json.load(f)
+        try:
+            return await session.restore(temp_file)
+        finally:
+            os.remove(temp_file)
 
-    def quit_game(self, process):
-        process.kill()
+    def set_session(self, room_id, game_id):
+        self.sessions[room_id] = game_id
+        self.state.set_session(room_id, game_id)
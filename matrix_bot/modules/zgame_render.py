@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+import re
+
+# the status line is separated from the score/time by a run of spaces
+STATUS_LINE_RE = re.compile("    +")
+MARKUP_RE = re.compile(r"</?[bi]>")
+TAG_RE = re.compile("<[^<]+?>")
+# the interpreter's <b> and <i> markup is passed through, everything else that
+# isn't plain ASCII is escaped the way libxml2 serializes HTML
+ATTRIBUTE_ESCAPE_RE = re.compile(r'</?[bi]>|&(?!\{)|["<>]|[^\x00-\x7f]')
+SINGLE_QUOTED_ATTRIBUTE_ESCAPE_RE = re.compile(r"</?[bi]>|&(?!\{)|[<>]|[^\x00-\x7f]")
+NON_ASCII_RE = re.compile(r"[^\x00-\x7f]")
+INVALID_CHARS_RE = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]")
+ESCAPES = {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;"}
+ESCAPED_MARKUP = [
+    ("&lt;" + tag[1:-1] + "&gt;", tag) for tag in ("<i>", "</i>", "<b>", "</b>")
+]
+
+
+def escape_match(match):
+    s = match.group()
+    escaped = ESCAPES.get(s)
+    if escaped is not None:
+        return escaped
+
+    if len(s) > 1:
+        # <b>, </i>, ...
+        return s
+
+    return "&#{};".format(ord(s))
+
+
+def check_text(text):
+    if INVALID_CHARS_RE.search(text):
+        raise ValueError(
+            "All strings must be XML compatible: Unicode or ASCII, no NULL bytes or"
+            " control characters"
+        )
+
+
+def escape_text(text):
+    """Return the escaped text for the html and for the body"""
+    check_text(text)
+    # plain replaces are a lot faster than a regex calling back for every
+    # match, and most lines have a few non-breaking spaces
+    html = text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    if not html.isascii():
+        html = html.replace("\xa0", "&#160;")
+        if not html.isascii():
+            html = NON_ASCII_RE.sub(escape_match, html)
+
+    if "<" not in text:
+        return html, html
+
+    body = html
+    for escaped, tag in ESCAPED_MARKUP:
+        html = html.replace(escaped, tag)
+        body = body.replace(escaped, "")
+
+    return html, body
+
+
+def render_title(title):
+    # values with double quotes are put into single quotes instead, unless
+    # they contain both
+    if '"' in title and "'" not in title:
+        return " title='{}'".format(
+            SINGLE_QUOTED_ATTRIBUTE_ESCAPE_RE.sub(escape_match, title)
+        )
+
+    return ' title="{}"'.format(ATTRIBUTE_ESCAPE_RE.sub(escape_match, title))
+
+
+def render_div(css_class, text):
+    html, body = escape_text(text)
+    return '<div class="{}">{}</div>'.format(css_class, html), body
+
+
+def render_paragraph(title, text, tails):
+    if tails and not tails[-1]:
+        # a trailing line break would only add space
+        tails.pop()
+
+    html = ["<p>" if title is None else "<p{}>".format(render_title(title))]
+
+    body = []
+    if text:
+        text_html, text_body = escape_text(text)
+        html.append(text_html)
+        body.append(text_body)
+
+    for tail in tails:
+        html.append("<br>")
+        if tail:
+            tail_html, tail_body = escape_text(tail)
+            html.append(tail_html)
+            body.append(tail_body)
+
+    html.append("</p>")
+    return "".join(html), "".join(body)
+
+
+def render_output(data, status_line):
+    """Turn interpreter output into the html and body of a message
+
+    The status line at the top becomes location and score divs, which are
+    only included if they differ from what `status_line` says was shown last;
+    `status_line` is updated. The rest becomes paragraphs, short lines keep
+    their line breaks. The html is exactly what the lxml tree this replaces
+    used to serialize to, pretty printed, and the body is the html without
+    its tags. Returns (html, body).
+    """
+    data = data.rstrip("> \n\r")
+    data = data.replace("</i><i>", "")
+    data = data.replace("</b><b>", "")
+    lines = data.split("\n")
+
+    # rendered (html, body) of the status divs and [title, text, tails] of
+    # the paragraphs, tails are the lines following each line break
+    blocks = []
+    main_title = None
+
+    first_line_chunks = STATUS_LINE_RE.split(lines[0], 1)
+    if len(first_line_chunks) > 1:
+        lines.pop(0)
+        location, score = first_line_chunks
+        location = location.strip()
+        location_full = location
+        score = score.strip()
+
+        # Make It Good uses " - ..." on the second line as extension of the
+        # location in the status line
+        if lines:
+            line = lines[0].strip()
+            if line.startswith("- "):
+                lines.pop(0)
+                location_full = location + " (" + line[2:] + ")"
+
+        if location_full != status_line.get("location", ""):
+            blocks.append(render_div("location", location_full))
+
+        if score != status_line.get("score", ""):
+            blocks.append(render_div("score", score))
+    else:
+        location = None
+        location_full = None
+        score = None
+
+    status_line["location"] = location_full
+    status_line["score"] = score
+
+    base_leading_spaces = min(
+        len(s) - len(s.lstrip(" ")) for s in lines if s.strip(". ")
+    )
+    base_indent = " " * base_leading_spaces
+
+    paragraph = None
+    for raw_line in lines:
+        line = raw_line.strip()
+        if line == ".":
+            line = ""
+
+        if location:
+            line_without_tags = MARKUP_RE.sub("", line) if "<" in line else line
+            if line_without_tags.startswith(location):
+                continue
+
+        if line.startswith("[") and line.endswith("]"):
+            check_text(line)
+            if paragraph is None:
+                main_title = line
+            else:
+                paragraph[0] = line
+            continue
+
+        if paragraph is None and not line:
+            continue
+
+        if paragraph is None or not line:
+            paragraph = [None, None, []]
+            blocks.append(paragraph)
+
+        fixed_line = raw_line
+        if base_leading_spaces > 0 and fixed_line.startswith(base_indent):
+            fixed_line = fixed_line[base_leading_spaces:]
+
+        fixed_line = fixed_line.replace("  ", "\xa0 ")
+
+        tails = paragraph[2]
+        if tails:
+            tails[-1] = tails[-1] + "\n" + fixed_line if tails[-1] else fixed_line
+        else:
+            text = paragraph[1]
+            paragraph[1] = text + "\n" + fixed_line if text else fixed_line
+
+        if fixed_line and len(fixed_line) < 50:
+            tails.append(None)
+
+    rendered = [
+        block if type(block) is tuple else render_paragraph(*block) for block in blocks
+    ]
+
+    start_tag = (
+        "<div>" if main_title is None else "<div{}>".format(render_title(main_title))
+    )
+
+    # libxml2 only puts block elements on their own lines if there are several
+    if len(rendered) > 1:
+        html = "{}\n{}\n</div>\n".format(
+            start_tag, "\n".join(html for html, body in rendered)
+        )
+        body = "\n{}\n\n".format("\n".join(body for html, body in rendered))
+    else:
+        html = "{}{}</div>\n".format(
+            start_tag, "".join(html for html, body in rendered)
+        )
+        body = "".join(body for html, body in rendered) + "\n"
+
+    titles = [main_title] + [block[0] for block in blocks if type(block) is list]
+    if any(title and MARKUP_RE.search(title) for title in titles):
+        # markup in a title ends up inside a tag, strip the tags like the
+        # body always was
+        body = TAG_RE.sub("", html)
+
+    return html, body
+
+
+def render_output_detached(data, status_line):
+    """render_output for running in another process, which can't update the
+    caller's `status_line`
+
+    Returns (html, body, status_line). A ValueError has the updated
+    status_line as its status_line attribute.
+    """
+    try:
+        html, body = render_output(data, status_line)
+    except ValueError as e:
+        e.status_line = status_line
+        raise
+
+    return html, body, status_line
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import json
+import os
+import sqlite3
+
+
+class ZGameState:
+    """Per room state of the zgame module, kept in SQLite
+
+    Stores which game is played in which room, who has direct mode enabled
+    and the last status line that was shown. Every change is a single row
+    write, the database runs in WAL mode so these stay cheap no matter how
+    many rooms there are.
+    """
+
+    def __init__(self, path):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                room_id TEXT PRIMARY KEY,
+                game_id TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS direct_mode (
+                room_id TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                PRIMARY KEY (room_id, user_id)
+            );
+            CREATE TABLE IF NOT EXISTS status_lines (
+                room_id TEXT PRIMARY KEY,
+                location TEXT,
+                score TEXT
+            );
+            """
+        )
+
+    def migrate_sessions_manifest(self, manifest_file):
+        """Import the JSON manifest older versions wrote, then move it aside"""
+        if not os.path.exists(manifest_file):
+            return
+
+        with open(manifest_file, "r") as f:
+            sessions = json.load(f)
+
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO sessions (room_id, game_id) VALUES (?, ?)",
+                sessions.items(),
+            )
+
+        os.replace(manifest_file, manifest_file + ".migrated")
+
+    def get_sessions(self):
+        """Return a dict of room_id -> game_id"""
+        return dict(self.db.execute("SELECT room_id, game_id FROM sessions"))
+
+    def set_session(self, room_id, game_id):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO sessions (room_id, game_id) VALUES (?, ?)",
+                (room_id, game_id),
+            )
+
+    def get_direct_mode(self):
+        """Return a dict of room_id -> set of user_ids"""
+        direct_mode = {}
+        for room_id, user_id in self.db.execute(
+            "SELECT room_id, user_id FROM direct_mode"
+        ):
+            direct_mode.setdefault(room_id, set()).add(user_id)
+
+        return direct_mode
+
+    def set_direct_mode(self, room_id, user_id, enabled):
+        with self.db:
+            if enabled:
+                self.db.execute(
+                    "INSERT OR IGNORE INTO direct_mode (room_id, user_id)"
+                    " VALUES (?, ?)",
+                    (room_id, user_id),
+                )
+            else:
+                self.db.execute(
+                    "DELETE FROM direct_mode WHERE room_id = ? AND user_id = ?",
+                    (room_id, user_id),
+                )
+
+    def get_status_lines(self):
+        """Return a dict of room_id -> {"location": ..., "score": ...}"""
+        return {
+            room_id: dict(location=location, score=score)
+            for room_id, location, score in self.db.execute(
+                "SELECT room_id, location, score FROM status_lines"
+            )
+        }
+
+    def set_status_line(self, room_id, location, score):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO status_lines (room_id, location, score)"
+                " VALUES (?, ?, ?)",
+                (room_id, location, score),
+            )
+
+    def close(self):
+        self.db.close()
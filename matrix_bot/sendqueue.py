@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+import asyncio
+import time
+
+from aiohttp import ClientConnectionError
+from nio import ErrorResponse
+
+
+class RateLimiter:
+    """Token bucket allowing `rate` requests per second and bursts of `burst`
+
+    `pause` stops handing out tokens for a while, e.g. when the server asked
+    us to back off.
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+        self.paused_until = 0
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, self.clock() + seconds)
+        self.tokens = 0
+
+    def get_wait_time(self):
+        """Take a token and return 0 or return how long to wait for one"""
+        now = self.clock()
+        if now < self.paused_until:
+            return self.paused_until - now
+
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while True:
+            wait_time = self.get_wait_time()
+            if not wait_time:
+                return
+
+            await asyncio.sleep(wait_time)
+
+
+class SendQueue:
+    """Paces requests to the homeserver and retries them when throttled
+
+    Messages go through one queue per room, so they arrive in order, while
+    different rooms send concurrently. All requests share one rate limiter,
+    since homeservers limit per user. When the server answers with
+    M_LIMIT_EXCEEDED the limiter pauses for the `retry_after_ms` it asked
+    for; connection errors and timeouts are retried with exponential backoff.
+    """
+
+    def __init__(self, rate=5, burst=10, max_retries=5, backoff=1):
+        self.limiter = RateLimiter(rate, burst)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        # room_id -> asyncio.Queue of (request, future)
+        self.queues = {}
+        self.workers = {}
+
+    @staticmethod
+    def create(config):
+        return SendQueue(
+            rate=float(config.get("send_rate", "5")),
+            burst=int(config.get("send_burst", "10")),
+            max_retries=int(config.get("send_max_retries", "5")),
+            backoff=float(config.get("send_backoff", "1")),
+        )
+
+    async def call(self, request):
+        """Await `request()` once the limiter allows it, retrying if needed
+
+        Returns the last response, error responses other than rate limits are
+        returned right away.
+        """
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            await self.limiter.acquire()
+            try:
+                response = await request()
+            except (ClientConnectionError, asyncio.TimeoutError) as e:
+                if last_attempt:
+                    raise
+
+                print("request failed ({!r}), retrying".format(e))
+                await asyncio.sleep(self.backoff * 2**attempt)
+                continue
+
+            if (
+                isinstance(response, ErrorResponse)
+                and response.status_code == "M_LIMIT_EXCEEDED"
+                and not last_attempt
+            ):
+                retry_after = (response.retry_after_ms or 0) / 1000
+                self.limiter.pause(retry_after or self.backoff * 2**attempt)
+                continue
+
+            return response
+
+    async def send(self, room_id, request):
+        """Like `call`, but in order with the other requests for the room"""
+        future = asyncio.get_running_loop().create_future()
+        queue = self.queues.get(room_id)
+        if queue is None:
+            queue = self.queues[room_id] = asyncio.Queue()
+
+        queue.put_nowait((request, future))
+        if room_id not in self.workers:
+            self.workers[room_id] = asyncio.create_task(self.work(room_id))
+
+        return await future
+
+    async def work(self, room_id):
+        queue = self.queues[room_id]
+        try:
+            while not queue.empty():
+                request, future = queue.get_nowait()
+                try:
+                    response = await self.call(request)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(response)
+
+        finally:
+            # idle rooms don't keep a worker around
+            del self.workers[room_id]
+            del self.queues[room_id]
+            while not queue.empty():
+                request, future = queue.get_nowait()
+                future.cancel()
+
+    async def stop(self):
+        workers = list(self.workers.values())
+        for worker in workers:
+            worker.cancel()
+
+        await asyncio.gather(*workers, return_exceptions=True)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+import asyncio
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one
+
+    The first call for a key runs, calls made while it's running wait for
+    it and get the same result or exception. They share the result object,
+    so it must not be changed. A waiter being cancelled doesn't cancel the
+    call for the others. If a counter is given, it's incremented for every
+    call that was coalesced.
+    """
+
+    def __init__(self, coalesced=None):
+        self.coalesced = coalesced
+        # key -> future of the running call
+        self.calls = {}
+
+    def __len__(self):
+        return len(self.calls)
+
+    async def run(self, key, func, *args):
+        """Return the result of `await func(*args)`, unless a call for `key`
+        is running, then return its result"""
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args))
+            self.calls[key] = future
+            future.add_done_callback(lambda f: self.forget(key, f))
+        elif self.coalesced is not None:
+            self.coalesced.inc()
+
+        return await asyncio.shield(future)
+
+    def forget(self, key, future):
+        if self.calls.get(key) is future:
+            del self.calls[key]
+
+        if not future.cancelled():
+            # don't warn about errors nobody waited for
+            future.exception()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+import copy
+import json
+import os
+
+from nio import UploadFilterResponse
+
+
+class SyncFilter:
+    """Server side filter for /sync that only asks for what the bot handles
+
+    Rooms only send their m.room.message timeline, presence, receipts,
+    typing notifications and account data are left out and members are lazy
+    loaded, i.e. only those that sent one of the messages are included.
+    Invites aren't affected by the filter. In lean mode no member events are
+    requested at all, so no member lists are kept.
+
+    The filter is uploaded once and its ID is kept in `path`, it's uploaded
+    again if the filter or the user changes.
+    """
+
+    def __init__(self, path, lean=False):
+        self.path = path
+        self.lean = lean
+
+    @staticmethod
+    def create(config):
+        """Return a SyncFilter or None if the filter is disabled"""
+        if config.get("sync_filter", "true").lower() != "true":
+            return None
+
+        path = config.get("sync_filter_file")
+        if not path:
+            path = os.path.join(config.get("store_path", "."), "sync_filter.json")
+
+        return SyncFilter(path, lean=config.get("lean_sync", "").lower() == "true")
+
+    def get_filter(self):
+        if self.lean:
+            state = {"not_types": ["m.room.member"]}
+        else:
+            state = {"lazy_load_members": True}
+
+        return dict(
+            presence={"types": []},
+            account_data={"types": []},
+            room=dict(
+                timeline={"types": ["m.room.message"]},
+                state=state,
+                ephemeral={"types": []},
+                account_data={"types": []},
+            ),
+        )
+
+    def load(self, user_id, sync_filter):
+        try:
+            with open(self.path) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if stored.get("user_id") != user_id or stored.get("filter") != sync_filter:
+            return None
+
+        return stored.get("filter_id")
+
+    def save(self, user_id, sync_filter, filter_id):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temp_file = self.path + ".tmp"
+        with open(temp_file, "w") as f:
+            json.dump(dict(user_id=user_id, filter=sync_filter, filter_id=filter_id), f)
+
+        os.replace(temp_file, self.path)
+
+    async def get_filter_id(self, client):
+        """Return the ID of the filter for `client`'s user, uploading it if
+        needed, or the filter itself if the upload failed"""
+        sync_filter = self.get_filter()
+        filter_id = self.load(client.user_id, sync_filter)
+        if filter_id is not None:
+            return filter_id
+
+        response = await client.upload_filter(**sync_filter)
+        if not isinstance(response, UploadFilterResponse):
+            print("uploading the sync filter failed: {}".format(response))
+            return sync_filter
+
+        self.save(client.user_id, sync_filter, response.filter_id)
+        return response.filter_id
+
+
+def limit_timeline(sync_filter, limit):
+    """Return a copy of `sync_filter` with at most `limit` timeline events per
+    room"""
+    sync_filter = copy.deepcopy(sync_filter or {})
+    room = sync_filter.setdefault("room", {})
+    room.setdefault("timeline", {})["limit"] = limit
+    return sync_filter
+
+
+class SyncToken:
+    """Keeps the token of the last sync so syncing can continue from there
+    after a restart"""
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def create(config):
+        path = config.get("sync_token_file")
+        if not path:
+            path = os.path.join(config.get("store_path", "."), "sync_token")
+
+        return SyncToken(path)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def save(self, token):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temp_file = self.path + ".tmp"
+        with open(temp_file, "w") as f:
+            f.write(token)
+
+        os.replace(temp_file, self.path)
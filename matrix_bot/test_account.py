@@ -0,0 +1,193 @@
+import asyncio
+import configparser
+from unittest.mock import AsyncMock, Mock, patch
+
+import pytest
+from nio import AsyncClient
+
+from matrix_bot.account import get_account_configs
+from matrix_bot.core import MatrixBot
+
+
+def make_config(sections):
+    config = configparser.ConfigParser()
+    config.read_dict(sections)
+    return config
+
+
+def test_account_configs_single():
+    config = make_config({"main": {"user_id": "@bot:a", "store_path": "data"}})
+    assert get_account_configs(config) == [
+        ("main", {"user_id": "@bot:a", "store_path": "data"})
+    ]
+
+
+def test_account_configs_inherit_from_main():
+    config = make_config(
+        {
+            "main": {"base_url": "https://a", "store_path": "data"},
+            "main:one": {"user_id": "@one:a"},
+            "main:two": {"user_id": "@two:a", "store_path": "other"},
+        }
+    )
+    assert get_account_configs(config) == [
+        (
+            "one",
+            {"base_url": "https://a", "store_path": "data/one", "user_id": "@one:a"},
+        ),
+        ("two", {"base_url": "https://a", "store_path": "other", "user_id": "@two:a"}),
+    ]
+
+
+@pytest.fixture
+def bot(tmp_path):
+    config = make_config(
+        {
+            "main": {"user_id": "@main:a", "store_path": str(tmp_path)},
+            "main:second": {"user_id": "@second:a"},
+        }
+    )
+    bot = MatrixBot(config)
+    for account, rooms in zip(bot.accounts, [["!both:a"], ["!both:a", "!second:a"]]):
+        account.client = Mock(rooms={room_id: Mock() for room_id in rooms})
+        account.client.room_send = AsyncMock()
+        account.healthy = True
+
+    bot.event_queue.put = AsyncMock()
+    return bot
+
+
+def test_rooms_are_served_by_first_joined_account(bot):
+    main, second = bot.accounts
+    assert bot.get_account("!both:a") is main
+    assert bot.get_account("!second:a") is second
+
+    # rooms of an account that's restarting are taken over
+    main.healthy = False
+    assert bot.get_account("!both:a") is second
+
+
+@pytest.mark.asyncio
+async def test_messages_are_handled_once(bot):
+    main, second = bot.accounts
+    room = Mock(room_id="!both:a")
+    event = Mock(sender="@user:a", server_timestamp=1e15)
+
+    await bot.on_room_message(second, room, event)
+    bot.event_queue.put.assert_not_called()
+
+    await bot.on_room_message(main, room, event)
+    bot.event_queue.put.assert_called_once_with(room, event)
+
+    await bot.room_send(room, {"body": "hi"})
+    main.client.room_send.assert_called_once()
+    second.client.room_send.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_messages_of_own_accounts_are_ignored(bot):
+    event = Mock(sender="@second:a", server_timestamp=1e15)
+    await bot.on_room_message(bot.accounts[0], Mock(room_id="!both:a"), event)
+    bot.event_queue.put.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_failed_sync_restarts_only_that_account(bot):
+    main, second = bot.accounts
+    main.sync_filter = None
+    main.login = AsyncMock(return_value=True)
+    main.client.synced = asyncio.Event()
+    main.client.sync_forever = AsyncMock(
+        side_effect=[Exception("boom"), Exception("boom"), asyncio.CancelledError()]
+    )
+
+    with patch("matrix_bot.account.asyncio.sleep", AsyncMock()) as sleep:
+        with pytest.raises(asyncio.CancelledError):
+            await main.run()
+
+    assert [c.args[0] for c in sleep.call_args_list] == [1, 2]
+    assert not main.healthy
+    assert second.healthy
+    assert 'matrix_bot_account_restarts_total{account="main"} 2' in (
+        bot.metrics.render()
+    )
+
+
+@pytest.mark.asyncio
+async def test_failed_login_is_retried(bot):
+    main = bot.accounts[0]
+    main.client = None
+    main.sync_filter = None
+    client = Mock(logged_in=True, synced=asyncio.Event())
+    client.sync_forever = AsyncMock(side_effect=asyncio.CancelledError())
+
+    async def login():
+        if main.login.call_count == 1:
+            raise OSError("unreachable")
+
+        main.client = client
+        return True
+
+    main.login = AsyncMock(side_effect=login)
+    with patch("matrix_bot.account.asyncio.sleep", AsyncMock()) as sleep:
+        with pytest.raises(asyncio.CancelledError):
+            await main.run()
+
+    assert main.login.call_count == 2
+    assert [c.args[0] for c in sleep.call_args_list] == [1]
+    client.sync_forever.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_events_of_the_first_sync_are_handled(bot):
+    main, second = bot.accounts
+    main.healthy = second.healthy = False
+
+    # nothing synced yet, the first events of an account mark it as healthy
+    event = Mock(sender="@user:a", server_timestamp=1e15)
+    await second.on_room_message(Mock(room_id="!second:a"), event)
+    bot.event_queue.put.assert_called_once()
+
+    # an event of a shared room, picked up by both while they start
+    event = Mock(sender="@user:a", server_timestamp=1e15)
+    await second.on_room_message(Mock(room_id="!both:a"), event)
+    await main.on_room_message(Mock(room_id="!both:a"), event)
+    assert bot.event_queue.put.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_login_creates_client(tmp_path):
+    config = make_config(
+        {
+            "main": {
+                "base_url": "https://a",
+                "user_id": "@main:a",
+                "password": "secret",
+                "device_id": "DEVICE",
+                "device_name": "bot",
+                "store_path": str(tmp_path),
+            }
+        }
+    )
+    account = MatrixBot(config).accounts[0]
+
+    async def login(client, password, device_name=None):
+        assert (password, device_name) == ("secret", "bot")
+        client.access_token = "token"
+
+    with patch.object(AsyncClient, "login", login):
+        assert await account.login()
+
+    assert account.client.config.max_limit_exceeded == 0
+    assert account.client.config.store_sync_tokens
+    await account.close()
+
+
+@pytest.mark.asyncio
+async def test_invites_are_accepted(bot):
+    main, unused_second = bot.accounts
+    main.client.join = AsyncMock()
+
+    await main.on_invite(Mock(room_id="!new:a"), Mock())
+
+    main.client.join.assert_awaited_once_with("!new:a")
@@ -0,0 +1,45 @@
+from matrix_bot.cache import TTLCache, normalize_query
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_normalize_query():
+    assert normalize_query("  Happy   CAT ") == "happy cat"
+
+
+def test_ttl_cache_expires_entries():
+    clock = FakeClock()
+    cache = TTLCache(max_entries=10, ttl=60, clock=clock)
+    cache.set("cat", [1, 2, 3])
+
+    clock.now = 59
+    assert cache.get("cat") == [1, 2, 3]
+
+    clock.now = 60
+    assert cache.get("cat") is None
+    assert len(cache) == 0
+
+
+def test_ttl_cache_drops_least_recently_used():
+    cache = TTLCache(max_entries=2, ttl=60, clock=FakeClock())
+    cache.set("cat", 1)
+    cache.set("dog", 2)
+    cache.get("cat")
+    cache.set("yes", 3)
+
+    assert "cat" in cache
+    assert "dog" not in cache
+    assert "yes" in cache
+
+
+def test_ttl_cache_can_be_disabled():
+    cache = TTLCache(max_entries=0, ttl=60, clock=FakeClock())
+    cache.set("cat", 1)
+
+    assert cache.get("cat") is None
@@ -0,0 +1,200 @@
+import asyncio
+from unittest.mock import Mock
+
+import pytest
+
+from matrix_bot.core import CommandRouter, RoomEventQueue
+from matrix_bot.modules.base import MatrixBotModule, arg
+
+
+class RouterTestModule(MatrixBotModule):
+    def register_commands(self):
+        self.add_command("!hello", "!hi", callback=self.hello, help="say hello")
+        self.add_command(
+            "!echo",
+            arg("text", self.validate, multi_word=True),
+            callback=self.echo,
+            help="echo {arg1}",
+        )
+        self.add_command(
+            "\\",
+            arg("command", self.validate),
+            callback=self.game,
+            prefix=True,
+            help="talk to the game",
+        )
+        self.add_command(
+            "\\\\",
+            arg("command", self.validate),
+            callback=self.meta,
+            prefix=True,
+            help="talk to the interpreter",
+        )
+
+    def validate(self, value):
+        pass
+
+    async def hello(self, **kwargs):
+        pass
+
+    async def echo(self, **kwargs):
+        pass
+
+    async def game(self, **kwargs):
+        pass
+
+    async def meta(self, **kwargs):
+        pass
+
+
+@pytest.fixture
+def router():
+    return CommandRouter([RouterTestModule({})])
+
+
+def test_router_matches_aliases_case_insensitively(router):
+    command, args = router.match("  !HI there ")
+    assert command.aliases == ["!hello", "!hi"]
+    assert args == ["there"]
+
+
+def test_router_matches_multi_word_arguments(router):
+    command, args = router.match("!echo one  two")
+    assert command.aliases == ["!echo"]
+    assert command.parse_arguments(args) == {"text": "one two"}
+
+
+def test_router_matches_longest_prefix(router):
+    command, args = router.match("\\look around")
+    assert command.aliases == ["\\"]
+    assert args == "look around"
+
+    command, args = router.match("\\\\restart")
+    assert command.aliases == ["\\\\"]
+    assert args == "restart"
+
+
+def test_router_rejects_unknown_messages(router):
+    assert router.match("hello there") is None
+    assert router.match("!unknown command") is None
+    assert router.match("") is None
+    assert router.match("   ") is None
+
+
+def make_room(room_id):
+    room = Mock()
+    room.room_id = room_id
+    return room
+
+
+@pytest.mark.asyncio
+async def test_room_event_queue_keeps_order_within_room():
+    handled = []
+
+    async def handler(room, event):
+        # later events finish faster, order must still be kept
+        await asyncio.sleep(0.01 / event)
+        handled.append(event)
+
+    queue = RoomEventQueue(handler, workers=4, max_pending=10)
+    queue.start()
+    room = make_room("!a:x")
+    for event in range(1, 6):
+        await queue.put(room, event)
+
+    await queue.join()
+    await queue.stop()
+
+    assert handled == [1, 2, 3, 4, 5]
+
+
+@pytest.mark.asyncio
+async def test_room_event_queue_runs_rooms_in_parallel():
+    blocker = asyncio.Event()
+    handled = []
+
+    async def handler(room, event):
+        if room.room_id == "!slow:x":
+            await blocker.wait()
+
+        handled.append(event)
+        if room.room_id == "!fast:x":
+            blocker.set()
+
+    queue = RoomEventQueue(handler, workers=2, max_pending=10)
+    queue.start()
+    await queue.put(make_room("!slow:x"), "slow")
+    await queue.put(make_room("!fast:x"), "fast")
+
+    await asyncio.wait_for(queue.join(), 1)
+    await queue.stop()
+
+    assert handled == ["fast", "slow"]
+
+
+@pytest.mark.asyncio
+async def test_room_event_queue_survives_handler_errors():
+    handled = []
+
+    async def handler(room, event):
+        if event == "bad":
+            raise Exception("boom")
+
+        handled.append(event)
+
+    queue = RoomEventQueue(handler, workers=1, max_pending=10)
+    queue.start()
+    room = make_room("!a:x")
+    await queue.put(room, "bad")
+    await queue.put(room, "good")
+
+    await queue.join()
+    await queue.stop()
+
+    assert handled == ["good"]
+
+
+@pytest.mark.asyncio
+async def test_room_event_queue_stop_finishes_running_handlers():
+    started = asyncio.Event()
+    handled = []
+
+    async def handler(room, event):
+        started.set()
+        await asyncio.sleep(0.05)
+        handled.append(event)
+
+    queue = RoomEventQueue(handler, workers=2, max_pending=10)
+    queue.start()
+    room = make_room("!a:x")
+    await queue.put(room, "running")
+    await queue.put(room, "queued")
+    await started.wait()
+
+    await queue.stop(timeout=1)
+
+    assert handled == ["running"]
+    assert queue.tasks == []
+
+
+@pytest.mark.asyncio
+async def test_room_event_queue_stop_cancels_stuck_handlers():
+    started = asyncio.Event()
+    cancelled = []
+
+    async def handler(room, event):
+        started.set()
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(event)
+            raise
+
+    queue = RoomEventQueue(handler, workers=1, max_pending=10)
+    queue.start()
+    await queue.put(make_room("!a:x"), "stuck")
+    await started.wait()
+
+    await asyncio.wait_for(queue.stop(timeout=0.05), 1)
+
+    assert cancelled == ["stuck"]
@@ -0,0 +1,48 @@
+import json
+import os
+
+import pytest
+
+from matrix_bot.cpupool import CpuPool
+from matrix_bot.metrics import MetricsRegistry
+from matrix_bot.modules.zgame_render import render_output_detached
+
+
+@pytest.mark.asyncio
+async def test_cpu_pool_runs_inline_without_workers():
+    pool = CpuPool(workers=0)
+    assert await pool.run(os.getpid) == os.getpid()
+    assert pool.executor is None
+
+
+@pytest.mark.asyncio
+async def test_cpu_pool_runs_small_inputs_inline():
+    metrics = MetricsRegistry()
+    pool = CpuPool(workers=1, min_size=100, metrics=metrics)
+    assert await pool.run(json.loads, b"[1]", size=3) == [1]
+    assert pool.executor is None
+    assert (
+        'matrix_bot_cpu_task_seconds_count{task="loads",offloaded="false"} 1'
+        in metrics.render()
+    )
+
+
+@pytest.mark.asyncio
+async def test_cpu_pool_offloads_to_worker_process():
+    pool = CpuPool(workers=1, min_size=100)
+    try:
+        assert await pool.run(os.getpid) != os.getpid()
+
+        status_line = {}
+        html, body, status_line = await pool.run(
+            render_output_detached, "Kitchen    Score: 1\n\nA table.\n>", status_line
+        )
+        assert status_line == {"location": "Kitchen", "score": "Score: 1"}
+
+        with pytest.raises(ValueError) as e:
+            await pool.run(render_output_detached, "Hall    Score: 2\n\x01\n>", {})
+
+        # the status line is updated even though the output was invalid
+        assert e.value.status_line == {"location": "Hall", "score": "Score: 2"}
+    finally:
+        pool.close()
@@ -0,0 +1,108 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from matrix_bot.httpclient import HttpClient
+
+
+@asynccontextmanager
+async def serve(timeout=5):
+    async def search(request):
+        return web.json_response({"q": request.query["q"]})
+
+    async def image(request):
+        return web.Response(body=b"GIF89a", content_type="image/gif")
+
+    async def missing(request):
+        raise web.HTTPNotFound()
+
+    async def slow(request):
+        response = web.StreamResponse(headers={"Content-Type": "image/gif"})
+        await response.prepare(request)
+        for chunk in [b"GIF89a", b"1", b"2", b"3", b"4"]:
+            await response.write(chunk)
+            await asyncio.sleep(0.1)
+
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_get("/search", search)
+    app.router.add_get("/image.gif", image)
+    app.router.add_get("/missing", missing)
+    app.router.add_get("/slow.gif", slow)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    http = HttpClient(timeout=timeout, max_connections=4, max_connections_per_host=2)
+    try:
+        yield "http://127.0.0.1:{}".format(port), http
+    finally:
+        await http.close()
+        await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_http_client_get_json():
+    async with serve() as (url, http):
+        result = await http.get_json(url + "/search", params={"q": "cat"})
+
+    assert result == {"q": "cat"}
+
+
+@pytest.mark.asyncio
+async def test_http_client_get_bytes():
+    async with serve() as (url, http):
+        data, headers = await http.get_bytes(url + "/image.gif")
+
+    assert data == b"GIF89a"
+    assert headers["Content-Type"] == "image/gif"
+
+
+@pytest.mark.asyncio
+async def test_http_client_reuses_one_session():
+    async with serve() as (url, http):
+        session = http.session
+        await http.get_json(url + "/search", params={"q": "cat"})
+        await http.get_json(url + "/search", params={"q": "dog"})
+
+        assert http.session is session
+
+
+@pytest.mark.asyncio
+async def test_http_client_raises_on_error_status():
+    async with serve() as (url, http):
+        with pytest.raises(aiohttp.ClientResponseError):
+            await http.get_json(url + "/missing")
+
+
+@pytest.mark.asyncio
+async def test_http_client_streams_for_longer_than_the_timeout():
+    async with serve(timeout=0.3) as (url, http):
+        with pytest.raises(asyncio.TimeoutError):
+            await http.get_bytes(url + "/slow.gif")
+
+        async with http.stream(url + "/slow.gif") as response:
+            data = await response.read()
+
+    assert data == b"GIF89a1234"
+
+
+@pytest.mark.asyncio
+async def test_http_client_coalesces_identical_requests():
+    async with serve() as (url, http):
+        results = await asyncio.gather(
+            http.get_json(url + "/search", params={"q": "cat"}),
+            http.get_json(url + "/search", params={"q": "cat"}),
+            http.get_json(url + "/search", params={"q": "dog"}),
+        )
+
+        # the same object, only one request was made
+        assert results[0] is results[1]
+        assert results[2] == {"q": "dog"}
+        assert len(http.in_flight) == 0
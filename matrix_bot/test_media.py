@@ -0,0 +1,168 @@
+import asyncio
+import configparser
+from contextlib import asynccontextmanager
+from unittest.mock import AsyncMock, Mock
+
+import pytest
+from nio import UploadError, UploadResponse
+
+from matrix_bot.core import MatrixBot
+from matrix_bot.media import MediaCache, MediaError, StreamedBody
+
+
+class FakeContent:
+    def __init__(self, data):
+        self.data = data
+
+    async def iter_chunked(self, size):
+        for i in range(0, len(self.data), size):
+            yield self.data[i : i + size]
+
+
+class FakeHttp:
+    def __init__(self, data, content_type="image/gif", chunked=False):
+        self.data = data
+        self.content_type = content_type
+        self.chunked = chunked
+        self.downloads = 0
+
+    @asynccontextmanager
+    async def stream(self, url):
+        self.downloads += 1
+        response = Mock()
+        response.headers = {"Content-Type": self.content_type}
+        response.content_length = None if self.chunked else len(self.data)
+        response.content = FakeContent(self.data)
+        response.read = AsyncMock(return_value=self.data)
+        yield response
+
+
+@pytest.fixture
+def bot(tmp_path):
+    config = configparser.ConfigParser()
+    config.read_dict({"main": {"store_path": str(tmp_path)}})
+    bot = MatrixBot(config)
+    bot.uploaded = []
+
+    async def upload(data_provider, content_type, filesize):
+        data = b""
+        async for chunk in data_provider(0, 0):
+            data += chunk
+
+        bot.uploaded.append((data, content_type, filesize))
+        return UploadResponse("mxc://server/{}".format(len(bot.uploaded))), None
+
+    bot.accounts[0].client = Mock()
+    bot.accounts[0].client.upload = upload
+    bot.accounts[0].client.room_send = AsyncMock()
+    bot.http = FakeHttp(b"GIF89a" * 100000)
+    return bot
+
+
+def test_media_cache_lookups():
+    cache = MediaCache(":memory:")
+    cache.add("https://a/1.gif", "abc", "mxc://server/1", "image/gif", 6)
+    cache.add_url("https://b/1.gif", "abc")
+
+    assert cache.get_by_url("https://a/1.gif") == ("mxc://server/1", "image/gif", 6)
+    assert cache.get_by_url("https://b/1.gif") == ("mxc://server/1", "image/gif", 6)
+    assert cache.get_by_hash("abc") == ("mxc://server/1", "image/gif", 6)
+    assert cache.get_by_url("https://c/1.gif") is None
+
+
+def test_media_cache_is_persistent(tmp_path):
+    path = str(tmp_path / "media.db")
+    cache = MediaCache(path)
+    cache.add("https://a/1.gif", "abc", "mxc://server/1", "image/gif", 6)
+    cache.close()
+
+    cache = MediaCache(path)
+    assert cache.get_by_url("https://a/1.gif") == ("mxc://server/1", "image/gif", 6)
+
+
+@pytest.mark.asyncio
+async def test_send_remote_image_streams_download_into_upload(bot):
+    room = Mock(room_id="!a:x")
+    await bot.send_remote_image(room, "https://a/1.gif", "one", dict(w=1, h=2))
+
+    assert bot.uploaded == [(bot.http.data, "image/gif", 600000)]
+    content = bot.accounts[0].client.room_send.call_args.kwargs["content"]
+    assert content["url"] == "mxc://server/1"
+    assert content["info"] == dict(mimetype="image/gif", size=600000, w=1, h=2)
+
+
+@pytest.mark.asyncio
+async def test_send_remote_image_buffers_download_of_unknown_size(bot):
+    bot.http = FakeHttp(b"GIF89a" * 1000, chunked=True)
+    room = Mock(room_id="!a:x")
+    await bot.send_remote_image(room, "https://a/1.gif", "one")
+
+    assert bot.uploaded == [(bot.http.data, "image/gif", 6000)]
+    content = bot.accounts[0].client.room_send.call_args.kwargs["content"]
+    assert content["info"]["size"] == 6000
+
+
+@pytest.mark.asyncio
+async def test_send_remote_image_uploads_once_per_url(bot):
+    room = Mock(room_id="!a:x")
+    await bot.send_remote_image(room, "https://a/1.gif", "one")
+    await bot.send_remote_image(room, "https://a/1.gif", "one")
+
+    assert bot.http.downloads == 1
+    assert len(bot.uploaded) == 1
+
+
+@pytest.mark.asyncio
+async def test_send_remote_image_reuses_uri_for_known_content(bot):
+    await bot.upload_remote_media("https://a/1.gif")
+    content_uri, unused_mimetype, unused_size = await bot.upload_remote_media(
+        "https://b/1.gif"
+    )
+
+    assert content_uri == "mxc://server/1"
+    assert bot.media_cache.get_by_url("https://b/1.gif")[0] == "mxc://server/1"
+
+
+@pytest.mark.asyncio
+async def test_send_remote_image_raises_on_failed_upload(bot):
+    bot.accounts[0].client.upload = AsyncMock(
+        return_value=(UploadError("too big"), None)
+    )
+
+    with pytest.raises(MediaError):
+        await bot.upload_remote_media("https://a/1.gif")
+
+    assert bot.media_cache.get_by_url("https://a/1.gif") is None
+
+
+@pytest.mark.asyncio
+async def test_streamed_body_downloads_again_on_retry():
+    http = FakeHttp(b"GIF89a")
+    async with http.stream("https://a/1.gif") as response:
+        body = StreamedBody(http, "https://a/1.gif", response)
+        first = [chunk async for chunk in body(0, 0)]
+        retry = [chunk async for chunk in body(1, 0)]
+
+    assert first == retry == [b"GIF89a"]
+    assert http.downloads == 2
+    assert body.size == 6
+
+
+@pytest.mark.asyncio
+async def test_send_remote_image_coalesces_concurrent_uploads(bot):
+    upload = bot.accounts[0].client.upload
+
+    async def slow_upload(*args, **kwargs):
+        # let the other rooms ask for the same image meanwhile
+        await asyncio.sleep(0.01)
+        return await upload(*args, **kwargs)
+
+    bot.accounts[0].client.upload = slow_upload
+    rooms = [Mock(room_id="!{}:x".format(i)) for i in range(3)]
+    await asyncio.gather(
+        *(bot.send_remote_image(room, "https://a/1.gif", "one") for room in rooms)
+    )
+
+    assert bot.http.downloads == 1
+    assert len(bot.uploaded) == 1
+    assert bot.accounts[0].client.room_send.call_count == 3
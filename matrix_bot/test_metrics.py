@@ -0,0 +1,111 @@
+import configparser
+from unittest.mock import AsyncMock, Mock
+
+import pytest
+
+from matrix_bot.core import MatrixBot
+from matrix_bot.metrics import MetricsExporter, MetricsRegistry
+from matrix_bot.modules.base import MatrixBotModule, ValidationError, arg
+
+
+def test_counter_rendering():
+    registry = MetricsRegistry()
+    counter = registry.counter("things_total", "Number of things", ["kind"])
+    counter.labels(kind="a").inc()
+    counter.labels(kind="a").inc(2)
+    counter.labels(kind='b"c').inc()
+
+    assert registry.render() == (
+        "# HELP things_total Number of things\n"
+        "# TYPE things_total counter\n"
+        'things_total{kind="a"} 3\n'
+        'things_total{kind="b\\"c"} 1\n'
+    )
+
+
+def test_histogram_rendering():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("latency_seconds", "Latency", buckets=[0.1, 1])
+    histogram.labels().observe(0.05)
+    histogram.labels().observe(0.5)
+    histogram.labels().observe(5)
+
+    assert registry.render() == (
+        "# HELP latency_seconds Latency\n"
+        "# TYPE latency_seconds histogram\n"
+        'latency_seconds_bucket{le="0.1"} 1\n'
+        'latency_seconds_bucket{le="1"} 2\n'
+        'latency_seconds_bucket{le="+Inf"} 3\n'
+        "latency_seconds_sum 5.55\n"
+        "latency_seconds_count 3\n"
+    )
+
+
+def test_registry_returns_existing_metrics():
+    registry = MetricsRegistry()
+    counter = registry.counter("things_total", "Number of things")
+
+    assert registry.counter("things_total", "Number of things") is counter
+    with pytest.raises(ValueError):
+        registry.histogram("things_total", "Number of things")
+
+
+def test_exporter_writes_file(tmp_path):
+    registry = MetricsRegistry()
+    registry.counter("things_total", "Number of things").labels().inc()
+    path = str(tmp_path / "metrics.prom")
+    exporter = MetricsExporter(registry, file=path)
+
+    exporter.write_file()
+
+    with open(path) as f:
+        assert f.read() == registry.render()
+
+
+class MetricsTestModule(MatrixBotModule):
+    def register_commands(self):
+        self.add_command("!ok", callback=self.ok, help="works")
+        self.add_command(
+            "!strict", arg("number", self.validate_number), callback=self.ok, help="-"
+        )
+        self.add_command("!broken", callback=self.broken, help="fails")
+
+    def validate_number(self, value):
+        if not value.isdigit():
+            raise ValidationError("not a number")
+
+    async def ok(self, **kwargs):
+        pass
+
+    async def broken(self, **kwargs):
+        raise Exception("boom")
+
+
+@pytest.mark.asyncio
+async def test_bot_records_command_outcomes(tmp_path):
+    config = configparser.ConfigParser()
+    config.read_dict({"main": {"store_path": str(tmp_path)}})
+    bot = MatrixBot(config)
+    bot.accounts[0].client = Mock(room_send=AsyncMock())
+    bot.use_modules([MetricsTestModule({})])
+    room = Mock(room_id="!a:x")
+
+    for body in ["!ok", "!strict x", "!broken", "nothing"]:
+        event = Mock(source={"content": {"msgtype": "m.text", "body": body}})
+        await bot.handle_room_message(room, event)
+
+    text = bot.metrics.render()
+    for outcome, command in [
+        ("ok", "!ok"),
+        ("validation_error", "!strict"),
+        ("error", "!broken"),
+    ]:
+        assert (
+            'matrix_bot_commands_total{{module="MetricsTestModule",command="{}",'
+            'outcome="{}"}} 1'.format(command, outcome) in text
+        )
+
+    assert (
+        'matrix_bot_matrix_request_duration_seconds_count{account="main",request="room_send"}'
+        " 2" in text
+    )
@@ -0,0 +1,119 @@
+import asyncio
+import time
+
+import pytest
+from nio import RoomSendError, RoomSendResponse
+
+from matrix_bot.sendqueue import RateLimiter, SendQueue
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def ok():
+    return RoomSendResponse("$event", "!room:localhost")
+
+
+def test_rate_limiter_allows_bursts_then_paces():
+    clock = FakeClock()
+    limiter = RateLimiter(rate=2, burst=3, clock=clock)
+
+    assert [limiter.get_wait_time() for i in range(3)] == [0, 0, 0]
+    assert limiter.get_wait_time() == 0.5
+
+    clock.now = 0.5
+    assert limiter.get_wait_time() == 0
+
+
+def test_rate_limiter_pause():
+    clock = FakeClock()
+    limiter = RateLimiter(rate=100, burst=100, clock=clock)
+    limiter.pause(2)
+
+    clock.now = 1.5
+    assert limiter.get_wait_time() == 0.5
+
+
+@pytest.mark.asyncio
+async def test_send_queue_honours_retry_after():
+    responses = [
+        RoomSendError("slow down", "M_LIMIT_EXCEEDED", retry_after_ms=100),
+        ok(),
+    ]
+    calls = []
+
+    async def request():
+        calls.append(time.monotonic())
+        return responses.pop(0)
+
+    queue = SendQueue(rate=1000, burst=10, max_retries=3, backoff=0.001)
+    response = await queue.send("!room:localhost", request)
+
+    assert isinstance(response, RoomSendResponse)
+    assert len(calls) == 2
+    assert calls[1] - calls[0] >= 0.1
+
+
+@pytest.mark.asyncio
+async def test_send_queue_gives_up_after_max_retries():
+    calls = []
+
+    async def request():
+        calls.append(None)
+        raise asyncio.TimeoutError()
+
+    queue = SendQueue(rate=1000, burst=10, max_retries=2, backoff=0.001)
+    with pytest.raises(asyncio.TimeoutError):
+        await queue.send("!room:localhost", request)
+
+    assert len(calls) == 3
+    assert not queue.workers
+
+
+@pytest.mark.asyncio
+async def test_send_queue_does_not_retry_other_errors():
+    calls = []
+
+    async def request():
+        calls.append(None)
+        return RoomSendError("nope", "M_FORBIDDEN")
+
+    queue = SendQueue(rate=1000, burst=10, max_retries=2, backoff=0.001)
+    response = await queue.send("!room:localhost", request)
+
+    assert response.status_code == "M_FORBIDDEN"
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_send_queue_keeps_order_per_room_and_rooms_concurrent():
+    log = []
+    blocked = asyncio.Event()
+
+    def make_request(room, i):
+        async def request():
+            if room == "a" and i == 0:
+                # the slow room must not hold up room b
+                await blocked.wait()
+
+            log.append((room, i))
+            if room == "b":
+                blocked.set()
+
+            return ok()
+
+        return request
+
+    queue = SendQueue(rate=1000, burst=100)
+    await asyncio.gather(
+        *[queue.send(room, make_request(room, i)) for room in "ab" for i in range(3)]
+    )
+
+    assert [i for room, i in log if room == "a"] == [0, 1, 2]
+    assert [i for room, i in log if room == "b"] == [0, 1, 2]
+    assert log.index(("b", 0)) < log.index(("a", 0))
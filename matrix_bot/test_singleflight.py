@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+from matrix_bot.metrics import CounterValue
+from matrix_bot.singleflight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_single_flight_shares_result():
+    coalesced = CounterValue()
+    in_flight = SingleFlight(coalesced)
+    calls = []
+
+    async def fetch(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return [value]
+
+    results = await asyncio.gather(
+        *(in_flight.run("key", fetch, i) for i in range(3)),
+        in_flight.run("other", fetch, 9),
+    )
+
+    assert results == [[0], [0], [0], [9]]
+    assert calls == [0, 9]
+    assert coalesced.value == 2
+    assert len(in_flight) == 0
+
+    # calls after it finished run again
+    assert await in_flight.run("key", fetch, 5) == [5]
+
+
+@pytest.mark.asyncio
+async def test_single_flight_shares_errors():
+    in_flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("down")
+
+    results = await asyncio.gather(
+        in_flight.run("key", fail), in_flight.run("key", fail), return_exceptions=True
+    )
+    assert [type(r) for r in results] == [ValueError, ValueError]
+    assert len(in_flight) == 0
+
+
+@pytest.mark.asyncio
+async def test_single_flight_cancelled_waiter():
+    in_flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        return "done"
+
+    first = asyncio.create_task(in_flight.run("key", fetch))
+    second = asyncio.create_task(in_flight.run("key", fetch))
+    await asyncio.sleep(0)
+    first.cancel()
+
+    assert await second == "done"
@@ -0,0 +1,74 @@
+import json
+from unittest.mock import AsyncMock, Mock
+
+import pytest
+from nio import UploadFilterError, UploadFilterResponse
+
+from matrix_bot.sync import SyncFilter, SyncToken, limit_timeline
+
+
+def make_client(response):
+    return Mock(
+        user_id="@bot:localhost", upload_filter=AsyncMock(return_value=response)
+    )
+
+
+def test_sync_filter_create():
+    assert SyncFilter.create({"sync_filter": "false"}) is None
+
+    sync_filter = SyncFilter.create({"store_path": "data", "lean_sync": "True"})
+    assert sync_filter.path == "data/sync_filter.json"
+    assert sync_filter.lean
+
+
+def test_sync_filter_only_messages():
+    room = SyncFilter("unused").get_filter()["room"]
+    assert room["timeline"] == {"types": ["m.room.message"]}
+    assert room["state"] == {"lazy_load_members": True}
+    assert room["ephemeral"] == {"types": []}
+
+    room = SyncFilter("unused", lean=True).get_filter()["room"]
+    assert room["state"] == {"not_types": ["m.room.member"]}
+
+
+@pytest.mark.asyncio
+async def test_sync_filter_id_is_persisted(tmp_path):
+    path = str(tmp_path / "sync_filter.json")
+    client = make_client(UploadFilterResponse("filter1"))
+    assert await SyncFilter(path).get_filter_id(client) == "filter1"
+    assert await SyncFilter(path).get_filter_id(client) == "filter1"
+    client.upload_filter.assert_called_once()
+
+    # a different filter needs a new ID
+    client.upload_filter.return_value = UploadFilterResponse("filter2")
+    assert await SyncFilter(path, lean=True).get_filter_id(client) == "filter2"
+    with open(path) as f:
+        assert json.load(f)["filter_id"] == "filter2"
+
+
+@pytest.mark.asyncio
+async def test_sync_filter_upload_failed(tmp_path):
+    path = str(tmp_path / "sync_filter.json")
+    sync_filter = SyncFilter(path)
+    client = make_client(UploadFilterError("nope"))
+
+    # the filter is sent with every sync instead
+    assert await sync_filter.get_filter_id(client) == sync_filter.get_filter()
+    assert not (tmp_path / "sync_filter.json").exists()
+
+
+def test_limit_timeline():
+    sync_filter = SyncFilter("unused").get_filter()
+    limited = limit_timeline(sync_filter, 1)
+    assert limited["room"]["timeline"] == {"types": ["m.room.message"], "limit": 1}
+    assert "limit" not in sync_filter["room"]["timeline"]
+
+    assert limit_timeline(None, 1) == {"room": {"timeline": {"limit": 1}}}
+
+
+def test_sync_token(tmp_path):
+    sync_token = SyncToken.create({"store_path": str(tmp_path / "store")})
+    assert sync_token.load() is None
+
+    sync_token.save("s123_456")
+    assert SyncToken(str(tmp_path / "store" / "sync_token")).load() == "s123_456"
@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+import asyncio
+import configparser
+import logging
+
+from matrix_bot.modules.frotz_daemon import FrotzServer
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    config = configparser.ConfigParser()
+    config.read("config.cfg")
+
+    server = FrotzServer.create(config)
+    asyncio.run(server.serve(config["zgame"]["daemon_address"]))